@@ -1,17 +1,174 @@
+import os
+import json
+import asyncio
+from contextlib import asynccontextmanager
+from typing import List
 from pydantic import BaseModel
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from utils import aclose_async_services, close_services
+from prediction_completion import WebhookCompletion
+from jobs import JobManager, NotRegenerable, QueueFull, job_elements
+from themes import THEME_DIR, publish_themes
 
-app = FastAPI()
+# Seconds between SSE keep-alive comments, so proxies do not drop an idle event stream, and
+# between checks of the job store for new events
+SSE_KEEPALIVE = 15
+SSE_POLL_INTERVAL = 0.25
+
+# When REPLICATE_WEBHOOK_URL points at this server's /replicate/webhook route, predictions
+# started here are resolved by Replicate's completion webhook instead of by polling
+webhook_completion = None
+if os.getenv("REPLICATE_WEBHOOK_URL"):
+    webhook_completion = WebhookCompletion(
+        os.getenv("REPLICATE_WEBHOOK_URL"),
+        secret=os.getenv("REPLICATE_WEBHOOK_SECRET")
+    )
+
+job_manager = JobManager(strategy=webhook_completion)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    publish_themes()
+    job_manager.start()
+    yield
+    await job_manager.stop()
+    # Release the pooled Azure/OpenAI connections when the server shuts down
+    await aclose_async_services()
+    close_services()
+
+class ThemeFiles(StaticFiles):
+    """Theme files are named by a hash of their CSS, so browsers may keep them for good."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+app = FastAPI(lifespan=lifespan)
+# Same URL layout as Streamlit's static serving, so stored image and theme URLs work in both
+# apps; the themes mount comes first so it takes precedence over the general one
+app.mount("/app/static/themes", ThemeFiles(directory=THEME_DIR, check_dir=False), name="themes")
+app.mount("/app/static", StaticFiles(directory="static", check_dir=False), name="static")
 
 class Specifications(BaseModel):
     AGE_GROUP: str
     STRUCTURE: str
     STYLE: str
+    CONTENT: str = ""
+    REGENERATE: bool = False
+
+class Regeneration(BaseModel):
+    ELEMENTS: List[str]
+    # Images only: also write a new prompt for the image instead of just a new rendering
+    REFINE: bool = False
+
+def job_links(job_id: str) -> dict:
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "events_url": f"/jobs/{job_id}/events",
+        "result_url": f"/jobs/{job_id}/result",
+    }
+
+def get_job(job_id: str) -> dict:
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job
 
-@app.post("/generate_html")
-async def generate_html(specifications: Specifications):
+# The endpoints that read or write the job store are plain functions, which FastAPI runs in
+# its threadpool: the SQLite and Redis stores block, and the event loop is shared by every
+# request and the job workers
+
+@app.post("/generate_html", status_code=202)
+def generate_html(specifications: Specifications):
+    """Queues a page and returns at once; poll the status URL or follow the events stream."""
     AGE_GROUP = specifications.AGE_GROUP
     STRUCTURE = specifications.STRUCTURE
     STYLE = specifications.STYLE
-    
+    CONTENT = specifications.CONTENT
+    try:
+        job_id = job_manager.submit(AGE_GROUP, STYLE, CONTENT, STRUCTURE, regenerate=specifications.REGENERATE)
+    except QueueFull as exc:
+        raise HTTPException(status_code=503, detail=f"Too many pages in progress: {exc}", headers={"Retry-After": "30"})
+    return job_links(job_id)
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    get_job(job_id)
+    return job_manager.summary(job_id)
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = get_job(job_id)
+    if job["html"] is None:
+        # The same summary as the status endpoint: 202 until the job is done, and 409 with
+        # its error once it has failed, which is the job's outcome rather than a server fault
+        return JSONResponse(job_manager.summary(job_id), status_code=409 if job["status"] == "failed" else 202)
+    return HTMLResponse(job["html"])
+
+@app.get("/jobs/{job_id}/elements")
+def job_element_list(job_id: str):
+    """The page's images and text sections with their ids, for choosing what to regenerate."""
+    get_job(job_id)
+    return {"job_id": job_id, "elements": job_elements(job_manager.store, job_id)}
+
+@app.post("/jobs/{job_id}/regenerate", status_code=202)
+def regenerate_elements(job_id: str, regeneration: Regeneration):
+    """
+    Queues a new job that redoes only the listed elements of a finished page and keeps the
+    rest; follow it like any other job.
+    """
+    get_job(job_id)
+    try:
+        new_job_id = job_manager.regenerate(job_id, regeneration.ELEMENTS, refine=regeneration.REFINE)
+    except NotRegenerable as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    except QueueFull as exc:
+        raise HTTPException(status_code=503, detail=f"Too many pages in progress: {exc}", headers={"Retry-After": "30"})
+    return job_links(new_job_id)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    Server-sent events: every progress event so far, then new ones until the job ends. Events
+    are read from the job store, so this works whichever process is running the job.
+    """
+    await asyncio.to_thread(get_job, job_id)
+
+    async def stream():
+        seq = 0
+        idle = 0.0
+        while True:
+            # Off the event loop, like the plain def endpoints above
+            events = await asyncio.to_thread(job_manager.store.events, job_id, seq)
+            for seq, event in events:
+                yield f"id: {seq}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+                if event["event"] == "status" and event["status"] in ("done", "failed"):
+                    return
+            if events:
+                idle = 0.0
+            else:
+                idle += SSE_POLL_INTERVAL
+                if idle >= SSE_KEEPALIVE:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keep-alive\n\n"
+                    idle = 0.0
+            await asyncio.sleep(SSE_POLL_INTERVAL)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/replicate/webhook")
+async def replicate_webhook(request: Request):
+    if webhook_completion is None:
+        raise HTTPException(status_code=404, detail="Webhook completion is not enabled")
+    body = await request.body()
+    if not webhook_completion.verify(request.headers, body):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    webhook_completion.resolve(json.loads(body))
+    return {"status": "received"}
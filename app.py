@@ -1,16 +1,32 @@
 import streamlit as st
-import os
-import tempfile
+import asyncio
+from ingest import TEXT_SUFFIXES, ingest_files, save_upload
+from utils import aclose_async_services
 
-def main():
-    uploaded_file = st.file_uploader("Choose a file")
-    # If user attempts to upload a file.
-    if uploaded_file is not None:
-        bytes_data = uploaded_file.getvalue()
+async def add_materials(paths):
+    try:
+        return await ingest_files(paths)
+    finally:
+        # The event loop ends with this script run, so its async clients must be closed here
+        await aclose_async_services()
 
-        # Show the image filename and image.
-        st.write(f'filename: {uploaded_file.name}')
-        st.image(bytes_data)
+def main():
+    st.title("Reference materials")
+    st.write("Past education materials added here are used to ground newly generated pages.")
+    uploaded_files = st.file_uploader(
+        "Choose files", type=["pdf"] + [suffix.lstrip(".") for suffix in TEXT_SUFFIXES], accept_multiple_files=True
+    )
+    # If user attempts to upload files.
+    if uploaded_files and st.button("Add to reference materials"):
+        paths = [save_upload(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+        with st.spinner("Reading and indexing..."):
+            results = asyncio.run(add_materials(paths))
+        for result in results:
+            message = f"{result.name}: {result.status} ({result.pages} pages, {result.chunks} passages)"
+            if result.status.startswith("failed"):
+                st.error(message)
+            else:
+                st.write(message)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
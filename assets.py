@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import io
+import mimetypes
+import os
+from typing import Dict, List, Optional, Tuple, Union
+from uuid import uuid4
+
+from sdk import azure_blob, azure_exceptions
+from utils import get_async_service, get_service
+
+# ASSET_STORE=local writes images under ASSET_DIR, which both entry points serve as static
+# files (Streamlit's static serving under /app/static, and the same mount in apis.py).
+# ASSET_STORE=blob uploads them to the ASSET_CONTAINER container of the Blob Storage
+# account behind CONNECTION_STRING instead.
+ASSET_STORE = os.getenv("ASSET_STORE", "local")
+ASSET_DIR = os.getenv("ASSET_DIR", os.path.join("static", "generated"))
+ASSET_BASE_URL = os.getenv("ASSET_BASE_URL", "/app/static/generated")
+ASSET_CONTAINER = os.getenv("ASSET_CONTAINER", "generated-images")
+
+# Generated images are also resized to their placeholder's slot and re-encoded in these
+# formats (most preferred first), at 1x and, when the render is big enough, 2x the slot size.
+# Formats the installed Pillow cannot encode are skipped: AVIF needs pillow-avif-plugin.
+IMAGE_FORMATS = [name.strip() for name in os.getenv("IMAGE_FORMATS", "avif,webp").split(",") if name.strip()]
+IMAGE_DENSITIES = (1, 2)
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 80))
+_IMAGE_ENCODERS = {"avif": ("AVIF", "image/avif"), "webp": ("WEBP", "image/webp")}
+
+
+def asset_name(data: bytes, content_type: str) -> str:
+    """Names an asset after the hash of its bytes, so identical images are stored once."""
+    extension = mimetypes.guess_extension(content_type or "") or ".webp"
+    return hashlib.sha256(data).hexdigest() + extension
+
+
+class LocalAssetStore:
+    def __init__(self, directory: str = ASSET_DIR, base_url: str = ASSET_BASE_URL):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, name: str, data: bytes, content_type: str) -> str:
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            # Write then rename, so a concurrent reader never sees a half-written file. Every
+            # put has its own temporary file: puts of the same image run in parallel threads
+            temporary_path = f"{path}.{uuid4().hex}.tmp"
+            with open(temporary_path, "wb") as file:
+                file.write(data)
+            os.replace(temporary_path, path)
+        return f"{self.base_url}/{name}"
+
+
+class BlobAssetStore:
+    def __init__(self, container: str = ASSET_CONTAINER, base_url: Optional[str] = os.getenv("ASSET_BASE_URL")):
+        self.container_client = get_service("blob_service_client").get_container_client(container)
+        # A CDN or custom domain in front of the container can be set with ASSET_BASE_URL
+        self.base_url = base_url.rstrip("/") if base_url else None
+        try:
+            self.container_client.create_container(public_access="blob")
+        except azure_exceptions.ResourceExistsError:
+            pass
+
+    def put(self, name: str, data: bytes, content_type: str) -> str:
+        blob_client = self.container_client.get_blob_client(name)
+        try:
+            blob_client.upload_blob(
+                data,
+                overwrite=False,
+                content_settings=azure_blob.ContentSettings(content_type=content_type, cache_control="public, max-age=31536000, immutable")
+            )
+        except azure_exceptions.ResourceExistsError:
+            pass
+        return f"{self.base_url}/{name}" if self.base_url else blob_client.url
+
+
+_asset_store = None
+
+
+def get_asset_store():
+    global _asset_store
+    if _asset_store is None:
+        _asset_store = BlobAssetStore() if ASSET_STORE == "blob" else LocalAssetStore()
+    return _asset_store
+
+
+async def store_asset(data: bytes, content_type: str) -> str:
+    """Persists `data` (deduplicated by content hash) and returns its stable URL."""
+    name = asset_name(data, content_type)
+    # Both stores do blocking file or network I/O, and building the blob store creates its
+    # container, so keep both off the event loop
+    return await asyncio.to_thread(lambda: get_asset_store().put(name, data, content_type))
+
+
+async def fetch_remote_asset(url: str) -> Tuple[bytes, str]:
+    response = await get_async_service("http_client").get(url)
+    response.raise_for_status()
+    return response.content, response.headers.get("content-type", "image/webp").split(";")[0]
+
+
+async def store_remote_asset(url: str) -> str:
+    """Downloads a temporary URL (e.g. a Replicate output) once and returns its stable URL."""
+    return await store_asset(*await fetch_remote_asset(url))
+
+
+def supported_image_formats() -> List[str]:
+    try:
+        from PIL import Image
+    except ImportError:
+        return []
+    try:
+        import pillow_avif  # noqa: F401 (registers the AVIF encoder)
+    except ImportError:
+        pass
+    Image.init()
+    return [name for name in IMAGE_FORMATS if name in _IMAGE_ENCODERS and _IMAGE_ENCODERS[name][0] in Image.SAVE]
+
+
+def encode_image_variants(data: bytes, width: int, height: int, formats: List[str]) -> List[Tuple[str, int, bytes]]:
+    """
+    Crops and resizes an image to width x height at each density, encoded in each format.
+    Returns (content_type, pixel_width, bytes) tuples; densities the source image is too small
+    for are left out rather than upscaled.
+    """
+    from PIL import Image, ImageOps
+
+    variants = []
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for density in IMAGE_DENSITIES:
+            size = (width * density, height * density)
+            if density > 1 and (size[0] > image.width or size[1] > image.height):
+                break
+            fitted = ImageOps.fit(image, size, Image.LANCZOS)
+            for name in formats:
+                pillow_format, content_type = _IMAGE_ENCODERS[name]
+                buffer = io.BytesIO()
+                fitted.save(buffer, pillow_format, quality=IMAGE_QUALITY)
+                variants.append((content_type, size[0], buffer.getvalue()))
+    return variants
+
+
+async def store_image_variants(data: bytes, dimensions: Tuple[int, int]) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    Stores slot-sized copies of an image and returns {content_type: [(url, pixel_width), ...]}
+    in format preference order, ready for <picture>/srcset. Empty if Pillow is not installed.
+    """
+    formats = supported_image_formats()
+    if not formats:
+        return {}
+    # Decoding and encoding are CPU-bound, so keep them off the event loop
+    encoded = await asyncio.to_thread(encode_image_variants, data, *dimensions, formats)
+    urls = await asyncio.gather(*[store_asset(variant, content_type) for content_type, _, variant in encoded])
+    variants = {}
+    for (content_type, width, _), url in zip(encoded, urls):
+        variants.setdefault(content_type, []).append((url, width))
+    return variants
+
+
+async def store_prediction_output(output: Union[str, List[str]], dimensions: Optional[Tuple[int, int]] = None) -> Tuple[List[str], Dict[str, List[Tuple[str, int]]]]:
+    """
+    Stores every output image and returns their stable URLs, plus slot-sized variants of the
+    first one (see store_image_variants) when the placeholder's dimensions are known.
+    """
+    urls = output if isinstance(output, list) else [output]
+    data, content_type = await fetch_remote_asset(urls[0])
+    stored = await asyncio.gather(store_asset(data, content_type), *[store_remote_asset(url) for url in urls[1:]])
+    variants = {}
+    if dimensions:
+        try:
+            variants = await store_image_variants(data, dimensions)
+        except Exception as exc:
+            # The full-size original is still usable
+            print(f"Could not resize {urls[0]}: {exc!r}")
+    return list(stored), variants
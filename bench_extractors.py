@@ -0,0 +1,110 @@
+# Benchmark: filling every placeholder of a large generated page. Compares the previous
+# regex functions (extract and replace, run separately for images and for text, each
+# replacement scanning the element list) with one PlaceholderIndex pass plus one render.
+#
+#   python bench_extractors.py --placeholders 100 200 400 800 --repeat 5
+import argparse
+import re
+import time
+from typing import List
+
+from elements import GraphicElement
+from extractors import PlaceholderIndex, extract_image_descriptions, extract_text_descriptions
+
+
+def image_url(description: str) -> str:
+    return f"https://example.com/{description.split()[2]}.webp"
+
+
+def legacy_extract(html_content: str, pattern: str, element_type: str) -> List[GraphicElement]:
+    elements = []
+    for match in re.compile(pattern).findall(html_content):
+        description = match[1] if isinstance(match, tuple) else match
+        elements.append(GraphicElement(element_type=element_type, description=description))
+    return elements
+
+
+def legacy_fill(html_content: str) -> str:
+    """The pre-index flow: four whole-document scans and a linear element lookup per match."""
+    image_pattern = r'<div class="image-placeholder">[\s\S]*?\[Image: (\d+x\d+) - (.*?)\]\s*</div>'
+    text_pattern = r'\[DESCRIPTION:\s*"(.*?)"\]'
+    images = legacy_extract(html_content, image_pattern, "image")
+    texts = legacy_extract(html_content, text_pattern, "text")
+    for element in images:
+        element.content = [image_url(element.description)]
+    for element in texts:
+        element.content = f"<p>{element.description}</p>"
+
+    def replace_image(match):
+        for element in images:
+            if element.description == match.group(2) and element.content:
+                return f'<img src="{element.content[0]}" alt="{match.group(2)}">'
+        return match.group(0)
+
+    def replace_text(match):
+        for element in texts:
+            if element.description == match.group(1) and element.content:
+                return element.content
+        return match.group(0)
+
+    html_content = re.compile(text_pattern).sub(replace_text, html_content)
+    return re.compile(image_pattern).sub(replace_image, html_content)
+
+
+def indexed_fill(html_content: str) -> str:
+    index = PlaceholderIndex(html_content)
+    elements = index.elements()
+    for element in elements:
+        if element.type == "image":
+            element.content = [image_url(element.description)]
+        else:
+            element.content = f"<p>{element.description}</p>"
+    return index.fill(elements)
+
+
+def generated_page(placeholders: int) -> str:
+    boxes = []
+    for i in range(placeholders):
+        if i % 2:
+            boxes.append(
+                f'<div class="content-box span-2">\n    <div class="image-placeholder">\n'
+                f'        [Image: 600x400 - Illustration number {i} of a family enjoying a picnic in a sunny park, warm colours]\n'
+                f'    </div>\n</div>'
+            )
+        else:
+            boxes.append(
+                f'<div class="content-box">\n'
+                f'    [DESCRIPTION: "Section {i}: guidance for parents on talking with their children, with practical tips."]\n</div>'
+            )
+    return "<head><style>.content-box { padding: 1em; }</style></head>\n<body>\n<div class=\"grid\">\n" + "\n".join(boxes) + "\n</div>\n</body>"
+
+
+def best_of(function, html_content: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(html_content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--placeholders", type=int, nargs="+", default=[100, 200, 400, 800])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for placeholders in args.placeholders:
+        page = generated_page(placeholders)
+        assert legacy_fill(page) == indexed_fill(page), "the two implementations disagree"
+        assert len(extract_image_descriptions(page)) + len(extract_text_descriptions(page)) == placeholders
+        legacy = best_of(legacy_fill, page, args.repeat)
+        indexed = best_of(indexed_fill, page, args.repeat)
+        print(
+            f"{placeholders:>5} placeholders ({len(page) / 1024:>6.0f} KiB)  "
+            f"regex {legacy * 1000:>8.2f}ms  index {indexed * 1000:>7.2f}ms  ({legacy / indexed:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Benchmark: cold-start import time of the entry points, measured with `python -X importtime`
+# in a fresh interpreter per run. Fails (exit status 1) when a module is over its budget or
+# opens a network connection while being imported.
+#
+#   python bench_imports.py --repeat 3
+#   python bench_imports.py apis --top 15
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Seconds of cumulative import time allowed per module, on a warm disk cache
+BUDGETS = {
+    # Library modules: no SDKs and no I/O on import
+    "htmlgenerator": 0.05,
+    "worker": 0.1,
+    # Workers: what a `worker.py` process, a FastAPI process and a Streamlit session load.
+    # SDKs (see sdk.py) are imported by the first stage that uses them, not here.
+    "jobs": 0.25,
+    "apis": 0.6,
+    "stapp": 2.0,
+}
+# Reported when an import pulls them in; none of them should be loaded by an import alone
+SDKS = ("openai", "httpx", "azure.storage.blob", "azure.search.documents", "replicate", "PIL")
+
+# Runs in the child before the import, so any connection attempt fails loudly
+NO_NETWORK = """
+import socket
+def refuse(*args, **kwargs):
+    raise RuntimeError("network access during import")
+socket.socket.connect = refuse
+socket.create_connection = refuse
+socket.getaddrinfo = refuse
+import {module}
+import json, resource, sys
+print(json.dumps({{
+    "rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "sdks": [name for name in {sdks!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(module: str):
+    """
+    Returns (seconds, [(self_us, cumulative_us, name)], details) for one cold import of
+    `module`, where details has the peak RSS in KiB and the SDKs that got loaded.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", NO_NETWORK.format(module=module, sdks=SDKS)],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nested imports are indented two spaces per level and listed before their parent
+        rows.append((int(self_us), int(cumulative_us), name.strip(), len(name) - len(name.lstrip())))
+    # Keep only the module's own import tree: its line and the nested lines just above it
+    end = max(index for index, row in enumerate(rows) if row[2] == module and row[3] == 1)
+    start = end
+    while start > 0 and rows[start - 1][3] > 1:
+        start -= 1
+    tree = [row[:3] for row in rows[start:end + 1]]
+    return tree[-1][1] / 1e6, tree, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def by_package(rows):
+    """Self time summed per top-level package, largest first."""
+    packages = {}
+    for self_us, _, name in rows:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5, help="packages to list per module")
+    args = parser.parse_args()
+
+    over = []
+    for module in args.modules:
+        try:
+            runs = [measure(module) for _ in range(args.repeat)]
+        except RuntimeError as exc:
+            if "ModuleNotFoundError" in str(exc) and f"'{module}'" not in str(exc):
+                print(f"{module:>14}: skipped, a dependency is not installed ({exc})")
+                continue
+            print(f"{module:>14}: FAILED, {exc}")
+            over.append(module)
+            continue
+        seconds, rows, details = min(runs, key=lambda run: run[0])
+        budget = BUDGETS.get(module)
+        verdict = "" if budget is None else ("ok" if seconds <= budget else "OVER BUDGET")
+        print(
+            f"{module:>14}: {seconds * 1000:7.1f}ms (budget {budget * 1000 if budget else float('nan'):.0f}ms) {verdict}, "
+            f"peak RSS {details['rss_kib'] / 1024:.0f} MiB, SDKs loaded: {', '.join(details['sdks']) or 'none'}"
+        )
+        for package, self_us in by_package(rows)[:args.top]:
+            print(f"{'':>16}{package:<24}{self_us / 1000:7.1f}ms")
+        if budget is not None and seconds > budget:
+            over.append(module)
+    if over:
+        raise SystemExit(f"over budget: {', '.join(over)}")
+
+
+if __name__ == "__main__":
+    main()
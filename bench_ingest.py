@@ -0,0 +1,161 @@
+# Benchmark: ingest throughput in pages per second (see ingest.py). Generates synthetic PDFs,
+# then ingests them into a fresh index against a local fake embeddings endpoint, once per
+# --processes value, and finally ingests the same files again to show that a re-upload is
+# skipped without parsing or embedding anything.
+#
+#   python bench_ingest.py --files 20 --pages 20 --processes 1 2 4 --latency 0.2
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+LATENCY = 0.2
+DIMENSIONS = 1536
+WORDS = (
+    "drugs prevention youth school parents community health risk cannabis vaping alcohol "
+    "peer pressure support counselling choices future family friends law harm addiction "
+    "help hotline signs talk listen trust wellbeing sport music learning safety"
+).split()
+
+
+class FakeEmbeddingsHandler(BaseHTTPRequestHandler):
+    """Answers every POST with a pseudo-random vector per input after sleeping LATENCY seconds."""
+
+    requests = 0
+    inputs = 0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(LATENCY)
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        type(self).requests += 1
+        type(self).inputs += len(texts)
+        data = []
+        for index, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+            vector = np.random.default_rng(seed).standard_normal(request.get("dimensions") or DIMENSIONS, dtype=np.float32)
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(vector.tobytes()).decode()
+            else:
+                vector = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        body = json.dumps({
+            "object": "list",
+            "data": data,
+            "model": "fake",
+            "usage": {"prompt_tokens": 10, "total_tokens": 10},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEndpointServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def start_fake_endpoint():
+    server = FakeEndpointServer(("127.0.0.1", 0), FakeEmbeddingsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_pdfs(directory: str, files: int, pages: int, seed: int):
+    """Writes `files` PDFs of `pages` pages of made-up text each (about 2,500 characters a page)."""
+    import pymupdf
+
+    rng = random.Random(seed)
+    paths = []
+    for number in range(files):
+        document = pymupdf.open()
+        for _ in range(pages):
+            page = document.new_page()
+            paragraphs = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 90))).capitalize() + "." for _ in range(5)]
+            page.insert_textbox(pymupdf.Rect(50, 50, 545, 800), "\n\n".join(paragraphs), fontsize=9)
+        path = os.path.join(directory, f"material-{number}.pdf")
+        document.save(path)
+        document.close()
+        paths.append(path)
+    return paths
+
+
+async def timed_ingest(paths, processes: int, index):
+    from ingest import ingest_files
+    from utils import aclose_async_services
+
+    FakeEmbeddingsHandler.requests = FakeEmbeddingsHandler.inputs = 0
+    start = time.perf_counter()
+    try:
+        results = await ingest_files(paths, processes, index=index)
+    finally:
+        await aclose_async_services()
+    return time.perf_counter() - start, results
+
+
+def report(label: str, elapsed: float, results):
+    pages = sum(result.pages for result in results)
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    print(
+        f"{label:>22}: {elapsed:6.2f}s  {pages / elapsed if pages else 0:7.1f} pages/s  "
+        f"{sum(result.chunks for result in results):5d} chunks  {FakeEmbeddingsHandler.requests:4d} embedding requests "
+        f"({FakeEmbeddingsHandler.inputs} inputs)  {statuses}"
+    )
+
+
+def main():
+    global LATENCY
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latency", type=float, default=LATENCY, help="seconds per embeddings request")
+    args = parser.parse_args()
+    LATENCY = args.latency
+
+    directory = tempfile.mkdtemp()
+    server = start_fake_endpoint()
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{server.server_address[1]}",
+        "AZURE_OPENAI_API_KEY": "fake",
+        "AZURE_OPENAI_EMBEDDING_TPM": "100000000",
+        "AZURE_OPENAI_EMBEDDING_RPM": "100000",
+        "CACHE_PATH": os.path.join(directory, "cache.sqlite3"),
+    })
+    from retrieval import LocalVectorIndex
+    from sdk import openai
+
+    # Import the client SDK now rather than in the first timed run
+    openai.AsyncAzureOpenAI
+
+    paths = make_pdfs(directory, args.files, args.pages, seed=0)
+    print(f"{os.cpu_count()} CPU(s), {args.files} files x {args.pages} pages, {args.latency}s per embeddings request")
+    for processes in args.processes:
+        # A model name of its own per run, so no run finds another's embeddings in the cache
+        os.environ["AZURE_OPENAI_EMBEDDING_MODEL"] = f"fake-{processes}"
+        index = LocalVectorIndex(os.path.join(directory, f"index-{processes}"))
+        elapsed, results = asyncio.run(timed_ingest(paths, processes, index))
+        report(f"{processes} process(es)", elapsed, results)
+    elapsed, results = asyncio.run(timed_ingest(paths, args.processes[-1], index))
+    report("re-upload", elapsed, results)
+
+
+if __name__ == "__main__":
+    main()
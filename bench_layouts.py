@@ -0,0 +1,118 @@
+# Benchmark: JSON layouts (LAYOUT_OUTPUT=json, see layouts.py) against HTML layouts on the
+# repo's unfilled layouts (the full prompt example and first_draft.html):
+#   output tokens  what the model writes for the same page in each format, and the time that
+#                  takes at --decode tokens/second
+#   local cost     parsing and validating a JSON layout and rendering it to HTML
+#   damage         --trials responses cut off at a random point, and as many with one section
+#                  broken: how often the page survives without a further request, and what
+#                  the targeted repair costs next to generating the layout again (all an HTML
+#                  layout can do, since extract_html_content finds nothing in a cut-off page)
+# Token counts use tokens.count_tokens.
+#
+#   python bench_layouts.py --decode 60 --trials 200
+import argparse
+import json
+import random
+import statistics
+import time
+
+DECODE_TOKENS_PER_SECOND = 60.0
+
+
+def pages():
+    from bench_themes import structure_only
+    from htmlgeneratorfunc import FULL_EXAMPLE
+
+    with open("first_draft.html") as file:
+        first_draft = file.read()
+    return {"prompt example": FULL_EXAMPLE, "first_draft.html": structure_only(first_draft)}
+
+
+def timed(function, repeat: int = 200) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def break_section(text: str, rng: random.Random) -> str:
+    """The layout with one section made invalid in one of the ways a model gets it wrong."""
+    data = json.loads(text)
+    section = rng.choice(data["sections"])
+    damage = rng.randrange(4)
+    if damage == 0:
+        section["size"] = "half"
+    elif damage == 1:
+        section["slots"] = []
+    elif damage == 2:
+        section["slots"][0]["kind"] = "picture"
+    else:
+        section["slots"][0]["description"] = ""
+    return json.dumps(data, separators=(",", ":"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--decode", type=float, default=DECODE_TOKENS_PER_SECOND, help="output tokens generated per second")
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--format", default="pamphlet")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from extractors import PlaceholderIndex
+    from htmlgeneratorfunc import SECTION_REPAIR_PROMPT, build_html_prompt, extract_html_content, layout_max_tokens
+    from layouts import SECTION_SHAPE, LayoutError, layout_from_html, parse_layout, render_layout
+    from tokens import count_tokens, load_encoding
+
+    print(f"Token counts by {'tiktoken' if load_encoding() is not None else 'approximation'}")
+    layouts = {}
+    for name, page in pages().items():
+        layout = layout_from_html(page)
+        text = layout.model_dump_json(exclude_defaults=True)
+        layouts[name] = text
+        html_tokens, json_tokens = count_tokens(page), count_tokens(text)
+        assert len(PlaceholderIndex(render_layout(layout))) == len(PlaceholderIndex(page))
+        print(
+            f"{name:>17}: {len(layout.sections):2d} sections, {html_tokens:4d} HTML -> {json_tokens:4d} JSON output tokens "
+            f"({1 - json_tokens / html_tokens:3.0%} fewer, {html_tokens / args.decode:4.1f}s -> {json_tokens / args.decode:4.1f}s), "
+            f"parse {timed(lambda: parse_layout(text)) * 1e6:4.0f}us, render {timed(lambda: render_layout(layout)) * 1e6:4.0f}us"
+        )
+
+    rng = random.Random(args.seed)
+    text = layouts["first_draft.html"]
+    html = "<!DOCTYPE html>" + pages()["first_draft.html"].split("<!DOCTYPE html>", 1)[-1]
+    kept, html_kept = [], 0
+    for _ in range(args.trials):
+        cut = rng.randrange(len(text) // 10, len(text))
+        try:
+            kept.append(len(parse_layout(text[:cut]).layout.sections))
+        except LayoutError:
+            kept.append(0)
+        html_kept += extract_html_content(html[:rng.randrange(len(html) // 10, len(html))]) is not None
+    sections = len(json.loads(text)["sections"])
+    print(
+        f"{'cut off':>17}: JSON keeps a page in {sum(1 for count in kept if count) / args.trials:4.0%} of responses "
+        f"({statistics.mean(kept) / sections:3.0%} of the sections on average), HTML in {html_kept / args.trials:4.0%}"
+    )
+
+    regeneration = count_tokens(build_html_prompt("parents", "90's cartoon style", "the risks of vaping", args.format, output="json"))
+    repair_prompt, repair_output, repair_reserved = [], [], []
+    for _ in range(args.trials):
+        parsed = parse_layout(break_section(text, rng))
+        assert len(parsed.broken) == 1 and len(parsed.layout.sections) == sections - 1
+        broken = "\n".join(f"{number}. {json.dumps(item.data)}\nERRORS: {item.errors}" for number, item in enumerate(parsed.broken, 1))
+        repair_prompt.append(count_tokens(SECTION_REPAIR_PROMPT.format(shape=SECTION_SHAPE, count=1, sections=broken)))
+        repair_output.append(count_tokens(json.dumps(parsed.broken[0].data)))
+        # As htmlgeneratorfunc.repair_layout_sections sizes max_tokens
+        repair_reserved.append(repair_prompt[-1] + 2 * count_tokens(broken) + 64)
+    print(
+        f"{'one bad section':>17}: the other {sections - 1} kept; repair {statistics.mean(repair_prompt):4.0f} prompt + "
+        f"{statistics.mean(repair_output):3.0f} output tokens ({statistics.mean(repair_output) / args.decode:4.1f}s), against "
+        f"{regeneration:4d} + {count_tokens(text):3d} ({count_tokens(text) / args.decode:4.1f}s) to generate the layout again "
+        f"(quota reserved: {statistics.mean(repair_reserved):4.0f} against "
+        f"{regeneration + layout_max_tokens(args.format, 'json')} tokens)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Benchmark: compares prediction completion strategies against the stub predictions server
+# from bench_predictions.py. Reports status polls sent and the p50/p95 time until a finished
+# prediction is noticed. Webhook delivery is simulated in-process: the stub hands the
+# finished prediction straight to WebhookCompletion.resolve on the event loop.
+#
+#   python bench_polling.py --predictions 16 --runtime 4 --jitter 0.3
+import argparse
+import asyncio
+import os
+import tempfile
+
+import bench_predictions
+from prediction_completion import AdaptivePolling, FixedIntervalPolling, PredictionMetrics, WebhookCompletion
+
+
+async def run_strategy(strategy, predictions):
+    from elements import GraphicElement
+    from imgen import run_multiple_image_predictions
+
+    # Two rounds, so AdaptivePolling has learned the model's typical runtime in the second
+    for round in range(2):
+        strategy.metrics = PredictionMetrics()
+        # Distinct prompts per run, otherwise the image cache would answer instead of the stub
+        elements = [GraphicElement("image", f"{type(strategy).__name__} round {round} image {i}") for i in range(predictions)]
+        await run_multiple_image_predictions(elements, strategy)
+    return strategy.metrics.summary()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--predictions", type=int, default=16)
+    parser.add_argument("--rtt", type=float, default=0.05)
+    parser.add_argument("--runtime", type=float, default=4.0)
+    parser.add_argument("--jitter", type=float, default=0.3)
+    args = parser.parse_args()
+    bench_predictions.RTT = args.rtt
+    bench_predictions.RUNTIME = args.runtime
+    bench_predictions.JITTER = args.jitter
+
+    server = bench_predictions.start_stub_server()
+    os.environ["REPLICATE_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault("REPLICATE_API_TOKEN", "stub-token")
+    scratch = tempfile.mkdtemp()
+    os.environ["CACHE_PATH"] = os.path.join(scratch, "bench.sqlite3")
+    os.environ["ASSET_DIR"] = os.path.join(scratch, "assets")
+    from utils import aclose_async_services
+
+    loop = asyncio.get_running_loop()
+    webhook = WebhookCompletion("http://127.0.0.1/replicate/webhook")
+    bench_predictions.StubPredictionsHandler.webhook_callback = (
+        lambda prediction: loop.call_soon_threadsafe(webhook.resolve, prediction)
+    )
+
+    results = {
+        "fixed 2s polling": await run_strategy(FixedIntervalPolling(2.0), args.predictions),
+        "adaptive polling": await run_strategy(AdaptivePolling(), args.predictions),
+        "webhook": await run_strategy(webhook, args.predictions),
+    }
+    await aclose_async_services()
+    server.shutdown()
+
+    baseline = results["fixed 2s polling"]
+    print(f"{args.predictions} predictions, runtime {args.runtime:.2f}s +/- {args.jitter:.0%}, {args.rtt:.2f}s round trip")
+    for name, summary in results.items():
+        saved = baseline["polls"] - summary["polls"]
+        print(
+            f"  {name:<17} polls {summary['polls']:>4} (saved {saved:>4})  "
+            f"p50 {summary['p50_latency']:.2f}s  p95 {summary['p95_latency']:.2f}s  "
+            f"(p95 {summary['p95_latency'] - baseline['p95_latency']:+.2f}s vs fixed)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
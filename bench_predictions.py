@@ -0,0 +1,205 @@
+# Harness: runs N image predictions against a local stub of the Replicate predictions API
+# and reports wall-clock time plus the worst event-loop stall seen while they were in flight.
+# The blocking variant issues the same requests with a synchronous client, as the old
+# replicate.predictions.create/get calls did.
+#
+#   python bench_predictions.py --predictions 8 --rtt 0.2 --runtime 1.0
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from uuid import uuid4
+
+from bench_refinements import FakeEndpointServer
+
+RTT = 0.2
+RUNTIME = 1.0
+# Each prediction's runtime is drawn uniformly from RUNTIME * (1 +/- JITTER)
+JITTER = 0.0
+
+
+class StubPredictionsHandler(BaseHTTPRequestHandler):
+    """Minimal Replicate predictions API: predictions succeed RUNTIME seconds after creation."""
+
+    predictions = {}
+    lock = threading.Lock()
+    # Called with the finished prediction when a request asked for a webhook
+    webhook_callback = None
+    noise = None
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(RTT)
+        if self.path.endswith("/cancel"):
+            prediction_id = self.path.rsplit("/", 2)[-2]
+            with self.lock:
+                self.predictions[prediction_id]["canceled"] = True
+            self.send_json(200, self.render(prediction_id))
+            return
+        prediction_id = uuid4().hex
+        runtime = RUNTIME * random.uniform(1 - JITTER, 1 + JITTER)
+        with self.lock:
+            self.predictions[prediction_id] = {"created": time.time(), "runtime": runtime, "input": payload.get("input", {})}
+        if payload.get("webhook") and self.webhook_callback:
+            callback = type(self).webhook_callback
+            threading.Timer(runtime, lambda: callback(self.render(prediction_id))).start()
+        self.send_json(201, self.render(prediction_id))
+
+    def do_GET(self):
+        time.sleep(RTT)
+        if self.path.startswith("/outputs/"):
+            body = self.output_image(self.path.rsplit("/", 1)[-1].split(".")[0])
+            self.send_response(200)
+            self.send_header("Content-Type", "image/webp")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        prediction_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+        if prediction_id not in self.predictions:
+            self.send_json(404, {"detail": "Not found"})
+            return
+        self.send_json(200, self.render(prediction_id))
+
+    def output_image(self, prediction_id):
+        """
+        A WebP the size flux-schnell would render for the prediction's aspect_ratio and
+        megapixels, or, without Pillow, a few bytes that differ per prediction.
+        """
+        try:
+            from PIL import Image
+        except ImportError:
+            return b"RIFF\0\0\0\0WEBPVP8 " + prediction_id.encode()
+        prediction_input = self.predictions.get(prediction_id, {}).get("input", {})
+        ratio_width, ratio_height = map(int, prediction_input.get("aspect_ratio", "1:1").split(":"))
+        pixels = float(prediction_input.get("megapixels", "1")) * 1024 * 1024
+        width = int((pixels * ratio_width / ratio_height) ** 0.5)
+        height = int(pixels / width)
+        seed = int(prediction_id[:6], 16)
+        # Rendering full-size noise takes ~0.4s per image under the GIL, which made the stub the
+        # bottleneck of multi-process runs; a flat image with one noisy tile is ~10x cheaper
+        if StubPredictionsHandler.noise is None:
+            StubPredictionsHandler.noise = Image.effect_noise((256, 256), 40).convert("RGB")
+        image = Image.new("RGB", (width, height), (seed % 256, seed // 256 % 256, seed // 65536 % 256))
+        image.paste(self.noise, (0, 0))
+        buffer = io.BytesIO()
+        image.save(buffer, "WEBP", quality=80, method=0)
+        return buffer.getvalue()
+
+    def render(self, prediction_id):
+        prediction = self.predictions[prediction_id]
+        done = time.time() - prediction["created"] >= prediction["runtime"]
+        if prediction.get("canceled") and not done:
+            return {"id": prediction_id, "model": "black-forest-labs/flux-schnell", "status": "canceled", "output": None}
+        return {
+            "id": prediction_id,
+            "model": "black-forest-labs/flux-schnell",
+            "version": "stub",
+            "input": prediction["input"],
+            "status": "succeeded" if done else "processing",
+            "output": [f"http://{self.headers['Host']}/outputs/{prediction_id}.webp"] if done else None,
+            "logs": "",
+            "error": None,
+            "metrics": {"predict_time": prediction["runtime"]} if done else {},
+            "urls": {"get": f"/v1/predictions/{prediction_id}"},
+        }
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = FakeEndpointServer(("127.0.0.1", 0), StubPredictionsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """Returns the longest time the event loop failed to wake this task on schedule."""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def blocking_predictions(elements, base_url):
+    import httpx
+
+    async def predict(element):
+        with httpx.Client(base_url=base_url) as client:
+            prediction = client.post("/v1/models/black-forest-labs/flux-schnell/predictions", json={"input": {"prompt": element.description}}).json()
+            while prediction["status"] not in ["succeeded", "failed", "canceled"]:
+                await asyncio.sleep(2)
+                prediction = client.get(f"/v1/predictions/{prediction['id']}").json()
+        element.content = prediction["output"]
+
+    await asyncio.gather(*[predict(element) for element in elements])
+
+
+async def timed(run):
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    start = time.perf_counter()
+    await run
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await lag_task
+
+
+async def main():
+    global RTT, RUNTIME
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--predictions", type=int, default=8)
+    parser.add_argument("--rtt", type=float, default=0.2)
+    parser.add_argument("--runtime", type=float, default=1.0)
+    args = parser.parse_args()
+    RTT, RUNTIME = args.rtt, args.runtime
+
+    server = start_stub_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["REPLICATE_BASE_URL"] = base_url
+    os.environ.setdefault("REPLICATE_API_TOKEN", "stub-token")
+    scratch = tempfile.mkdtemp()
+    os.environ["CACHE_PATH"] = os.path.join(scratch, "bench.sqlite3")
+    os.environ["ASSET_DIR"] = os.path.join(scratch, "assets")
+
+    from elements import GraphicElement
+    from imgen import run_multiple_image_predictions
+    from utils import aclose_async_services
+
+    def make_elements():
+        return [GraphicElement("image", f"Placeholder image {i}") for i in range(args.predictions)]
+
+    blocking_elements = make_elements()
+    blocking_time, blocking_lag = await timed(blocking_predictions(blocking_elements, base_url))
+
+    async_elements = make_elements()
+    async_time, async_lag = await timed(run_multiple_image_predictions(async_elements))
+    await aclose_async_services()
+    server.shutdown()
+
+    assert all(element.content for element in blocking_elements + async_elements)
+    print(f"{args.predictions} predictions, {RTT:.2f}s round trip, {RUNTIME:.2f}s model runtime")
+    print(f"  blocking client: {blocking_time:.2f}s wall, worst event-loop stall {blocking_lag * 1000:.0f} ms")
+    print(f"  async client:    {async_time:.2f}s wall, worst event-loop stall {async_lag * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
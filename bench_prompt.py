@@ -0,0 +1,150 @@
+# Benchmark: layout prompt size and time to first token (see htmlgeneratorfunc). Compares
+#   legacy   the previous prompt: request first, then instructions and the full example, and
+#            max_tokens=4096 for every format
+#   full     instructions and full example first (a shared, cacheable prefix), sized max_tokens
+#   compact  instructions and compact example first, sized max_tokens
+# against a local fake Azure OpenAI endpoint that models the cost of reading a prompt: time
+# to first token is --rtt plus the uncached prompt tokens at --prefill tokens per second,
+# where, as on Azure, a prefix of 1,024 tokens or more shared with an earlier prompt is
+# cached in 128-token steps. Token counts use tokens.count_tokens.
+#
+#   python bench_prompt.py --requests 20 --format pamphlet --prefill 4000 --rtt 0.15
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RTT = 0.15
+PREFILL_TOKENS_PER_SECOND = 4000.0
+# The quota divided up in the layouts-per-minute column (AZURE_OPENAI_TPM's default)
+TPM = 30000
+
+
+def cached_prefix_tokens(prompt: str, previous) -> int:
+    from tokens import count_tokens
+
+    shared = 0
+    for earlier in previous:
+        length = len(os.path.commonprefix([prompt, earlier]))
+        shared = max(shared, length)
+    tokens = count_tokens(prompt[:shared])
+    return tokens // 128 * 128 if tokens >= 1024 else 0
+
+
+class FakePrefillHandler(BaseHTTPRequestHandler):
+    """Streams a short layout after RTT plus the modelled prefill time of the prompt."""
+
+    prompts = []
+    cached = []
+    lock = threading.Lock()
+    layout = '<!DOCTYPE html><html><body><div class="content-box">[DESCRIPTION: "Intro."]</div></body></html>'
+
+    def do_POST(self):
+        from tokens import count_tokens
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        prompt = request["messages"][-1]["content"]
+        with self.lock:
+            cached = cached_prefix_tokens(prompt, self.prompts)
+            type(self).prompts.append(prompt)
+            type(self).cached.append(cached)
+        time.sleep(RTT + (count_tokens(prompt) - cached) / PREFILL_TOKENS_PER_SECOND)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for finish_reason, content in ((None, self.layout), ("stop", None)):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "fake",
+                "choices": [{"index": 0, "finish_reason": finish_reason, "delta": {"content": content} if content else {}}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEndpointServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def legacy_prompt(target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
+    from htmlgeneratorfunc import FULL_EXAMPLE, LAYOUT_INSTRUCTIONS
+
+    return f"""TARGET AUDIENCE: {target_audience}
+STYLISTIC DESCRIPTION: {stylistic_description}
+CONTENT DESCRIPTION: {content_description}
+FORMAT: {format}
+
+{LAYOUT_INSTRUCTIONS}
+EXAMPLE OUTPUT:
+
+{FULL_EXAMPLE}
+"""
+
+
+async def measure(name: str, requests: int, format: str):
+    from htmlgeneratorfunc import build_html_prompt, layout_max_tokens
+    from tokens import count_tokens
+    from utils import aclose_async_services, stream_openai_completion
+
+    FakePrefillHandler.prompts, FakePrefillHandler.cached = [], []
+    first_tokens, prompt_tokens = [], []
+    try:
+        for number in range(requests):
+            audience = f"secondary school students, class {number}"
+            start = time.perf_counter()
+            if name == "legacy":
+                prompt, max_tokens = legacy_prompt(audience, "bold comic style", "the risks of vaping", format), 4096
+            else:
+                prompt = build_html_prompt(audience, "bold comic style", "the risks of vaping", format, example=name)
+                max_tokens = layout_max_tokens(format)
+            async for _ in stream_openai_completion(prompt, max_tokens=max_tokens):
+                first_tokens.append(time.perf_counter() - start)
+                break
+            prompt_tokens.append(count_tokens(prompt))
+    finally:
+        await aclose_async_services()
+    reservation = statistics.mean(prompt_tokens) + max_tokens
+    print(
+        f"{name:>8}: {statistics.mean(prompt_tokens):6.0f} prompt tokens ({statistics.mean(FakePrefillHandler.cached[1:] or [0]):5.0f} cached after the first), "
+        f"max_tokens {max_tokens}, TTFT p50 {statistics.median(first_tokens) * 1000:5.0f}ms, "
+        f"quota reserved {reservation:5.0f} tokens = {TPM / reservation:4.1f} layouts per minute at {TPM} TPM"
+    )
+
+
+def main():
+    global RTT, PREFILL_TOKENS_PER_SECOND
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--format", default="pamphlet")
+    parser.add_argument("--prefill", type=float, default=PREFILL_TOKENS_PER_SECOND, help="prompt tokens read per second")
+    parser.add_argument("--rtt", type=float, default=RTT)
+    args = parser.parse_args()
+    RTT, PREFILL_TOKENS_PER_SECOND = args.rtt, args.prefill
+
+    server = FakeEndpointServer(("127.0.0.1", 0), FakePrefillHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{server.server_address[1]}",
+        "AZURE_OPENAI_API_KEY": "fake",
+        "AZURE_OPENAI_TPM": "100000000",
+        "RETRIEVAL_BACKEND": "off",
+    })
+    from tokens import load_encoding
+
+    print(f"Token counts by {'tiktoken' if load_encoding() is not None else 'approximation'}, format {args.format!r}")
+    for name in ("legacy", "full", "compact"):
+        asyncio.run(measure(name, args.requests, args.format))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# Benchmark: wall-clock time for N concurrent image refinements against a local fake
+# Azure OpenAI endpoint. Compares the old blocking client path (sync AzureOpenAI called
+# inside a coroutine) with the async path used by utils.create_openai_completion.
+#
+#   python bench_refinements.py --refinements 8 --latency 0.5
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY = 0.5
+
+
+class FakeChatCompletionHandler(BaseHTTPRequestHandler):
+    """
+    Answers every POST with a fixed chat completion after sleeping LATENCY seconds. JSON-mode
+    requests (text expansion) get an object with a fragment for every section id in the prompt.
+    Streaming requests (layout generation) get `stream_content` in small chunks.
+    """
+
+    stream_content = "<!DOCTYPE html><html><body><p>Fake layout.</p></body></html>"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(LATENCY)
+        # Distinct prompts get distinct refinements, so their images are not cache hits either
+        prompt_digest = hashlib.blake2b(request["messages"][-1]["content"].encode(), digest_size=4).hexdigest()
+        content = f"A refined description of the image ({prompt_digest})."
+        if request.get("response_format", {}).get("type") == "json_object":
+            section_ids = re.findall(r'^\s*"(\d+)":', request["messages"][-1]["content"], re.MULTILINE)
+            content = json.dumps({section_id: f"<p>Section {section_id}.</p>" for section_id in section_ids})
+        if request.get("stream"):
+            self.send_stream(type(self).stream_content)
+            return
+        body = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "fake",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, content, chunk_size=40):
+        # HTTP/1.0 without a Content-Length: the body ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i in range(0, len(content), chunk_size):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "fake",
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": content[i:i + chunk_size]}}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(0.005)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEndpointServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def start_fake_endpoint():
+    server = FakeEndpointServer(("127.0.0.1", 0), FakeChatCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def blocking_refinements(elements):
+    # The pre-async behaviour: a synchronous client call inside each coroutine.
+    from openai import AzureOpenAI
+
+    async def refine(element):
+        client = AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version="2024-06-01"
+        )
+        response = client.chat.completions.create(
+            model=os.getenv("AZURE_OPENAI_CHAT_COMPLETIONS_DEPLOYMENT_NAME"),
+            messages=[{"role": "user", "content": element.description}],
+        )
+        element.refined = response.choices[0].message.content
+
+    await asyncio.gather(*[refine(element) for element in elements])
+
+
+async def main():
+    global LATENCY
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--refinements", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+    LATENCY = args.latency
+
+    server = start_fake_endpoint()
+    os.environ["AZURE_OPENAI_ENDPOINT"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["AZURE_OPENAI_API_KEY"] = "fake-key"
+    os.environ["AZURE_OPENAI_CHAT_COMPLETIONS_DEPLOYMENT_NAME"] = "fake-deployment"
+    os.environ.setdefault("REPLICATE_API_TOKEN", "fake-token")
+    # The fake endpoint has no quota, so keep the client-side TPM limit out of the measurement
+    os.environ.setdefault("AZURE_OPENAI_TPM", "10000000")
+    # Start from an empty refinement cache so the first async run really calls the endpoint
+    os.environ["CACHE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+
+    from elements import GraphicElement
+    from imgen import run_multiple_image_refinements
+
+    def make_elements():
+        return [GraphicElement("image", f"Placeholder image {i}") for i in range(args.refinements)]
+
+    start = time.perf_counter()
+    await blocking_refinements(make_elements())
+    blocking_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await run_multiple_image_refinements(make_elements(), "general audience", "flat illustration", "drug awareness", "pamphlet")
+    async_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await run_multiple_image_refinements(make_elements(), "general audience", "flat illustration", "drug awareness", "pamphlet")
+    cached_time = time.perf_counter() - start
+
+    server.shutdown()
+    print(f"{args.refinements} refinements, {LATENCY:.2f}s endpoint latency")
+    print(f"  blocking client: {blocking_time:.2f}s ({blocking_time / LATENCY:.1f}x latency)")
+    print(f"  async client:    {async_time:.2f}s ({async_time / LATENCY:.1f}x latency)")
+    print(f"  repeat (cached): {cached_time:.3f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
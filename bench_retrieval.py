@@ -0,0 +1,92 @@
+# Benchmark: reference-material lookup in the local vector index (retrieval.LocalVectorIndex).
+# Builds indexes of synthetic embeddings of each size in a temporary directory, then reports
+# the time to open one (memory-mapping the files), search latency percentiles by brute force
+# and, where the index has an HNSW graph, through it, with HNSW recall against the exact top k.
+# The query embedding is not part of the lookup time: it is one API call, cached per query.
+#
+#   python bench_retrieval.py --sizes 1000 5000 50000 --dimensions 1536 --queries 200
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from retrieval import Document, LocalVectorIndex, normalize
+
+
+def percentile(values, q):
+    return float(np.percentile(np.asarray(values) * 1000, q))
+
+
+def embeddings(count: int, centers, rng):
+    """
+    Unit vectors scattered around topic centers. Real embeddings cluster like this; uniformly
+    random high-dimensional vectors are all nearly equidistant, which no ANN index handles.
+    """
+    topics = rng.integers(len(centers), size=count)
+    noise = rng.standard_normal((count, centers.shape[1]), dtype=np.float32)
+    return normalize(centers[topics] + 0.8 * normalize(noise))
+
+
+def build(directory: str, size: int, centers, hnsw_threshold: int, rng) -> float:
+    vectors = embeddings(size, centers, rng)
+    documents = [Document(str(row), f"Material {row}", f"Excerpt of past material {row}.") for row in range(size)]
+    start = time.perf_counter()
+    LocalVectorIndex(directory, hnsw_threshold=hnsw_threshold).add(documents, vectors)
+    return time.perf_counter() - start
+
+
+def run(size: int, dimensions: int, queries: int, k: int, hnsw_threshold: int, ef: int, rng):
+    with tempfile.TemporaryDirectory() as directory:
+        centers = normalize(rng.standard_normal((max(size // 100, 1), dimensions), dtype=np.float32))
+        build_seconds = build(directory, size, centers, hnsw_threshold, rng)
+        start = time.perf_counter()
+        index = LocalVectorIndex(directory, hnsw_threshold=hnsw_threshold, ef=ef)
+        open_seconds = time.perf_counter() - start
+        hnsw = index.hnsw
+        query_vectors = embeddings(queries, centers, rng)
+
+        brute, graph, recall = [], [], []
+        for query in query_vectors:
+            index.hnsw = None
+            start = time.perf_counter()
+            exact = index.search(query, k)
+            brute.append(time.perf_counter() - start)
+            if hnsw is None:
+                continue
+            index.hnsw = hnsw
+            start = time.perf_counter()
+            approximate = index.search(query, k)
+            graph.append(time.perf_counter() - start)
+            recall.append(len({d.id for d, _ in exact} & {d.id for d, _ in approximate}) / k)
+        index.hnsw = hnsw
+
+    print(f"{size:>8} x {dimensions}: built in {build_seconds:.2f}s, opened in {open_seconds * 1000:.1f}ms")
+    print(f"{'':>10}brute force  p50 {percentile(brute, 50):6.2f}ms  p99 {percentile(brute, 99):6.2f}ms")
+    if graph:
+        print(
+            f"{'':>10}HNSW (ef {ef})  p50 {percentile(graph, 50):6.2f}ms  p99 {percentile(graph, 99):6.2f}ms  "
+            f"recall@{k} {np.mean(recall):.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 50000])
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--hnsw-threshold", type=int, default=20000)
+    parser.add_argument("--ef", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{os.cpu_count()} CPU(s)")
+    for size in args.sizes:
+        run(size, args.dimensions, args.queries, args.k, args.hnsw_threshold, args.ef, rng)
+
+
+if __name__ == "__main__":
+    main()
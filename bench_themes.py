@@ -0,0 +1,78 @@
+# Benchmark: what shared themes (see themes.py) save on the repo's sample pages
+# (output.html, first_draft.html, updated.html), each of which carries its own copy of the
+# grid CSS the model used to write. For every page it compares the page as generated with
+# the same page written without CSS and themed afterwards:
+#   output tokens  what the model writes, and the time that takes at --decode tokens/second
+#   page bytes     with THEME_DELIVERY=inline and =link
+#   --pages        bytes a browser downloads for that many pages, where a linked theme is
+#                  fetched once and then served from its cache
+# Token counts use tokens.count_tokens.
+#
+#   python bench_themes.py --decode 60 --pages 20
+import argparse
+import re
+import statistics
+import time
+
+PAGES = ("output.html", "first_draft.html", "updated.html")
+DECODE_TOKENS_PER_SECOND = 60.0
+
+_STYLE = re.compile(r"\s*<style>.*?</style>\s*", re.DOTALL | re.IGNORECASE)
+
+
+def structure_only(page: str) -> str:
+    """The page as the model writes it now: the same markup without its <style> block."""
+    return _STYLE.sub("\n", page, count=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--decode", type=float, default=DECODE_TOKENS_PER_SECOND, help="output tokens generated per second")
+    parser.add_argument("--pages", type=int, default=20, help="pages viewed, for the transfer column")
+    parser.add_argument("--format", default="pamphlet")
+    parser.add_argument("--style", default="90's cartoon style")
+    args = parser.parse_args()
+
+    import themes
+    from tokens import count_tokens, load_encoding
+
+    theme = themes.select_theme(args.format, args.style)
+    print(f"Token counts by {'tiktoken' if load_encoding() is not None else 'approximation'}, theme {theme.name} ({len(theme.css)} bytes of CSS)")
+    before_tokens, after_tokens, inline_bytes, link_bytes, before_bytes = [], [], [], [], []
+    for name in PAGES:
+        with open(name) as file:
+            page = file.read()
+        body = structure_only(page)
+        themes.THEME_DELIVERY = "inline"
+        inline = themes.apply_theme(body, theme)
+        themes.THEME_DELIVERY = "link"
+        linked = themes.apply_theme(body, theme)
+        before_tokens.append(count_tokens(page))
+        after_tokens.append(count_tokens(body))
+        before_bytes.append(len(page.encode()))
+        inline_bytes.append(len(inline.encode()))
+        link_bytes.append(len(linked.encode()))
+        print(
+            f"{name:>17}: {before_tokens[-1]:5d} -> {after_tokens[-1]:5d} output tokens "
+            f"({1 - after_tokens[-1] / before_tokens[-1]:4.0%} fewer, {before_tokens[-1] / args.decode:5.1f}s -> {after_tokens[-1] / args.decode:5.1f}s "
+            f"at {args.decode:.0f} tokens/s), {before_bytes[-1]:5d} bytes -> {inline_bytes[-1]:5d} inline / {link_bytes[-1]:5d} linked"
+        )
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        themes.apply_theme(body, theme)
+    applied = (time.perf_counter() - start) / 1000
+    mean_before, mean_link = statistics.mean(before_bytes), statistics.mean(link_bytes)
+    print(
+        f"{'mean':>17}: {statistics.mean(before_tokens):5.0f} -> {statistics.mean(after_tokens):5.0f} output tokens, "
+        f"apply_theme {applied * 1e6:.0f}us per page"
+    )
+    print(
+        f"{args.pages} pages viewed: {mean_before * args.pages / 1024:6.1f} KiB as generated, "
+        f"{statistics.mean(inline_bytes) * args.pages / 1024:6.1f} KiB inline, "
+        f"{(mean_link * args.pages + len(theme.css)) / 1024:6.1f} KiB linked (theme fetched once)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# Benchmark: job throughput with 1, 2 and 4 worker processes (worker.py) against local fakes
+# of Azure OpenAI and the Replicate predictions API, then a resume check: a worker is killed
+# mid-job and a fresh one finishes the job from its checkpoints, and a job re-claimed across
+# Streamlit reruns is still taken over once its lease lapses.
+#
+#   python bench_workers.py --jobs 16 --processes 1 2 4 --concurrency 2
+import argparse
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+import bench_predictions
+import bench_refinements
+from bench_extractors import generated_page
+
+
+def wait_for(store, job_ids, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = [store.get(job_id) for job_id in job_ids]
+        if all(job["status"] in ("done", "failed") for job in jobs):
+            return jobs
+        time.sleep(0.05)
+    raise TimeoutError(f"jobs not finished after {timeout}s")
+
+
+def layout_response(placeholders):
+    """The page the fake chat endpoint streams, in the form LAYOUT_OUTPUT asks the model for."""
+    from htmlgeneratorfunc import LAYOUT_OUTPUT
+
+    page = f"<title>Bench page</title><h1>Bench page</h1>{generated_page(placeholders)}"
+    if LAYOUT_OUTPUT != "json":
+        return f"<!DOCTYPE html><html>{page}</html>"
+    from layouts import layout_from_html
+
+    return layout_from_html(page).model_dump_json(exclude_defaults=True)
+
+
+def start_workers(processes, concurrency):
+    from worker import run_process
+
+    # spawn, so every worker imports its settings from the environment set up below
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_process, args=(concurrency,)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def stop_workers(workers, sig=signal.SIGTERM):
+    for worker in workers:
+        os.kill(worker.pid, sig)
+    for worker in workers:
+        worker.join()
+
+
+def submit(store, count, tag):
+    return [
+        store.create({
+            "target_audience": f"audience {tag}-{i}",
+            "stylistic_description": "flat illustration",
+            "content_description": "drug awareness",
+            "format": "pamphlet",
+        })
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=2, help="jobs each worker process runs at once")
+    parser.add_argument("--placeholders", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=0.3, help="fake chat completion latency")
+    parser.add_argument("--runtime", type=float, default=0.5, help="fake image prediction runtime")
+    args = parser.parse_args()
+
+    bench_refinements.LATENCY = args.latency
+    bench_predictions.RTT, bench_predictions.RUNTIME = 0.02, args.runtime
+    bench_refinements.FakeChatCompletionHandler.stream_content = layout_response(args.placeholders)
+    chat = bench_refinements.start_fake_endpoint()
+    predictions = bench_predictions.start_stub_server()
+
+    scratch = tempfile.mkdtemp()
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{chat.server_address[1]}",
+        "AZURE_OPENAI_API_KEY": "fake-key",
+        "AZURE_OPENAI_CHAT_COMPLETIONS_DEPLOYMENT_NAME": "fake-deployment",
+        "REPLICATE_BASE_URL": f"http://127.0.0.1:{predictions.server_address[1]}",
+        "REPLICATE_API_TOKEN": "stub-token",
+        # The fakes have no quota, so keep the client-side limits out of the measurement
+        "AZURE_OPENAI_TPM": "10000000",
+        "CACHE_PATH": os.path.join(scratch, "cache.sqlite3"),
+        "ASSET_DIR": os.path.join(scratch, "assets"),
+        "JOB_BACKEND": "sqlite",
+        "JOB_DB_PATH": os.path.join(scratch, "jobs.sqlite3"),
+        "JOB_POLL_INTERVAL": "0.1",
+        # Short leases so the resume check does not wait a minute for the killed worker's
+        "JOB_LEASE": "3",
+    })
+
+    from jobstore import SQLiteJobStore
+
+    store = SQLiteJobStore(os.environ["JOB_DB_PATH"])
+    print(
+        f"{args.jobs} jobs of {args.placeholders} placeholders, {args.concurrency} jobs per process, "
+        f"{args.latency:.2f}s chat latency, {args.runtime:.2f}s image runtime"
+    )
+    baseline = None
+    for processes in args.processes:
+        workers = start_workers(processes, args.concurrency)
+        # One job per worker slot first, so process start-up and imports stay out of the timing
+        wait_for(store, submit(store, processes * args.concurrency, f"warmup{processes}"), timeout=600)
+        start = time.perf_counter()
+        jobs = wait_for(store, submit(store, args.jobs, f"p{processes}"), timeout=600)
+        elapsed = time.perf_counter() - start
+        stop_workers(workers)
+        failed = sum(job["status"] == "failed" for job in jobs)
+        baseline = baseline or args.jobs / elapsed
+        print(f"  {processes} process(es): {elapsed:6.2f}s, {args.jobs / elapsed:5.2f} jobs/s ({args.jobs / elapsed / baseline:.1f}x), {failed} failed")
+
+    # Resume: kill a worker once half of the page's images are checkpointed, then let another finish it
+    def done_images():
+        return sum(
+            key.startswith("element:") and state["type"] == "image" and state["status"] == "done"
+            for key, state in store.checkpoints(job_id).items()
+        )
+
+    [job_id] = submit(store, 1, "resume")
+    workers = start_workers(1, 1)
+    deadline = time.monotonic() + 600
+    while done_images() < args.placeholders // 4:
+        job = store.get(job_id)
+        if job["status"] in ("done", "failed") or time.monotonic() > deadline:
+            stop_workers(workers, signal.SIGKILL)
+            raise RuntimeError(f"resume job {job['status']} with {done_images()} images done: {job.get('error')}")
+        time.sleep(0.02)
+    stop_workers(workers, signal.SIGKILL)
+    kept = done_images()
+    predictions_before = len(bench_predictions.StubPredictionsHandler.predictions)
+    start = time.perf_counter()
+    workers = start_workers(1, 1)
+    [job] = wait_for(store, [job_id], timeout=600)
+    elapsed = time.perf_counter() - start
+    stop_workers(workers)
+    new_predictions = len(bench_predictions.StubPredictionsHandler.predictions) - predictions_before
+    print(
+        f"  resume after SIGKILL: {job['status']} on attempt {job['attempts']} in {elapsed:.2f}s "
+        f"(including the {os.environ['JOB_LEASE']}s lease), {kept} finished images kept, "
+        f"{new_predictions} new predictions for the other {args.placeholders // 2 - kept}"
+    )
+
+    # Reruns: a Streamlit session re-claims its own job on every rerun and hands it back when a
+    # rerun interrupts it; neither may use up attempts, so a crash after many reruns still resumes
+    [job_id] = submit(store, 1, "reruns")
+    for _ in range(5):
+        assert store.claim("streamlit:bench", lease=0.05, job_id=job_id) is not None
+        assert store.claim("streamlit:bench", lease=0.05, job_id=job_id) is not None
+        store.release(job_id, "streamlit:bench")
+    store.claim("streamlit:bench", lease=0.05, job_id=job_id)
+    time.sleep(0.1)
+    job = store.claim("bench:other", job_id=job_id)
+    if job is None or job["attempts"] != 2:
+        raise RuntimeError(f"job lapsed after reruns was not taken over on attempt 2: {store.get(job_id)}")
+    print(f"  lapse after 5 reruns: taken over on attempt {job['attempts']}")
+    chat.shutdown()
+    predictions.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# Where cached results live. SQLite is the default; set CACHE_BACKEND=redis (and REDIS_URL)
+# to share one cache between several app processes or machines.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(".cache", "inky.sqlite3"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+def content_key(*parts) -> str:
+    """Hashes everything that determines a result into a stable cache key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SQLiteCache:
+    """
+    A string cache in one SQLite table, shared by every namespace.
+
+    Entries expire after `ttl` seconds (None keeps them until evicted) and each namespace is
+    capped at `max_entries`, evicting the least recently used entries beyond that.
+    """
+
+    def __init__(self, namespace: str, path: str = CACHE_PATH, ttl: Optional[float] = None, max_entries: int = 10000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )"""
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, last_access)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE cache SET last_access = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key)
+            )
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items: Dict[str, str], ttl: Optional[float] = None) -> None:
+        """Stores several entries in one transaction, with one expiry and eviction sweep."""
+        now = time.time()
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = now + ttl if ttl is not None else None
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    [(self.namespace, key, value, expires_at, now) for key, value in items.items()]
+                )
+                self.connection.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+                    (self.namespace, now)
+                )
+                self.connection.execute(
+                    """DELETE FROM cache WHERE namespace = ? AND key IN (
+                        SELECT key FROM cache WHERE namespace = ? ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                    )""",
+                    (self.namespace, self.namespace, self.max_entries)
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+class RedisCache:
+    """
+    Same interface as SQLiteCache on top of Redis. TTLs map to key expiry; LRU order is kept
+    in a per-namespace sorted set of access times so the entry cap works the same way.
+    """
+
+    def __init__(self, namespace: str, url: str = REDIS_URL, ttl: Optional[float] = None, max_entries: int = 10000):
+        try:
+            import redis
+        except ImportError as exc:
+            raise ImportError("CACHE_BACKEND=redis needs the redis package: pip install redis") from exc
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.client = redis.Redis.from_url(url)
+        self.lru_key = f"inky:{namespace}:lru"
+
+    def _key(self, key: str) -> str:
+        return f"inky:{self.namespace}:{key}"
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.client.zadd(self.lru_key, {key: time.time()})
+        self.hits += 1
+        return value.decode()
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items: Dict[str, str], ttl: Optional[float] = None) -> None:
+        ttl = ttl if ttl is not None else self.ttl
+        now = time.time()
+        pipeline = self.client.pipeline()
+        for key, value in items.items():
+            if ttl is not None:
+                pipeline.set(self._key(key), value, px=int(ttl * 1000))
+            else:
+                pipeline.set(self._key(key), value)
+        pipeline.zadd(self.lru_key, {key: now for key in items})
+        pipeline.execute()
+        overflow = self.client.zcard(self.lru_key) - self.max_entries
+        if overflow > 0:
+            evicted = [member.decode() for member, _ in self.client.zpopmin(self.lru_key, overflow)]
+            self.client.delete(*[self._key(member) for member in evicted])
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self._key(key))
+        self.client.zrem(self.lru_key, key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+class TieredCache:
+    """
+    An in-process LRU tier, bounded by `memory_budget` bytes of cached values, in front of a
+    persistent tier (SQLite or Redis). Memory hits skip serialisation and disk entirely;
+    disk hits are promoted back into memory.
+    """
+
+    def __init__(self, disk_tier, memory_budget: int):
+        self.disk_tier = disk_tier
+        self.memory_budget = memory_budget
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.memory_hits = 0
+        self.lock = threading.Lock()
+
+    def _forget(self, key: str) -> None:
+        value, _ = self.memory.pop(key)
+        self.memory_size -= len(value.encode())
+
+    def _remember(self, key: str, value: str, ttl: Optional[float]) -> None:
+        size = len(value.encode())
+        if size > self.memory_budget:
+            # Too big to keep in memory, but an older value must not keep shadowing it
+            with self.lock:
+                if key in self.memory:
+                    self._forget(key)
+            return
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            if key in self.memory:
+                self._forget(key)
+            self.memory[key] = (value, expires_at)
+            self.memory_size += size
+            while self.memory_size > self.memory_budget:
+                self._forget(next(iter(self.memory)))
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                self._forget(key)
+        value = self.disk_tier.get(key)
+        if value is not None:
+            # The remaining disk lifetime is unknown here, so promote with the default TTL
+            self._remember(key, value, self.disk_tier.ttl)
+        return value
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self._remember(key, value, ttl if ttl is not None else self.disk_tier.ttl)
+        self.disk_tier.set(key, value, ttl)
+
+    def set_many(self, items: Dict[str, str], ttl: Optional[float] = None) -> None:
+        for key, value in items.items():
+            self._remember(key, value, ttl if ttl is not None else self.disk_tier.ttl)
+        self.disk_tier.set_many(items, ttl)
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            if key in self.memory:
+                self._forget(key)
+        self.disk_tier.delete(key)
+
+    def stats(self) -> dict:
+        disk_stats = self.disk_tier.stats()
+        # A memory hit never reaches the disk tier, so it counts as a hit overall
+        hits = self.memory_hits + disk_stats["hits"]
+        total = hits + disk_stats["misses"]
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": disk_stats["hits"],
+            "misses": disk_stats["misses"],
+            "hit_rate": hits / total if total else 0.0,
+            "memory_bytes": self.memory_size,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(namespace: str, ttl: Optional[float] = None, max_entries: int = 10000, memory_budget: Optional[int] = None):
+    """
+    Returns the process-wide cache for `namespace`, created on first use. With a
+    `memory_budget` (in bytes) the persistent cache gets an in-process LRU tier in front.
+    """
+    with _caches_lock:
+        if namespace not in _caches:
+            backend = RedisCache if CACHE_BACKEND == "redis" else SQLiteCache
+            cache = backend(namespace, ttl=ttl, max_entries=max_entries)
+            if memory_budget:
+                cache = TieredCache(cache, memory_budget)
+            _caches[namespace] = cache
+        return _caches[namespace]
@@ -0,0 +1,131 @@
+import hashlib
+from enum import Enum
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class ElementStatus(str, Enum):
+    PENDING = "pending"
+    REFINING = "refining"
+    GENERATING = "generating"
+    DONE = "done"
+    FAILED = "failed"
+
+
+def parse_dimensions(dimensions) -> Optional[Tuple[int, int]]:
+    """Turns "600x400" into (600, 400); passes tuples through and anything else as None."""
+    if isinstance(dimensions, tuple):
+        return dimensions
+    if not dimensions:
+        return None
+    try:
+        width, height = dimensions.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        return None
+
+
+def element_id(element_type: str, description: str, dimensions: Optional[Tuple[int, int]] = None, occurrence: int = 0) -> str:
+    """
+    A short id derived from what the element is, so the same placeholder gets the same id
+    every time its page is parsed. `occurrence` tells apart repeats of an identical
+    placeholder within one page.
+    """
+    size = "x".join(map(str, dimensions)) if dimensions else ""
+    key = f"{element_type}\0{size}\0{description}\0{occurrence}"
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+class GraphicElement:
+    """
+    An image or text placeholder of a generated page and what has been produced for it.
+    Uses __slots__ since a page holds many of these and many pages can be in flight.
+    """
+
+    __slots__ = ("id", "type", "description", "dimensions", "refined", "content", "variants", "status", "placeholder", "variation")
+
+    def __init__(self, element_type, description, refined = None, content = None, dimensions = None, placeholder: Optional[int] = None, occurrence: int = 0):
+        self.type = element_type
+        self.description = description
+        self.dimensions = parse_dimensions(dimensions)
+        self.id = element_id(element_type, description, self.dimensions, occurrence)
+        self.refined = refined
+        self.content = content
+        # Slot-sized image encodings, {content_type: [(url, pixel_width), ...]}
+        self.variants = {}
+        self.status = ElementStatus.DONE if content else ElementStatus.PENDING
+        # Position of the element's placeholder in its page's PlaceholderIndex, if known
+        self.placeholder = placeholder
+        # Bumped each time the user asks for this element again. Part of the refinement, text
+        # and image cache keys (and the image seed), so a regeneration yields something new
+        # while every earlier variation stays cached.
+        self.variation = 0
+
+    def __repr__(self):
+        return f"GraphicElement(id={self.id!r}, type={self.type!r}, status={self.status.value!r}, description={self.description[:40]!r})"
+
+
+def element_state(element: GraphicElement) -> dict:
+    """What has been produced for an element so far, as JSON-ready data for checkpoints."""
+    return {
+        "type": element.type,
+        "description": element.description,
+        "refined": element.refined,
+        "content": element.content,
+        "variants": element.variants,
+        "status": element.status.value,
+        "variation": element.variation,
+    }
+
+
+def restore_element(element: GraphicElement, state: Optional[dict]) -> GraphicElement:
+    """Puts a checkpointed element_state back onto a freshly parsed element with the same id."""
+    if state:
+        element.refined = state.get("refined")
+        element.content = state.get("content")
+        element.variants = state.get("variants") or {}
+        element.status = ElementStatus(state.get("status", ElementStatus.PENDING.value))
+        element.variation = state.get("variation", 0)
+    return element
+
+
+class ElementTable:
+    """The elements of one page keyed by id, in document order."""
+
+    def __init__(self):
+        self.elements: Dict[str, GraphicElement] = {}
+        self.occurrences: Dict[Tuple[str, Optional[Tuple[int, int]], str], int] = {}
+
+    def add(self, element_type: str, description: str, dimensions = None, placeholder: Optional[int] = None) -> GraphicElement:
+        """Creates the page's next element, numbering repeats of identical placeholders."""
+        dimensions = parse_dimensions(dimensions)
+        key = (element_type, dimensions, description)
+        occurrence = self.occurrences.get(key, 0)
+        self.occurrences[key] = occurrence + 1
+        element = GraphicElement(element_type, description, dimensions=dimensions, placeholder=placeholder, occurrence=occurrence)
+        self.elements[element.id] = element
+        return element
+
+    def add_placeholder(self, placeholder) -> GraphicElement:
+        """add() for an extractors.Placeholder."""
+        return self.add(placeholder.kind, placeholder.description, placeholder.dimensions, placeholder.id)
+
+    def __getitem__(self, element_id: str) -> GraphicElement:
+        return self.elements[element_id]
+
+    def get(self, element_id: str) -> Optional[GraphicElement]:
+        return self.elements.get(element_id)
+
+    def __contains__(self, element_id: str) -> bool:
+        return element_id in self.elements
+
+    def __iter__(self) -> Iterator[GraphicElement]:
+        return iter(self.elements.values())
+
+    def __len__(self) -> int:
+        return len(self.elements)
+
+    def of_kind(self, element_type: str) -> List[GraphicElement]:
+        return [element for element in self.elements.values() if element.type == element_type]
+
+    def with_status(self, status: ElementStatus) -> List[GraphicElement]:
+        return [element for element in self.elements.values() if element.status == status]
@@ -1,38 +1,129 @@
 import re  
 import json  
+import html
 from typing import * 
-from uuid import uuid4  
-
-class GraphicElement:  
-    def __init__(self, element_type, description, refined = None, content = None):  
-        self.id = str(uuid4())  
-        self.type = element_type
-        self.description = description  
-        self.content = content
-        self.refined = refined
-  
+from elements import ElementTable, GraphicElement
+
+# One alternation for both kinds of placeholder, so a page is tokenized in a single scan.
+# An image placeholder additionally needs the <div class="image-placeholder"> opening before
+# its [Image: ...] marker; that is looked up backwards from the marker rather than with a
+# lazy [\s\S]*? run from every <div> in the page.
+PLACEHOLDER_PATTERN = re.compile(r'\[Image: (\d+x\d+) - (.*?)\]\s*</div>|\[DESCRIPTION:\s*"(.*?)"\]')
+IMAGE_PLACEHOLDER_OPENING = '<div class="image-placeholder">'
+
+
+class Placeholder(NamedTuple):
+    id: int  # position among the page's placeholders, in document order
+    kind: str  # "image" or "text"
+    start: int
+    end: int
+    dimensions: Optional[str]  # "WxH" for images
+    description: str
+
+
+def iter_placeholders(html_content: str, pos: int = 0, endpos: Optional[int] = None, first_id: int = 0) -> Iterator[Placeholder]:
+    """
+    Yields the placeholders in html_content[pos:endpos] in document order. Spans are offsets
+    into html_content; an image span covers its whole placeholder <div>.
+    """
+    if endpos is None:
+        endpos = len(html_content)
+    placeholder_id = first_id
+    previous_end = pos
+    for match in PLACEHOLDER_PATTERN.finditer(html_content, pos, endpos):
+        if match.group(3) is not None:
+            yield Placeholder(placeholder_id, "text", match.start(), match.end(), None, match.group(3))
+        else:
+            start = html_content.rfind(IMAGE_PLACEHOLDER_OPENING, previous_end, match.start())
+            if start == -1:
+                continue
+            yield Placeholder(placeholder_id, "image", start, match.end(), match.group(1), match.group(2))
+        placeholder_id += 1
+        previous_end = match.end()
+
+
+class PlaceholderIndex:
+    """
+    Every placeholder of a page, found in one pass. render() splices new content in by
+    offset, also in one pass, so filling a page is linear in its size however many
+    placeholders it has, and placeholders sharing a description are still told apart by id.
+    """
+
+    def __init__(self, html_content: str):
+        self.html = html_content
+        self.placeholders = list(iter_placeholders(html_content))
+
+    def __len__(self):
+        return len(self.placeholders)
+
+    def table(self) -> ElementTable:
+        """A fresh element for every placeholder, keyed by its content-derived id."""
+        table = ElementTable()
+        for placeholder in self.placeholders:
+            table.add_placeholder(placeholder)
+        return table
+
+    def elements(self, kind: Optional[str] = None) -> List[GraphicElement]:
+        table = self.table()
+        return table.of_kind(kind) if kind else list(table)
+
+    def render(self, contents: Dict[int, str]) -> str:
+        """Returns the page with the placeholders whose ids are in `contents` replaced."""
+        parts = []
+        position = 0
+        for placeholder in self.placeholders:
+            replacement = contents.get(placeholder.id)
+            if replacement is None:
+                continue
+            parts.append(self.html[position:placeholder.start])
+            parts.append(replacement)
+            position = placeholder.end
+        parts.append(self.html[position:])
+        return "".join(parts)
+
+    def fill(self, elements: Iterable[GraphicElement]) -> str:
+        """Renders every element that has content into the placeholder it came from."""
+        contents = {}
+        for element in elements:
+            if element.placeholder is not None:
+                replacement = render_element(element)
+                if replacement is not None:
+                    contents[element.placeholder] = replacement
+        return self.render(contents)
+
+
+def render_element(element: GraphicElement) -> Optional[str]:
+    """The HTML that replaces an element's placeholder, or None if it has no content yet."""
+    if not element.content:
+        return None
+    if element.type == "text":
+        return element.content
+    # Replicate returns either a list of output URLs or a single URL
+    image_url = element.content[0] if isinstance(element.content, list) else element.content
+    image_url = image_url.strip("'")
+    alt = html.escape(element.description)
+    if not element.variants or not element.dimensions:
+        return f'<img src="{image_url}" alt="{alt}">'
+
+    # Slot-sized encodings: the browser takes the first format it supports and picks the
+    # density from srcset; the last format's 1x copy is the plain <img> fallback
+    width, height = element.dimensions
+    sizes = f"(max-width: {width}px) 100vw, {width}px"
+    sources = []
+    for content_type, variants in element.variants.items():
+        srcset = ", ".join(f"{url} {pixel_width}w" for url, pixel_width in variants)
+        sources.append(f'<source type="{content_type}" srcset="{srcset}" sizes="{sizes}">')
+    fallback_url = list(element.variants.values())[-1][0][0]
+    return (
+        f'<picture>{"".join(sources)}'
+        f'<img src="{fallback_url}" width="{width}" height="{height}" alt="{alt}" loading="lazy" decoding="async">'
+        f'</picture>'
+    )
+
 
 def extract_image_descriptions(html_content) -> List[GraphicElement]:
     """Extracts image descriptions. The expected format is [Image: dimensions - description]."""
-    
-    # Define a pattern to match the image placeholders  
-    pattern = re.compile(r'<div class="image-placeholder">[\s\S]*?\[Image: (\d+x\d+) - (.*?)\]\s*</div>')  
-      
-    # Find all matches in the HTML content  
-    matches = pattern.findall(html_content)  
-      
-    # Create a dictionary to store the results  
-     # Create a list to store the results  
-    image_elements = []  
-      
-    for _, description in matches:  
-        image_element = GraphicElement(  
-            element_type="image",  
-            description=description,  
-        )  
-        image_elements.append(image_element)  
-      
-    return image_elements  
+    return PlaceholderIndex(html_content).elements("image")
 
 def extract_text_descriptions(html_content) -> List[GraphicElement]:  
     """  
@@ -44,23 +135,21 @@ def extract_text_descriptions(html_content) -> List[GraphicElement]:
     Returns:  
         List[GraphicElement]: A list of GraphicElement instances representing text descriptions.  
     """  
-    # Define a pattern to match the text placeholders  
-    pattern = re.compile(r'\[DESCRIPTION:\s*"(.*?)"\]') 
-      
-    # Find all matches in the HTML content  
-    matches = pattern.findall(html_content)  
-      
-    # Create a list to store the results  
-    text_elements = []  
-      
-    for description in matches:  
-        text_element = GraphicElement(  
-            element_type="text",  
-            description=description  
-        )  
-        text_elements.append(text_element)  
-      
-    return text_elements
+    return PlaceholderIndex(html_content).elements("text")
+
+def replace_descriptions(html_content: str, elements: List[GraphicElement], kind: str) -> str:
+    """Fills every `kind` placeholder whose description matches an element with content."""
+    by_description = {}
+    for element in elements:
+        if element.content:
+            by_description.setdefault(element.description, element)
+    index = PlaceholderIndex(html_content)
+    contents = {}
+    for placeholder in index.placeholders:
+        element = by_description.get(placeholder.description)
+        if placeholder.kind == kind and element is not None:
+            contents[placeholder.id] = render_element(element)
+    return index.render(contents)
 
 def replace_text_descriptions(html_content: str, text_elements: List[GraphicElement]) -> str:  
     """  
@@ -73,21 +162,7 @@ def replace_text_descriptions(html_content: str, text_elements: List[GraphicElem
     Returns:  
         str: The modified HTML content with replaced text descriptions.  
     """  
-    # Define a pattern to match the original text descriptions  
-    pattern = re.compile(r'\[DESCRIPTION:\s*"(.*?)"\]')  
-  
-    # Function to replace each match with the corresponding expanded description  
-    def replacer(match):  
-        original_description = match.group(1)  
-        for element in text_elements:  
-            if element.description == original_description:  
-                return element.content
-        return match.group(0)  # Return the original if no match is found  
-  
-    # Replace all occurrences in the HTML content  
-    modified_html = pattern.sub(replacer, html_content)  
-      
-    return modified_html
+    return replace_descriptions(html_content, text_elements, "text")
 
 def replace_image_descriptions(html_content: str, image_elements: List[GraphicElement]) -> str:  
     """  
@@ -100,20 +175,4 @@ def replace_image_descriptions(html_content: str, image_elements: List[GraphicEl
     Returns:  
         str: The modified HTML content with replaced image descriptions.  
     """  
-    # Define a pattern to match the original image descriptions  
-    pattern = re.compile(r'<div class="image-placeholder">[\s\S]*?\[Image: (\d+x\d+) - (.*?)\]\s*</div>')  
-  
-    # Function to replace each match with the corresponding content link  
-    def replacer(match):  
-        _, original_description = match.groups()  
-        for element in image_elements:  
-            if element.description == original_description:   
-                
-                return f'<img src="{element.content[0].strip("'")}" alt="{original_description}">'   
-        return match.group(0)  # Return the original if no match is found  
-  
-    # Replace all occurrences in the HTML content  
-    modified_html = pattern.sub(replacer, html_content)  
-      
-    return modified_html  
-    
+    return replace_descriptions(html_content, image_elements, "image")
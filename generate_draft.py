@@ -0,0 +1,44 @@
+# Command line for htmlgenerator.py: generates a layout draft (or, with --full, the finished
+# page with its images and text) and writes it to a file.
+#
+#   python generate_draft.py --audience "parents" --format pamphlet --output first_draft.html
+import argparse
+import asyncio
+
+import htmlgenerator
+
+
+async def generate(args) -> str:
+    from utils import aclose_async_services
+
+    try:
+        if args.full:
+            from main import generate_page
+
+            return await generate_page(args.audience, args.style, args.content, args.format, regenerate=args.regenerate)
+        return await htmlgenerator.generate_html_content(args.audience, args.style, args.content, args.format)
+    finally:
+        await aclose_async_services()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a preventive drug education page draft.")
+    parser.add_argument("--audience", default=htmlgenerator.TARGET_AUDIENCE)
+    parser.add_argument("--style", default=htmlgenerator.STYLISTIC_DESCRIPTION)
+    parser.add_argument("--content", default=htmlgenerator.CONTENT_DESCRIPTION)
+    parser.add_argument("--format", default=htmlgenerator.FORMAT)
+    parser.add_argument("--output", default="first_draft.html")
+    parser.add_argument("--full", action="store_true", help="also generate the images and text, not just the layout")
+    parser.add_argument("--regenerate", action="store_true", help="with --full, ignore the page cache")
+    args = parser.parse_args()
+
+    output = asyncio.run(generate(args))
+    if output is None:
+        raise SystemExit("The model response did not contain an HTML document")
+    with open(args.output, "w") as file:
+        file.write(output)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
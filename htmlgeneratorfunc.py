@@ -2,9 +2,54 @@
 from dotenv import load_dotenv
 load_dotenv()
 import asyncio
+import json
+import logging
+import os
 # Standard library imports
 import re
-from utils import create_openai_completion
+from functools import lru_cache
+from typing import List, Optional, Sequence
+from utils import CHAT_COMPLETION_MAX_TOKENS, create_openai_completion, stream_openai_completion
+from extractors import iter_placeholders
+from retrieval import RETRIEVAL_CONTEXT_CHARS, Document, find_reference_materials, format_references
+from themes import THEME_CLASSES, apply_theme, select_theme
+from tokens import count_tokens
+
+# LAYOUT_OUTPUT=json (the default) has the model answer with the layout as a JSON tree,
+# which is validated, repaired where it is broken and rendered to HTML locally (see
+# layouts.py, imported on first use since it loads pydantic); =html has it write the HTML
+# page itself
+LAYOUT_OUTPUT = os.getenv("LAYOUT_OUTPUT", "json")
+# Layouts in JSON mode: the API version the clients use has JSON mode but not json_schema
+# structured outputs, so the shape is given in the prompt and checked by layouts.py
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+# Characters of an unusable response sent back for repair
+LAYOUT_REPAIR_MAX_CHARS = int(os.getenv("LAYOUT_REPAIR_MAX_CHARS", 12000))
+
+# The layout prompt puts the instructions and an example page first and the request last.
+# That first part is the same for every request, so Azure OpenAI serves it from its prompt
+# cache once it is 1,024 tokens or longer. LAYOUT_PROMPT_EXAMPLE=compact (the default)
+# shows a short skeleton of the layout vocabulary; =full shows the complete example page,
+# about 600 tokens more in HTML (450 in JSON), which makes the shared part long enough to be
+# cached with LAYOUT_OUTPUT=html. JSON prompts stay under that length either way.
+LAYOUT_PROMPT_EXAMPLE = os.getenv("LAYOUT_PROMPT_EXAMPLE", "compact")
+# Prompts longer than this lose reference materials, then the full example, until they fit
+LAYOUT_PROMPT_MAX_TOKENS = int(os.getenv("LAYOUT_PROMPT_MAX_TOKENS", 3000))
+# Completion caps by format, matched as keywords in the FORMAT text. Azure reserves TPM quota
+# for the whole cap, so a smaller cap lets more layouts run in the same minute. A typical
+# full page is about 950 tokens of HTML now that its CSS comes from themes.py rather than
+# the model, and a JSON layout about 30% less again (see layout_max_tokens). LAYOUT_MAX_TOKENS,
+# if set, applies to every format.
+LAYOUT_MAX_TOKENS_BY_FORMAT = (
+    ("poster", 1280), ("flyer", 1280), ("infographic", 1792), ("pamphlet", 2048), ("brochure", 2048),
+    ("newsletter", 3072), ("website", 3072), ("web page", 3072), ("webpage", 3072),
+)
+LAYOUT_MAX_TOKENS_DEFAULT = int(os.getenv("LAYOUT_MAX_TOKENS_DEFAULT", 2048))
+LAYOUT_MAX_TOKENS = int(os.getenv("LAYOUT_MAX_TOKENS", 0))
+
+# Bump whenever the layout prompt below changes, so cached pages built from the old prompt
+# are not served for new requests; the output format and example in use are part of it too
+PROMPT_VERSION = f"5-{LAYOUT_OUTPUT}-{LAYOUT_PROMPT_EXAMPLE}"
 def extract_html_content(text):
     # Compile the regular expression pattern
     pattern = re.compile(r'<!DOCTYPE html>(.*?)</html>', re.DOTALL | re.IGNORECASE)
@@ -19,212 +64,453 @@ def extract_html_content(text):
         return None
 
 
-async def generate_html_content(target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
-    
-    user_response_wrapper_prompt = f"""
-    Your task is to create Preventive Drug Education material for the Central Narcotics Bureau, the lead agency for preventive drug education in Singapore, dedicated to warning people on the dangers of drugs. 
-
-    Following the following guidelines:
-    TARGET AUDIENCE: {target_audience}
-    STYLISTIC DESCRIPTION: {stylistic_description}
-    CONTENT DESCRIPTION: {content_description}
-    FORMAT: {format}
-    Create what is specified using html with ONLY text and visuals, with a modern and sleek look.
-
-    Do not include things like
-        <li><a href="#">Home</a></li>  
-        <li><a href="#">About</a></li>  
-        <li><a href="#">Contact</a></li>  
-    as it is supposed to look like a static page. 
-
-
-    1. for the text content, it is sufficient to write [DESCRIPTION: ""],  with a short description text describing what is the content supposed to be. e.g: [DESCRIPTION: A brief introduction to the dangers of drug abuse]
-
-    2. For any images, specify the dimension, then replace the image link with a detailed description of a single image suitable for prompting an image model, like this: <div class="IMAGE_PLACEHOLDER"> [Image: 600x400] - A supportive scene showing a counselor or support group helping young adults. The image should convey a sense of hope and community, with warm, welcoming colors and expressions.] </div> 
-    the image descriptions should all follow a similar theme and be similar to stock image descriptions or visual elements for icons. Do not describe textual elements. 
-    Include this help hotline at the end: CNB Hotline (24-hours): 1800 325 6666 and a QR code image link bottom.
-
-    3. For html layouts other than posters, you MUST ensure that the width of the images is set to to 100 percent nd the height to auto so that they can adapt to the size of their containers. Do not just arrange elements in a boring, linear manner. 
-
-    EXAMPLE OUTPUT :
-
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Family Drug Awareness - Central Narcotics Bureau</title>
-        <style>  
-            body {{ 
-                font-family: 'Arial', sans-serif;  
-                margin: 0;  
-                padding: 0;  
-                background-color: #f0f4f8;  
-                color: #333;  
-            }}
-            .container {{
-                max-width: 1200px;  
-                margin: 0 auto;  
-                padding: 20px;  
-                display: grid;  
-                grid-template-columns: repeat(4, 1fr);  
-                grid-gap: 20px;  
-            }}
-            .header {{ 
-                grid-column: 1 / -1;  
-                background-color: #2c3e50;  
-                color: white;  
-                padding: 40px;  
-                text-align: center;  
-                border-radius: 10px;  
-            }}  
-            .content-box {{
-                background-color: white;  
-                padding: 20px;  
-                border-radius: 10px;  
-                box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);  
-            }}  
-            .span-2 {{  
-                grid-column: span 2;  
-            }}
-            .span-3 {{
-                grid-column: span 3;  
-            }}
-            .full-width {{ 
-                grid-column: 1 / -1;  
-            }} 
-            .content-box img {{  
-                width: 100%;  
-                height: auto;  
-                border-radius: 5px;  
-            }}
-            .image-placeholder {{  
-                background-color: #e0e0e0;  
-                height: 200px;  
-                display: flex;  
-                justify-content: center;  
-                align-items: center;  
-                margin-bottom: 15px;  
-                border-radius: 5px;  
-                font-style: italic;  
-                text-align: center;  
-                padding: 10px;  
-            }}
-            .footer {{  
-                grid-column: 1 / -1;  
-                background-color: #2c3e50;  
-                color: white;  
-                padding: 20px;  
-                text-align: center;  
-                border-radius: 10px;  
-                display: flex;  
-                justify-content: space-around;  
-                align-items: center;  
-            }} 
-            .qr-placeholder img {{
-                width: 100px; /* Set the desired width */
-                height: 100px; /* Set the desired height */
-                object-fit: cover; /* Ensure the image covers the area without distortion */
-            }}
-    
-            /* Responsive adjustments */  
-        @media (max-width: 768px) {{  
-            .container {{  
-                grid-template-columns: repeat(2, 1fr);  
-            }}  
-            .span-2 {{  
-                grid-column: span 2;  
-            }}  
-            .span-3 {{  
-                grid-column: span 2;  
-            }}  
-        }}  
-        @media (max-width: 480px) {{  
-            .container {{  
-                grid-template-columns: 1fr;  
-            }}  
-            .span-2, .span-3, .full-width {{  
-                grid-column: span 1;  
-            }}  
-        }}   
-        </style> 
-    </head>
-    <body>
-        <div class="container">
-            <header class="header">
-                <h1>Protecting Our Families: Understanding and Preventing Drug Abuse</h1>
-            </header>
-
-            <div class="content-box span-2">
-                <div class="image-placeholder">
-                    [Image: 600x400 - A diverse group of Singaporean families enjoying quality time together in a park setting. The image should depict parents and children of various ages engaged in activities like picnicking, playing games, and talking, conveying a sense of unity and positive family dynamics.]
-                </div>
-            </div>
+LAYOUT_TASK = "Your task is to create Preventive Drug Education material for the Central Narcotics Bureau, the lead agency for preventive drug education in Singapore, dedicated to warning people on the dangers of drugs."
 
-            <div class="content-box span-2">
-                [DESCRIPTION: "An introduction to the importance of family involvement in drug prevention, emphasizing the role of parents in guiding and supporting their children."]
-            </div>
+LAYOUT_INSTRUCTIONS = LAYOUT_TASK + """
 
-            <div class="content-box span-3">
-                [DESCRIPTION: "Overview of current drug trends in Singapore, including information on commonly abused substances and their effects on individuals and families."]
-            </div>
+Create what the REQUEST at the end specifies using html with ONLY text and visuals.
 
-            <div class="content-box">
-                <div class="image-placeholder">
-                    [Image: 300x300 - An infographic-style illustration showing the brain and how different drugs affect its various regions. Use simplified, icon-based visuals to represent different areas of the brain and drug impacts.]
-                </div>
-            </div>
+Do not include things like
+    <li><a href="#">Home</a></li>
+    <li><a href="#">About</a></li>
+    <li><a href="#">Contact</a></li>
+as it is supposed to look like a static page.
 
-            <div class="content-box span-2">
-                [DESCRIPTION: "Guidance on how to talk to children about drugs, including age-appropriate conversation starters and tips for maintaining open communication."]
-            </div>
+1. for the text content, it is sufficient to write [DESCRIPTION: ""],  with a short description text describing what is the content supposed to be. e.g: [DESCRIPTION: "A brief introduction to the dangers of drug abuse"]
+
+2. For any images, specify the dimension, then replace the image link with a detailed description of a single image suitable for prompting an image model, like this: <div class="image-placeholder"> [Image: 600x400 - A supportive scene showing a counselor or support group helping young adults. The image should convey a sense of hope and community, with warm, welcoming colors and expressions.] </div>
+the image descriptions should all follow a similar theme and be similar to stock image descriptions or visual elements for icons. Do not describe textual elements.
+Include this help hotline at the end: CNB Hotline (24-hours): 1800 325 6666 and a QR code image link bottom.
 
-            <div class="content-box span-2">
-                <div class="image-placeholder">
-                    [Image: 600x300 - An image showing positive parent-child interaction. The scene should depict active listening and engaged conversation between parents and children of various ages.]
-                </div>
+3. The page is styled by a shared stylesheet that is added afterwards, so write NO CSS: no <style> block, no style attributes and no <link> tags. The <head> holds only the charset and the title. Lay the <body> out with these classes only:
+{classes}
+Vary the spans and mix images with text so the page does not read as a boring, linear list.
+""".format(classes="\n".join(f"    {name}: {use}" for name, use in THEME_CLASSES.items()))
+
+# The complete example page (about 800 tokens)
+FULL_EXAMPLE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>Family Drug Awareness - Central Narcotics Bureau</title>
+</head>
+<body>
+    <div class="container">
+        <header class="header">
+            <h1>Protecting Our Families: Understanding and Preventing Drug Abuse</h1>
+        </header>
+
+        <div class="content-box span-2">
+            <div class="image-placeholder">
+                [Image: 600x400 - A diverse group of Singaporean families enjoying quality time together in a park setting. The image should depict parents and children of various ages engaged in activities like picnicking, playing games, and talking, conveying a sense of unity and positive family dynamics.]
             </div>
+        </div>
+
+        <div class="content-box span-2">
+            [DESCRIPTION: "An introduction to the importance of family involvement in drug prevention, emphasizing the role of parents in guiding and supporting their children."]
+        </div>
+
+        <div class="content-box span-3">
+            [DESCRIPTION: "Overview of current drug trends in Singapore, including information on commonly abused substances and their effects on individuals and families."]
+        </div>
 
-            <div class="content-box full-width">
-                [DESCRIPTION: "Signs and symptoms of drug use that parents should be aware of, including behavioral, physical, and social indicators."]
+        <div class="content-box">
+            <div class="image-placeholder">
+                [Image: 300x300 - An infographic-style illustration showing the brain and how different drugs affect its various regions. Use simplified, icon-based visuals to represent different areas of the brain and drug impacts.]
             </div>
+        </div>
+
+        <div class="content-box span-2">
+            [DESCRIPTION: "Guidance on how to talk to children about drugs, including age-appropriate conversation starters and tips for maintaining open communication."]
+        </div>
 
-            <div class="content-box span-2">
-                <div class="image-placeholder">
-                    [Image: 600x400 - A warm, inviting home environment with subtle visual cues representing a drug-free lifestyle. Include elements like family photos, healthy snacks, sports equipment, and educational materials to suggest a supportive family atmosphere.]
-                </div>
+        <div class="content-box span-2">
+            <div class="image-placeholder">
+                [Image: 600x300 - An image showing positive parent-child interaction. The scene should depict active listening and engaged conversation between parents and children of various ages.]
             </div>
+        </div>
+
+        <div class="content-box full-width highlight">
+            [DESCRIPTION: "Signs and symptoms of drug use that parents should be aware of, including behavioral, physical, and social indicators."]
+        </div>
 
-            <div class="content-box span-2">
-                [DESCRIPTION: "Strategies for creating a supportive home environment that discourages drug use, including establishing clear rules, promoting healthy activities, and strengthening family bonds."]
+        <div class="content-box span-2">
+            <div class="image-placeholder">
+                [Image: 600x400 - A warm, inviting home environment with subtle visual cues representing a drug-free lifestyle. Include elements like family photos, healthy snacks, sports equipment, and educational materials to suggest a supportive family atmosphere.]
             </div>
+        </div>
+
+        <div class="content-box span-2">
+            [DESCRIPTION: "Strategies for creating a supportive home environment that discourages drug use, including establishing clear rules, promoting healthy activities, and strengthening family bonds."]
+        </div>
+
+        <div class="content-box span-3">
+            [DESCRIPTION: "Information on Singapore's drug laws and policies, emphasizing the legal consequences of drug offenses and the importance of prevention."]
+        </div>
 
-            <div class="content-box span-3">
-                [DESCRIPTION: "Information on Singapore's drug laws and policies, emphasizing the legal consequences of drug offenses and the importance of prevention."]
+        <div class="content-box">
+            <div class="image-placeholder">
+                [Image: 300x300 - A conceptual illustration representing Singapore's strong stance against drugs. Use symbolic elements like a shield, a family silhouette, and iconic Singapore landmarks to convey protection and national unity in drug prevention.]
             </div>
+        </div>
 
-            <div class="content-box">
-                <div class="image-placeholder">
-                    [Image: 300x300 - A conceptual illustration representing Singapore's strong stance against drugs. Use symbolic elements like a shield, a family silhouette, and iconic Singapore landmarks to convey protection and national unity in drug prevention.]
-                </div>
+        <footer class="footer">
+            <div>
+                <h3>24/7 CNB Hotline</h3>
+                <p>1800 325 6666</p>
+            </div>
+            <div class="qr-placeholder">
+                <a href="https://imgbb.com/"><img src="https://i.ibb.co/6tcJ0tB/qr.png" alt="qr"></a>
             </div>
+        </footer>
+    </div>
+</body>
+</html>"""
 
-            <footer class="footer">
-                <div>
-                    <h3>24/7 CNB Hotline</h3>
-                    <p>1800 325 6666</p>
-                </div>
-                <div class="qr-placeholder">
-                    <a href="https://imgbb.com/"><img src="https://i.ibb.co/6tcJ0tB/qr.png" alt="qr"></a>
-                </div>
-            </footer>
-        </div>
-    </body>
-    </html>
+# The same page reduced to its layout vocabulary (the span classes, both placeholder kinds,
+# the hotline footer) in about a quarter of the tokens
+COMPACT_EXAMPLE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<title>Family Drug Awareness - Central Narcotics Bureau</title>
+</head>
+<body>
+<div class="container">
+<header class="header"><h1>Protecting Our Families</h1></header>
+<div class="content-box span-2">
+<div class="image-placeholder">
+[Image: 600x400 - Singaporean families picnicking together in a park, warm colors, a sense of unity.]
+</div>
+</div>
+<div class="content-box span-2">
+[DESCRIPTION: "Why family involvement matters in drug prevention."]
+</div>
+<div class="content-box full-width highlight">
+[DESCRIPTION: "The one thing parents should remember."]
+</div>
+<footer class="footer">
+<div><h3>24/7 CNB Hotline</h3><p>1800 325 6666</p></div>
+<div class="qr-placeholder"><a href="https://imgbb.com/"><img src="https://i.ibb.co/6tcJ0tB/qr.png" alt="qr"></a></div>
+</footer>
+</div>
+</body>
+</html>"""
+
+EXAMPLES = {"full": FULL_EXAMPLE, "compact": COMPACT_EXAMPLE}
+
+JSON_LAYOUT_INSTRUCTIONS = LAYOUT_TASK + """
+
+Plan what the REQUEST at the end specifies as a static page of ONLY text and visuals, and answer with its layout as one JSON object and nothing else, in this shape:
+{shape}
+
+The sections fill a four-column grid from left to right: "cell" is one column wide, "span-2" and "span-3" two and three columns, "full-width" the whole row. Vary the sizes and mix images with text so the page does not read as a boring, linear list. "highlight": true marks a key message; leave it out otherwise.
+
+1. A text slot's description says what the text is supposed to be, e.g. "A brief introduction to the dangers of drug abuse".
+
+2. An image slot's description is a detailed description of a single image suitable for prompting an image model, e.g. "A supportive scene showing a counselor or support group helping young adults. The image should convey a sense of hope and community, with warm, welcoming colors and expressions.", and its width and height are the pixels it should take up, e.g. 600 and 400.
+The image descriptions should all follow a similar theme and be similar to stock image descriptions or visual elements for icons. Do not describe textual elements.
+
+The title banner and the CNB hotline footer with its QR code are added around the sections, so do not write them as sections.
+"""
+
+@lru_cache(maxsize=None)
+def json_layout_prompt(example: str):
+    """
+    JSON_LAYOUT_INSTRUCTIONS with the layout shape filled in, and the HTML example as a
+    layout written the way the model should write one (no whitespace, no "highlight": false).
+    """
+    from layouts import LAYOUT_SHAPE, layout_from_html
+
+    return JSON_LAYOUT_INSTRUCTIONS.format(shape=LAYOUT_SHAPE), layout_from_html(EXAMPLES[example]).model_dump_json(exclude_defaults=True)
+
+
+def layout_max_tokens(format: str, output: str = LAYOUT_OUTPUT) -> int:
+    """The completion cap for a layout in `format` (see LAYOUT_MAX_TOKENS_BY_FORMAT)."""
+    if LAYOUT_MAX_TOKENS:
+        return LAYOUT_MAX_TOKENS
+    format = format.lower()
+    max_tokens = next((max_tokens for keyword, max_tokens in LAYOUT_MAX_TOKENS_BY_FORMAT if keyword in format), LAYOUT_MAX_TOKENS_DEFAULT)
+    if output == "json":
+        # Three quarters of the HTML cap, in whole 256-token steps; a JSON layout that is cut
+        # off still keeps its complete sections (see layouts.close_json)
+        max_tokens = -(-max_tokens * 3 // 4 // 256) * 256
+    return max_tokens
+
+
+def build_html_prompt(target_audience: str, stylistic_description: str, content_description: str, format: str, references: str = "", example: str = LAYOUT_PROMPT_EXAMPLE, output: str = LAYOUT_OUTPUT) -> str:
+    # Everything up to the example is the same for every request (see LAYOUT_PROMPT_EXAMPLE)
+    instructions, example_output = json_layout_prompt(example) if output == "json" else (LAYOUT_INSTRUCTIONS, EXAMPLES[example])
+    prompt = f"""{instructions}
+EXAMPLE OUTPUT:
+
+{example_output}
+
+REQUEST:
+TARGET AUDIENCE: {target_audience}
+STYLISTIC DESCRIPTION: {stylistic_description}
+CONTENT DESCRIPTION: {content_description}
+FORMAT: {format}
+"""
+    # Past materials found by retrieval.find_reference_materials, if any
+    if references:
+        prompt += f"""
+REFERENCE MATERIALS (excerpts from past education materials relevant to this request; draw on their facts, key messages and tone, but do not copy them):
+{references}
+"""
+    return prompt
+
+def fit_html_prompt(target_audience: str, stylistic_description: str, content_description: str, format: str, documents: Sequence[Document] = ()) -> str:
+    """
+    build_html_prompt within LAYOUT_PROMPT_MAX_TOKENS: shortens the reference materials, then
+    falls back to the compact example, until the prompt fits.
+    """
+    reference_chars = (RETRIEVAL_CONTEXT_CHARS, RETRIEVAL_CONTEXT_CHARS // 4, 0) if documents else (0,)
+    for example in dict.fromkeys((LAYOUT_PROMPT_EXAMPLE, "compact")):
+        for max_chars in reference_chars:
+            prompt = build_html_prompt(target_audience, stylistic_description, content_description, format, format_references(documents, max_chars), example)
+            tokens = count_tokens(prompt)
+            if tokens <= LAYOUT_PROMPT_MAX_TOKENS:
+                return prompt
+    logging.warning("Layout prompt is %d tokens, over LAYOUT_PROMPT_MAX_TOKENS=%d even without reference materials", tokens, LAYOUT_PROMPT_MAX_TOKENS)
+    return prompt
+
+async def build_grounded_html_prompt(target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
+    """The layout prompt with the most relevant past materials from the retrieval index."""
+    documents = await find_reference_materials(target_audience, stylistic_description, content_description, format)
+    return fit_html_prompt(target_audience, stylistic_description, content_description, format, documents)
+
+SECTION_REPAIR_PROMPT = """Some sections of a page layout do not match the section shape:
+{shape}
+
+Correct each of the sections below, keeping its content and changing only what the errors point at. Answer with one JSON object, {{"sections": [...]}}, holding the {count} corrected sections in the same order.
+
+{sections}
+"""
+
+LAYOUT_REPAIR_PROMPT = """The text below was meant to be one JSON object describing a page layout, in this shape:
+{shape}
+
+It could not be used ({error}). Answer with the same layout as a valid JSON object in that shape, keeping its content.
+
+TEXT:
+{text}
+"""
+
+async def repair_layout_sections(broken: Sequence["layouts.BrokenSection"]) -> List[Optional["layouts.Section"]]:
+    """
+    Asks the model to correct just the sections that failed validation, given their errors;
+    None for each section that is still not valid afterwards.
+    """
+    from layouts import SECTION_SHAPE, parse_sections
+
+    sections = "\n".join(f"{number}. {json.dumps(item.data)}\nERRORS: {item.errors}" for number, item in enumerate(broken, 1))
+    prompt = SECTION_REPAIR_PROMPT.format(shape=SECTION_SHAPE, count=len(broken), sections=sections)
+    # The corrected sections are about as long as the broken ones
+    max_tokens = min(CHAT_COMPLETION_MAX_TOKENS, 2 * count_tokens(sections) + 64)
+    try:
+        response = await create_openai_completion(prompt, max_tokens=max_tokens, response_format=JSON_RESPONSE_FORMAT)
+    except Exception as exc:
+        logging.warning("Could not repair %d layout section(s): %r", len(broken), exc)
+        return [None] * len(broken)
+    return parse_sections(response.choices[0].message.content or "", len(broken))
+
+async def repair_layout_response(text: str, error: str, max_tokens: int) -> str:
+    """Asks the model to turn a layout response with no usable JSON in it into one that parses."""
+    from layouts import LAYOUT_SHAPE
+
+    prompt = LAYOUT_REPAIR_PROMPT.format(shape=LAYOUT_SHAPE, error=error, text=text[:LAYOUT_REPAIR_MAX_CHARS])
+    response = await create_openai_completion(prompt, max_tokens=max_tokens, response_format=JSON_RESPONSE_FORMAT)
+    return response.choices[0].message.content or ""
+
+async def finish_layout(text: str, max_tokens: int, repair_whole: bool = True) -> "layouts.PageLayout":
+    """
+    The layout in a JSON layout response. Sections that fail validation go back to the model
+    on their own (see repair_layout_sections) and are dropped if they still fail; a response
+    with no usable layout at all is sent back once whole, unless `repair_whole` is False.
+    Raises layouts.LayoutError when no page can be made of it.
     """
-    response = await create_openai_completion(user_response_wrapper_prompt)
+    from layouts import LayoutError, merge_sections, parse_layout
+
+    try:
+        parsed = parse_layout(text)
+    except LayoutError as exc:
+        if not repair_whole:
+            raise
+        logging.warning("Repairing an unusable layout response: %s", exc)
+        parsed = parse_layout(await repair_layout_response(text, str(exc), max_tokens))
+    if parsed.truncated:
+        logging.warning("The layout response was cut off; keeping the %d complete section(s)", len(parsed.layout.sections))
+    if not parsed.broken:
+        return parsed.layout
+    logging.info("Repairing %d of the layout's sections", len(parsed.broken))
+    return merge_sections(parsed, await repair_layout_sections(parsed.broken))
+
+async def generate_layout_content(target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
+    """generate_html_content for LAYOUT_OUTPUT=json: the layout comes back as JSON and is rendered here."""
+    from layouts import render_layout
+
+    prompt = await build_grounded_html_prompt(target_audience, stylistic_description, content_description, format)
+    max_tokens = layout_max_tokens(format)
+    response = await create_openai_completion(prompt, max_tokens=max_tokens, response_format=JSON_RESPONSE_FORMAT)
+    layout = await finish_layout(response.choices[0].message.content or "", max_tokens)
+    return apply_theme(render_layout(layout), select_theme(format, stylistic_description))
+
+async def generate_html_content(target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
+    if LAYOUT_OUTPUT == "json":
+        return await generate_layout_content(target_audience, stylistic_description, content_description, format)
+    user_response_wrapper_prompt = await build_grounded_html_prompt(target_audience, stylistic_description, content_description, format)
+    max_tokens = layout_max_tokens(format)
+    response = await create_openai_completion(user_response_wrapper_prompt, max_tokens=max_tokens)
     output = extract_html_content(response.choices[0].message.content)
-    return output
+    if output is None and response.choices[0].finish_reason == "length" and max_tokens < CHAT_COMPLETION_MAX_TOKENS:
+        # The layout outgrew its format's budget; one more try with the general cap
+        response = await create_openai_completion(user_response_wrapper_prompt, max_tokens=CHAT_COMPLETION_MAX_TOKENS)
+        output = extract_html_content(response.choices[0].message.content)
+    if output is None:
+        return None
+    return apply_theme(output, select_theme(format, stylistic_description))
+
+class HtmlStreamParser:
+    """
+    Incremental counterpart of extract_html_content for streamed completions.
+
+    feed() takes each new chunk of model text and returns the HTML found so far (None until
+    <!DOCTYPE html> has streamed in) and the placeholders that closed in this chunk, so image
+    and text work can start before the layout is finished. Placeholders come from the same
+    tokenizer as extractors.PlaceholderIndex, with ids and spans matching the final HTML's index.
+    """
+
+    doctype_pattern = re.compile(r'<!DOCTYPE html>', re.IGNORECASE)
+    end_pattern = re.compile(r'</html>', re.IGNORECASE)
+
+    def __init__(self):
+        self.text = ""
+        self.start = None
+        self.end = None
+        self.scanned = 0
+        self.count = 0
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        if self.start is None:
+            # The doctype may be split across chunks, so search a little way back
+            match = self.doctype_pattern.search(self.text, max(0, len(self.text) - len(chunk) - 15))
+            if match is None:
+                return None, []
+            self.start = self.scanned = match.end()
+        if self.end is None:
+            match = self.end_pattern.search(self.text, max(self.start, len(self.text) - len(chunk) - 7))
+            if match:
+                self.end = match.start()
+        limit = self.end if self.end is not None else len(self.text)
+
+        placeholders = []
+        for placeholder in iter_placeholders(self.text, self.scanned, limit, first_id=self.count):
+            placeholders.append(placeholder._replace(start=placeholder.start - self.start, end=placeholder.end - self.start))
+            self.scanned = placeholder.end
+            self.count += 1
+        return self.text[self.start:limit], placeholders
+
+    def html(self):
+        """The final HTML once the stream is done, matching extract_html_content."""
+        if self.start is None or self.end is None:
+            return None
+        return self.text[self.start:self.end]
+
+class LayoutStreamParser:
+    """
+    Incremental counterpart of layouts.parse_layout for streamed JSON layouts, as
+    HtmlStreamParser is for HTML ones: feed() returns the page rendered from the sections
+    streamed so far (None until the heading and a first section are in) and the
+    placeholders of the sections completed in this chunk. Sections after one that fails
+    validation are held back, since repairing it could change them, so the placeholders
+    handed out always have the ids they get in the final page.
+
+    The response is scanned once, by a layouts.JsonCloser, and only parsed again when a
+    chunk completes another section, up to the end of that section.
+    """
+
+    def __init__(self):
+        from layouts import JsonCloser
+
+        self.closer = JsonCloser()
+        self.html = None
+        self.count = 0
+
+    @property
+    def text(self):
+        return self.closer.text
 
+    def feed(self, chunk: str):
+        from layouts import LayoutError, parse_document, render_layout
+
+        # A section ends where an object closes inside the layout's top-level array
+        sections_closed = [point for point in self.closer.feed(chunk) if point[1] == ("}", "]")]
+        if not sections_closed:
+            return self.html, []
+        document, _ = self.closer.document(*sections_closed[-1])
+        try:
+            # Every section in the document is complete, so none is reported as cut off
+            parsed = parse_document(document, truncated=False)
+        except LayoutError:
+            return self.html, []
+        sections = parsed.layout.sections[:parsed.broken[0].position] if parsed.broken else parsed.layout.sections
+        if not sections:
+            return self.html, []
+        self.html = render_layout(parsed.layout.model_copy(update={"sections": sections}))
+        return self.html, self.placeholders(self.html)
+
+    def placeholders(self, html: str):
+        """The placeholders of `html` not handed out yet."""
+        placeholders = list(iter_placeholders(html))[self.count:]
+        self.count += len(placeholders)
+        return placeholders
+
+def themed_page(html: str, placeholders, theme):
+    """The page with the theme applied, and its placeholders moved to match."""
+    themed_html = apply_theme(html, theme)
+    # The stylesheet goes in before the body, so it moves every placeholder alike
+    shift = len(themed_html) - len(html)
+    return themed_html, [placeholder._replace(start=placeholder.start + shift, end=placeholder.end + shift) for placeholder in placeholders]
+
+async def stream_html_content(target_audience: str, stylistic_description: str, content_description: str, format: str):
+    """
+    Streaming version of generate_html_content. Yields (partial_html, new_placeholders) as
+    the layout is generated, where new_placeholders lists the extractors.Placeholder entries
+    completed since the previous yield. The final yield carries the same HTML
+    generate_html_content would have returned, with any placeholders not yielded before.
+    Every yield has the theme applied, so the partial page is drawn with its stylesheet
+    while it streams in. Raises ValueError when an HTML layout ends before </html> (e.g.
+    cut off at max_tokens), or layouts.LayoutError when a JSON layout stops parsing after
+    placeholders were yielded, rather than leaving the partial page as the last yield.
+    """
+    user_response_wrapper_prompt = await build_grounded_html_prompt(target_audience, stylistic_description, content_description, format)
+    theme = select_theme(format, stylistic_description)
+    max_tokens = layout_max_tokens(format)
+    if LAYOUT_OUTPUT == "json":
+        from layouts import render_layout
 
+        layout_parser = LayoutStreamParser()
+        async for chunk in stream_openai_completion(user_response_wrapper_prompt, max_tokens=max_tokens, response_format=JSON_RESPONSE_FORMAT):
+            partial_html, placeholders = layout_parser.feed(chunk)
+            if partial_html is not None:
+                yield themed_page(partial_html, placeholders, theme)
+        # Broken sections are repaired once the whole response is in. A whole new layout would
+        # not keep the placeholders already handed out, so it is only asked for before any were
+        html = render_layout(await finish_layout(layout_parser.text, max_tokens, repair_whole=layout_parser.count == 0))
+        yield themed_page(html, layout_parser.placeholders(html), theme)
+        return
 
+    parser = HtmlStreamParser()
+    async for chunk in stream_openai_completion(user_response_wrapper_prompt, max_tokens=max_tokens):
+        partial_html, placeholders = parser.feed(chunk)
+        if partial_html is not None:
+            yield themed_page(partial_html, placeholders, theme)
+    if parser.html() is None:
+        # Unlike generate_html_content this cannot simply try again with a larger cap: the
+        # partial page's placeholders have already been handed out
+        if parser.start is None:
+            raise ValueError("The model response did not contain an HTML document")
+        raise ValueError(f"The layout ended before </html> (max_tokens={max_tokens}), so the page is incomplete")
+    yield apply_theme(parser.html(), theme), []
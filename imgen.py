@@ -1,56 +1,201 @@
 import asyncio  
-import replicate  
-from uuid import uuid4  
+import json
+import math
+import time
 from typing import List 
 import os
 import re
-from utils import create_openai_completion
+from utils import create_openai_completion, get_async_service
+from prediction_completion import AdaptivePolling
+from scheduler import get_limiter, run_rate_limited
+from resilience import LatencyTracker, RetryableError, hedged, retry_call, with_deadline
+from cache import content_key, get_cache
+from assets import store_prediction_output
 from extractors import extract_image_descriptions
-os.environ["REPLICATE_API_TOKEN"] = os.getenv("REPLICATE_API_TOKEN")
+from elements import ElementStatus, GraphicElement
 
-class GraphicElement:  
-    def __init__(self, element_type, description, refined = None, content = None):  
-        self.id = str(uuid4())  
-        self.type = element_type
-        self.description = description  
-        self.content = content
-        self.refined = refined
+REPLICATE_MODEL = "black-forest-labs/flux-schnell"
+
+# How run_image_prediction waits for a prediction to finish when no strategy is passed in.
+# See prediction_completion.py for the polling and webhook strategies.
+default_completion_strategy = AdaptivePolling()
+
+# Per-attempt deadline and attempts per image. When hedging is on, an attempt still running
+# past the p95 of recent prediction times gets a duplicate, and whichever finishes first wins.
+PREDICTION_TIMEOUT = float(os.getenv("PREDICTION_TIMEOUT", 120))
+PREDICTION_MAX_TRIES = 3
+HEDGE_PREDICTIONS = os.getenv("HEDGE_PREDICTIONS", "1") == "1"
+prediction_latency = LatencyTracker()
+# Refined prompts are reused for identical (prompt, deployment) pairs for this many seconds
+REFINEMENT_CACHE_TTL = float(os.getenv("REFINEMENT_CACHE_TTL", 30 * 24 * 3600))
+
+def image_seed(prompt: str, variation: int = 0) -> int:
+    """
+    A fixed seed per prompt makes outputs reproducible, so stored images can be reused. Each
+    variation (see GraphicElement.variation) of an element gets a seed of its own.
+    """
+    key = content_key(prompt, variation) if variation else content_key(prompt)
+    return int(key[:8], 16) % 2**31
+
+# Aspect ratios flux-schnell accepts; it renders about 1 or 0.25 megapixels (of 1024x1024)
+ASPECT_RATIOS = ["1:1", "16:9", "21:9", "3:2", "2:3", "4:5", "5:4", "3:4", "4:3", "9:16", "9:21"]
+
+def ratio_value(aspect_ratio: str) -> float:
+    width, height = aspect_ratio.split(":")
+    return int(width) / int(height)
+
+def render_size(aspect_ratio: str, megapixels: str):
+    """The (width, height) flux-schnell renders at, in multiples of 16 pixels."""
+    ratio = ratio_value(aspect_ratio)
+    width = math.sqrt(float(megapixels) * 1024 * 1024 * ratio)
+    return int(round(width / 16)) * 16, int(round(width / ratio / 16)) * 16
+
+def prediction_size(dimensions) -> dict:
+    """
+    Maps a placeholder's (width, height) to the closest supported aspect ratio, and to the
+    0.25 MP render whenever that still covers the slot at 1x, which is quicker to generate and
+    to download than the default 1 MP. Missing or degenerate sizes get the model's defaults.
+    """
+    if not dimensions or min(dimensions) <= 0:
+        return {}
+    width, height = dimensions
+    target = math.log(width / height)
+    aspect_ratio = min(ASPECT_RATIOS, key=lambda ratio: abs(math.log(ratio_value(ratio)) - target))
+    render_width, render_height = render_size(aspect_ratio, "0.25")
+    megapixels = "0.25" if render_width >= width and render_height >= height else "1"
+    return {"aspect_ratio": aspect_ratio, "megapixels": megapixels}
+# Keeps fire-and-forget cancel requests alive until they finish
+_background_tasks = set()
+
+class PredictionFailed(RetryableError):
+    def __init__(self, prediction: dict):
+        super().__init__(f"Prediction {prediction['id']} ended with status {prediction['status']}: {prediction.get('error')}")
+        self.prediction = prediction
+
+# Thin async wrappers around the Replicate predictions REST API. All requests go through
+# the shared httpx.AsyncClient, so in-flight predictions never block the event loop.
+async def replicate_request(method: str, url: str, **kwargs) -> dict:
+    client = get_async_service("replicate_client")
+
+    async def send():
+        response = await client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    return await run_rate_limited(get_limiter("replicate"), send)
+
+async def create_prediction(input_data: dict, model: str = REPLICATE_MODEL, **params) -> dict:
+    return await replicate_request("POST", f"/v1/models/{model}/predictions", json={"input": input_data, **params})
+
+async def get_prediction(prediction_id: str) -> dict:
+    return await replicate_request("GET", f"/v1/predictions/{prediction_id}")
+
+async def cancel_prediction(prediction_id: str) -> dict:
+    return await replicate_request("POST", f"/v1/predictions/{prediction_id}/cancel")
+
+def cancel_prediction_in_background(prediction_id: str) -> None:
+    task = asyncio.ensure_future(cancel_prediction(prediction_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def print_prediction_progress(description: str, prediction: dict) -> None:
+    log_output = prediction.get("logs")
+    if log_output:  
+        current_iteration = log_output.count("it [")  
+        total_iterations = 28  # Fixed number of iterations  
+        progress_percentage = (current_iteration / total_iterations) * 100  
+        print(f"Prompt: {description[:60]}... Progress: {progress_percentage:.2f}%")  
+    else:  
+        print(f"Prompt: {description[:60]}... Progress: Not available yet.")  
+
+async def create_and_wait(input_data: dict, strategy, on_update=None) -> dict:
+    prediction = await create_prediction(input_data, **strategy.create_params())
+    try:
+        # Wait for completion with the chosen polling/webhook strategy
+        return await strategy.wait(prediction, get_prediction, on_update=on_update)
+    except asyncio.CancelledError:
+        # Deadline hit or a hedged duplicate won: no point paying for this one
+        cancel_prediction_in_background(prediction["id"])
+        raise
+
+async def predict_image(input_data: dict, strategy, on_update=None, on_start=None) -> dict:
+    """
+    One prediction attempt. Stops the prediction on Replicate if the attempt is abandoned.
+    PREDICTION_TIMEOUT and the recorded latency count from when the attempt gets its
+    concurrency slot, when `on_start` is called, so time spent queued behind other
+    predictions neither times it out nor raises the hedging threshold.
+    """
+    # A concurrency slot is held for the prediction's whole lifetime, since Replicate caps
+    # how many predictions may be running at once, not just how fast they are created
+    async with get_limiter("replicate").concurrency():
+        if on_start is not None:
+            on_start()
+        start = time.monotonic()
+        prediction = await with_deadline(create_and_wait(input_data, strategy, on_update), PREDICTION_TIMEOUT)
+    if prediction["status"] != "succeeded":
+        raise PredictionFailed(prediction)
+    prediction_latency.record(time.monotonic() - start)
+    return prediction
 
 # Asynchronous function to run a prediction from one single prompt and track progress  
-async def run_image_prediction(element: GraphicElement) -> None:
+async def run_image_prediction(element: GraphicElement, strategy=None) -> None:
+    strategy = strategy or default_completion_strategy
     description = element.refined if element.refined else element.description
     input_data = {  
-        "prompt": description  
+        "prompt": description,
+        "seed": image_seed(description, element.variation),
+        **prediction_size(element.dimensions)
     }  
-    prediction = replicate.predictions.create(  
-        model="black-forest-labs/flux-schnell",  
-        input=input_data  
-    )  
-      
-    # Check progress asynchronously  
-    while prediction.status not in ["succeeded", "failed", "canceled"]:  
-        await asyncio.sleep(2)  # Pause for 2 seconds before checking again  
-        prediction = replicate.predictions.get(prediction.id)  
-        log_output = prediction.logs  
-        if log_output:  
-            current_iteration = log_output.count("it [")  
-            total_iterations = 28  # Fixed number of iterations  
-            progress_percentage = (current_iteration / total_iterations) * 100  
-            print(f"Prompt: {description[:60]}... Progress: {progress_percentage:.2f}%")  
-        else:  
-            print(f"Prompt: {description[:60]}... Progress: Not available yet.")  
-      
-    # Handle result  
-    if prediction.status == "succeeded":  
-        print(f"Prompt: {description[:60]}... Prediction completed successfully!")  
-        element.content = prediction.output  
-    else:  
-        print(f"Prompt: {description[:60]}... Prediction failed with status: {prediction.status}")  
-        element.content = "Error generating image"  
+
+    # Same model, prompt and seed means the same image: serve it from the asset store
+    image_cache = get_cache("images")
+    cache_key = content_key(REPLICATE_MODEL, input_data)
+    cached = image_cache.get(cache_key)
+    if cached is not None:
+        cached = json.loads(cached)
+        # Entries written before variants existed hold just the list of URLs
+        if isinstance(cached, list):
+            cached = {"content": cached, "variants": {}}
+        element.content = cached["content"]
+        element.variants = cached["variants"]
+        element.status = ElementStatus.DONE
+        return
+
+    element.status = ElementStatus.GENERATING
+    hedge_after = prediction_latency.percentile(95) if HEDGE_PREDICTIONS else None
+
+    async def hedged_attempt():
+        # The hedge clock starts once the first attempt is running, not while it is queued
+        started = asyncio.Event()
+        def attempt():
+            return predict_image(
+                input_data, strategy, on_update=lambda update: print_prediction_progress(description, update), on_start=started.set
+            )
+        return await hedged(attempt, hedge_after, started=started)
+
+    try:
+        prediction = await retry_call(hedged_attempt, max_tries=PREDICTION_MAX_TRIES)
+    except Exception as exc:
+        # Leave the placeholder in the page rather than failing the whole run
+        print(f"Prompt: {description[:60]}... Prediction failed: {exc!r}")  
+        element.content = None
+        element.status = ElementStatus.FAILED
+        return
+
+    print(f"Prompt: {description[:60]}... Prediction completed successfully!")  
+    element.status = ElementStatus.DONE
+    try:
+        # Replicate output URLs expire, so pages point at our own copy instead
+        element.content, element.variants = await store_prediction_output(prediction["output"], element.dimensions)
+    except Exception as exc:
+        print(f"Prompt: {description[:60]}... Could not store output, using the Replicate URL: {exc!r}")
+        element.content = prediction["output"]
+        return
+    image_cache.set(cache_key, json.dumps({"content": element.content, "variants": element.variants}))
   
 # Function to run multiple predictions asynchronously  
-async def run_multiple_image_predictions(elements: List[GraphicElement]):  
-    tasks = [run_image_prediction(element) for element in elements if element.type == "image"]  
+async def run_multiple_image_predictions(elements: List[GraphicElement], strategy=None):  
+    tasks = [run_image_prediction(element, strategy) for element in elements if element.type == "image"]  
     await asyncio.gather(*tasks)  
     return elements  
 
@@ -74,14 +219,32 @@ async def refine_image_description(element: GraphicElement, target_audience: str
     Return ONLY the expanded description and nothing else. DO NOT include any description of text or textual elements in your expanded description, unless explicity specified. If it is specified, restrict to only one textual element. 
     
 """
-    response = await create_openai_completion(prompt)
+    element.status = ElementStatus.REFINING
+    refinement_cache = get_cache("refinements", ttl=REFINEMENT_CACHE_TTL)
+    cache_parts = [prompt, os.getenv("AZURE_OPENAI_CHAT_COMPLETIONS_DEPLOYMENT_NAME")]
+    if element.variation:
+        cache_parts.append(element.variation)
+    cache_key = content_key(*cache_parts)
+    cached = refinement_cache.get(cache_key)
+    if cached is not None:
+        element.refined = cached
+        return
+
+    try:
+        response = await create_openai_completion(prompt)
+    except Exception as exc:
+        # The unrefined description is still a usable image prompt
+        print(f"Refinement failed for {element.description[:60]}..., using the original description: {exc!r}")
+        return
     element.refined = response.choices[0].message.content
+    refinement_cache.set(cache_key, element.refined)
 
 async def run_multiple_image_refinements(elements: List[GraphicElement], target_audience: str, stylistic_description: str, content_description: str, format: str) -> List[GraphicElement]:  
     """Run multiple refinements for image descriptions asynchronously."""
     print("generating image descriptions...")
     tasks = [refine_image_description(element, target_audience, stylistic_description, content_description, format) for element in elements if element.type == "image"]  
     await asyncio.gather(*tasks)  
+    print(f"refinement cache: {get_cache('refinements').stats()}")
     return elements  
 
 # Example usage
@@ -0,0 +1,318 @@
+# Turns uploaded education materials (PDFs and plain text) into reference materials in the
+# retrieval index (see retrieval.py). Stages, all running at once:
+#   parse  PDF text is extracted in a pool of processes, INGEST_PAGES_PER_TASK pages per task,
+#          and each file's pages are consumed in order as their tasks finish
+#   chunk  pages are packed into overlapping chunks of about INGEST_CHUNK_CHARS characters
+#   embed  chunks are embedded INGEST_BATCH_SIZE to a request, INGEST_CONCURRENCY requests at
+#          a time, while later pages are still being parsed
+#   index  a file's chunks go into the index in one step once all of them are embedded
+# Files are identified by a hash of their bytes, so a file that is already in the index is
+# skipped before it is parsed, and chunks embedded before (in any file) come from the cache.
+#
+#   python ingest.py materials/*.pdf --processes 4
+import argparse
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from retrieval import Document, embed_texts, get_vector_index
+
+logger = logging.getLogger(__name__)
+
+INGEST_CHUNK_CHARS = int(os.getenv("INGEST_CHUNK_CHARS", 1500))
+# Characters repeated at the start of the next chunk, so a passage cut at a chunk boundary is
+# still whole in one of the two
+INGEST_CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", 200))
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", 8))
+# Chunks per embeddings request (Azure OpenAI accepts up to 2048 inputs per request)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 64))
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", 4))
+INGEST_PROCESSES = int(os.getenv("INGEST_PROCESSES", os.cpu_count() or 1))
+# Uploaded files are kept here, named by content hash, so the index can point back to them
+INGEST_UPLOAD_DIR = os.getenv("INGEST_UPLOAD_DIR", os.path.join(".cache", "uploads"))
+TEXT_SUFFIXES = (".txt", ".md")
+
+
+class Chunk(NamedTuple):
+    text: str
+    first_page: int
+    last_page: int
+
+
+class IngestResult(NamedTuple):
+    name: str
+    digest: str
+    pages: int
+    chunks: int
+    # "indexed", "duplicate" (already in the index), "empty" (no text, e.g. a scanned PDF)
+    # or "failed: <reason>"
+    status: str
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(digest: str, number: int) -> str:
+    # Azure AI Search keys allow letters, digits, "_", "-" and "="
+    return f"{digest[:32]}-{number}"
+
+
+def save_upload(name: str, data: bytes) -> str:
+    """Stores uploaded bytes under INGEST_UPLOAD_DIR and returns the path to pass to ingest_files."""
+    directory = os.path.join(INGEST_UPLOAD_DIR, hashlib.sha256(data).hexdigest()[:16])
+    path = os.path.join(directory, os.path.basename(name))
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def page_count(path: str) -> int:
+    if path.lower().endswith(TEXT_SUFFIXES):
+        return 1
+    import pymupdf
+
+    with pymupdf.open(path) as document:
+        return document.page_count
+
+
+def split_paragraphs(text: str, max_chars: int = INGEST_CHUNK_CHARS) -> List[str]:
+    """
+    Paragraphs of `text` with whitespace collapsed (PDF text breaks every line), and those
+    longer than `max_chars` split at word boundaries.
+    """
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        words = paragraph.split()
+        piece: List[str] = []
+        length = 0
+        for word in words:
+            if piece and length + 1 + len(word) > max_chars:
+                paragraphs.append(" ".join(piece))
+                piece, length = [], 0
+            piece.append(word)
+            length += len(word) + (length > 0)
+        if piece:
+            paragraphs.append(" ".join(piece))
+    return paragraphs
+
+
+def extract_pages(path: str, first: int, last: int) -> List[Tuple[int, List[str]]]:
+    """
+    (page number, paragraphs) for pages first..last-1 (counted from 0) of a file; runs in
+    the parsing processes.
+    """
+    if path.lower().endswith(TEXT_SUFFIXES):
+        with open(path, encoding="utf-8", errors="replace") as file:
+            return [(1, split_paragraphs(file.read()))]
+    import pymupdf
+
+    with pymupdf.open(path) as document:
+        return [(number + 1, split_paragraphs(document[number].get_text())) for number in range(first, last)]
+
+
+class Chunker:
+    """Packs paragraphs, fed in document order, into chunks of about `size` characters."""
+
+    def __init__(self, size: int = INGEST_CHUNK_CHARS, overlap: int = INGEST_CHUNK_OVERLAP):
+        self.size = size
+        self.overlap = overlap
+        self.parts: List[Tuple[int, str]] = []
+        self.length = 0
+        # Whether parts holds more than the overlap carried over from the previous chunk
+        self.fresh = False
+
+    def feed(self, page: int, paragraphs: Sequence[str]) -> List[Chunk]:
+        chunks = []
+        for paragraph in paragraphs:
+            if self.fresh and self.length + len(paragraph) > self.size:
+                chunks.append(self._emit())
+            self.parts.append((page, paragraph))
+            self.length += len(paragraph) + 1
+            self.fresh = True
+        return chunks
+
+    def finish(self) -> List[Chunk]:
+        return [self._emit()] if self.fresh else []
+
+    def _emit(self) -> Chunk:
+        text = "\n".join(paragraph for _, paragraph in self.parts)
+        chunk = Chunk(text, self.parts[0][0], self.parts[-1][0])
+        tail = text[-self.overlap:] if self.overlap else ""
+        if tail and " " in tail and len(tail) < len(text):
+            # Start the carried-over text at a word
+            tail = tail[tail.index(" ") + 1:]
+        self.parts = [(chunk.last_page, tail)] if tail else []
+        self.length = len(tail) + 1 if tail else 0
+        self.fresh = False
+        return chunk
+
+
+class EmbeddingBatcher:
+    """
+    Collects texts into embeddings requests of up to `batch_size` texts, with at most
+    `concurrency` requests in flight. embed() returns a future for the text's vector.
+    """
+
+    def __init__(self, batch_size: int = INGEST_BATCH_SIZE, concurrency: int = INGEST_CONCURRENCY):
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.texts: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.tasks = set()
+
+    def embed(self, text: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.texts.append(text)
+        self.futures.append(future)
+        if len(self.texts) >= self.batch_size:
+            self.flush()
+        return future
+
+    def flush(self) -> None:
+        """Sends the texts collected so far, even if they do not fill a batch."""
+        if not self.texts:
+            return
+        task = asyncio.create_task(self._request(self.texts, self.futures))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.texts, self.futures = [], []
+
+    async def _request(self, texts: List[str], futures: List[asyncio.Future]) -> None:
+        async with self.semaphore:
+            try:
+                vectors = await embed_texts(texts)
+            except Exception as exc:
+                for future in futures:
+                    future.set_exception(exc)
+                return
+        for future, vector in zip(futures, vectors):
+            future.set_result(vector)
+
+
+async def index_file(index, index_lock: asyncio.Lock, name: str, digest: str, pages: int, chunks: List[Chunk], vectors: List[asyncio.Future]) -> IngestResult:
+    if not chunks:
+        return IngestResult(name, digest, pages, 0, "empty")
+    try:
+        vectors = await asyncio.gather(*vectors)
+    except Exception as exc:
+        return IngestResult(name, digest, pages, len(chunks), f"failed: embedding error {exc!r}")
+    documents = [
+        Document(
+            chunk_id(digest, number),
+            f"{name}, page {chunk.first_page}" if chunk.first_page == chunk.last_page else f"{name}, pages {chunk.first_page}-{chunk.last_page}",
+            chunk.text,
+            name,
+        )
+        for number, chunk in enumerate(chunks)
+    ]
+    # Adding is what makes chunk 0's id, the duplicate marker, appear, so a file is recorded
+    # only once all of it is in; one add() at a time, as the local index requires
+    async with index_lock:
+        await asyncio.to_thread(index.add, documents, vectors)
+    return IngestResult(name, digest, pages, len(chunks), "indexed")
+
+
+async def ingest_files(paths: Sequence[str], processes: int = INGEST_PROCESSES, index=None) -> List[IngestResult]:
+    """
+    Adds the files at `paths` to `index` (by default the one retrieval uses), returning one
+    result per file.
+    """
+    index = index if index is not None else get_vector_index()
+    if index is None:
+        raise RuntimeError("Retrieval is off (RETRIEVAL_BACKEND=off), so there is no index to ingest into")
+    loop = asyncio.get_running_loop()
+    batcher = EmbeddingBatcher()
+    index_lock = asyncio.Lock()
+    results: List[Optional[IngestResult]] = [None] * len(paths)
+    indexing = []
+    # Files of this call already queued, which the index does not know about yet
+    seen = set()
+    with ProcessPoolExecutor(max(processes, 1), mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Queue the parsing of every new file up front, so the pool never waits on chunking
+        parsing = []
+        for position, path in enumerate(paths):
+            name = os.path.basename(path)
+            try:
+                digest = await asyncio.to_thread(file_digest, path)
+                if digest in seen or await asyncio.to_thread(index.__contains__, chunk_id(digest, 0)):
+                    results[position] = IngestResult(name, digest, 0, 0, "duplicate")
+                    continue
+                pages = await asyncio.to_thread(page_count, path)
+            except Exception as exc:
+                results[position] = IngestResult(name, "", 0, 0, f"failed: {exc!r}")
+                continue
+            seen.add(digest)
+            tasks = [
+                loop.run_in_executor(pool, extract_pages, path, first, min(first + INGEST_PAGES_PER_TASK, pages))
+                for first in range(0, pages, INGEST_PAGES_PER_TASK)
+            ]
+            parsing.append((position, name, digest, pages, tasks))
+
+        for position, name, digest, pages, tasks in parsing:
+            chunker = Chunker()
+            chunks: List[Chunk] = []
+            vectors: List[asyncio.Future] = []
+            try:
+                for task in tasks:
+                    for page, paragraphs in await task:
+                        for chunk in chunker.feed(page, paragraphs):
+                            chunks.append(chunk)
+                            vectors.append(batcher.embed(chunk.text))
+                for chunk in chunker.finish():
+                    chunks.append(chunk)
+                    vectors.append(batcher.embed(chunk.text))
+            except Exception as exc:
+                for task in tasks:
+                    task.cancel()
+                results[position] = IngestResult(name, digest, pages, 0, f"failed: {exc!r}")
+                continue
+            indexing.append((position, asyncio.create_task(index_file(index, index_lock, name, digest, pages, chunks, vectors))))
+    batcher.flush()
+    for position, task in indexing:
+        results[position] = await task
+    for result in results:
+        logger.info("%s: %s (%d pages, %d chunks)", result.name, result.status, result.pages, result.chunks)
+    return results
+
+
+async def ingest(paths: Sequence[str], processes: int) -> List[IngestResult]:
+    from utils import aclose_async_services
+
+    try:
+        return await ingest_files(paths, processes)
+    finally:
+        await aclose_async_services()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add past education materials to the retrieval index.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--processes", type=int, default=INGEST_PROCESSES, help="processes parsing PDFs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.perf_counter()
+    results = asyncio.run(ingest(args.paths, args.processes))
+    elapsed = time.perf_counter() - start
+    pages = sum(result.pages for result in results)
+    print(f"{len(results)} files, {pages} pages, {sum(result.chunks for result in results)} chunks in {elapsed:.1f}s ({pages / elapsed:.1f} pages/s)")
+    if any(result.status.startswith("failed") for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
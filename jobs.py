@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import os
+import socket
+from enum import Enum
+from typing import Iterable, List, Optional
+from uuid import uuid4
+
+from elements import ElementStatus, element_state
+from extractors import PlaceholderIndex
+from jobstore import JOB_LEASE, get_job_store
+from main import stream_page
+
+logger = logging.getLogger(__name__)
+
+# Jobs live in the job store (see jobstore.py), so they survive restarts and can be worked on
+# by any process: JOB_WORKERS coroutines inside the API server, and/or `python worker.py`
+# processes. Generation is almost entirely waiting on Azure OpenAI and Replicate, so one
+# process runs many jobs at once. At most JOB_QUEUE_SIZE jobs wait for a worker; finished
+# jobs are kept for JOB_TTL seconds.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))
+JOB_TTL = float(os.getenv("JOB_TTL", 3600))
+# How often idle workers look for new jobs queued by other processes
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class QueueFull(Exception):
+    """Raised by JobManager.submit when JOB_QUEUE_SIZE jobs are already waiting."""
+
+
+class LeaseLost(Exception):
+    """Raised in a job's worker when another worker has taken the job over."""
+
+
+class NotRegenerable(Exception):
+    """Raised when elements of a job's page cannot be regenerated: it is unfinished, has no layout or lacks the ids."""
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:6]}"
+
+
+def job_summary(store, job: dict) -> dict:
+    counts = {}
+    for key, state in store.checkpoints(job["id"]).items():
+        if key.startswith("element:"):
+            counts[state["status"]] = counts.get(state["status"], 0) + 1
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "created": job["created"],
+        "updated": job["updated"],
+        "elements": counts,
+        # Set for regeneration jobs: the job whose page they started from
+        "source": job["params"].get("source"),
+        "error": job["error"],
+    }
+
+
+def job_elements(store, job_id: str) -> List[dict]:
+    """The elements of a job's page in document order, each as its id plus its element_state."""
+    saved = store.checkpoints(job_id)
+    if "layout" not in saved:
+        return []
+    return [
+        {"id": element.id, **saved.get(f"element:{element.id}", element_state(element))}
+        for element in PlaceholderIndex(saved["layout"]).table()
+    ]
+
+
+def create_regeneration_job(store, job_id: str, element_ids: Iterable[str], refine: bool = False) -> str:
+    """
+    Queues a job that redoes only the given elements of a finished job's page and keeps
+    everything else. It starts from a copy of the job's checkpoints in which the chosen
+    elements are reset to pending with their variation bumped, so run_job's resume path
+    generates just those: an image costs one prediction (plus one refinement if `refine`),
+    text one completion per batch. The new page also replaces the cached one.
+    """
+    job = store.get(job_id)
+    if job is None or job["status"] != JobStatus.DONE.value:
+        raise NotRegenerable(f"Job {job_id} has not finished")
+    saved = store.checkpoints(job_id)
+    if "layout" not in saved:
+        raise NotRegenerable(f"Job {job_id} was answered from the page cache and has no layout to regenerate from")
+    element_ids = list(dict.fromkeys(element_ids))
+    unknown = [element_id for element_id in element_ids if f"element:{element_id}" not in saved]
+    if not element_ids or unknown:
+        raise NotRegenerable(f"Unknown element ids: {unknown}" if unknown else "No elements given")
+
+    for element_id in element_ids:
+        state = dict(saved[f"element:{element_id}"])
+        state.update(content=None, variants={}, status=ElementStatus.PENDING.value, variation=state.get("variation", 0) + 1)
+        if refine:
+            state["refined"] = None
+        saved[f"element:{element_id}"] = state
+    params = {**job["params"], "regenerate": True, "source": job_id, "elements": element_ids}
+    new_job_id = store.create(params, checkpoints=saved)
+    store.publish(new_job_id, {"event": "status", "status": JobStatus.QUEUED.value})
+    return new_job_id
+
+
+async def run_job(store, job: dict, worker: str, strategy=None):
+    """
+    Runs (or resumes) a claimed job, yielding stream_page's (stage, html) updates.
+
+    The finished layout and every element's progress (refined prompt, image URLs, expanded
+    text) are checkpointed as they happen, so a rerun after a crash or restart starts from
+    what was already paid for. The job's lease is renewed in the background; if another
+    worker has taken the job over, this run stops with LeaseLost. Closing the generator before
+    the job is settled hands it back to the queue.
+    """
+    params = job["params"]
+    saved = store.checkpoints(job["id"])
+    resume = None
+    if "layout" in saved:
+        resume = {
+            "layout": saved["layout"],
+            "elements": {key.split(":", 1)[1]: state for key, state in saved.items() if key.startswith("element:")},
+        }
+        store.publish(job["id"], {"event": "status", "status": JobStatus.RUNNING.value, "resumed": len(resume["elements"])})
+    else:
+        store.publish(job["id"], {"event": "status", "status": JobStatus.RUNNING.value})
+
+    def on_layout(html: str) -> None:
+        store.save_checkpoint(job["id"], "layout", html)
+
+    def on_element(element) -> None:
+        state = element_state(element)
+        store.save_checkpoint(job["id"], f"element:{element.id}", state)
+        store.publish(job["id"], {"event": "element", "id": element.id, "type": element.type, "status": state["status"], "description": element.description})
+
+    lost = asyncio.Event()
+
+    async def keep_lease():
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            if not store.renew(job["id"], worker):
+                lost.set()
+                return
+
+    def check_lease():
+        # The lease task only flags the loss; the run stops here, between updates, so the
+        # caller's own task is never cancelled from under it
+        if lost.is_set():
+            raise LeaseLost(f"Job {job['id']} was taken over by another worker")
+
+    settled = False
+    lease = asyncio.create_task(keep_lease())
+    try:
+        async for stage, html in stream_page(
+            params["target_audience"], params["stylistic_description"], params["content_description"], params["format"],
+            regenerate=params.get("regenerate", False), strategy=strategy, on_element=on_element, on_layout=on_layout, resume=resume
+        ):
+            check_lease()
+            if stage == "page":
+                store.finish(job["id"], worker, html)
+                store.publish(job["id"], {"event": "status", "status": JobStatus.DONE.value})
+                settled = True
+                lease.cancel()
+            yield stage, html
+            check_lease()
+    except LeaseLost:
+        settled = True
+        raise
+    except Exception as exc:
+        logger.exception("Job %s failed", job["id"])
+        store.fail(job["id"], worker, repr(exc))
+        store.publish(job["id"], {"event": "status", "status": JobStatus.FAILED.value, "error": repr(exc)})
+        settled = True
+    finally:
+        lease.cancel()
+        if not settled:
+            # Closed or cancelled part way through (shutting down, a Streamlit rerun, a closed
+            # tab): hand the job back so the next worker resumes it straight away instead of
+            # waiting out the lease
+            store.release(job["id"], worker)
+
+
+class JobManager:
+    """Submits page generation jobs to the job store and works on them with a pool of coroutines."""
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE, ttl: float = JOB_TTL, strategy=None, store=None):
+        self.worker_count = workers
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.strategy = strategy
+        self.store = store or get_job_store()
+        self.name = worker_name()
+        self.workers = []
+        self.wake = asyncio.Event()
+        self.loop = None
+
+    def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.workers = [asyncio.create_task(self._work(f"{self.name}/{index}")) for index in range(self.worker_count)]
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, target_audience: str, stylistic_description: str, content_description: str, format: str, regenerate: bool = False) -> str:
+        self.store.expire(self.ttl)
+        queued = self.store.queued()
+        if queued >= self.queue_size:
+            raise QueueFull(f"{queued} jobs are already waiting")
+        job_id = self.store.create({
+            "target_audience": target_audience,
+            "stylistic_description": stylistic_description,
+            "content_description": content_description,
+            "format": format,
+            "regenerate": regenerate,
+        })
+        self.store.publish(job_id, {"event": "status", "status": JobStatus.QUEUED.value})
+        self._wake()
+        return job_id
+
+    def regenerate(self, job_id: str, element_ids: Iterable[str], refine: bool = False) -> str:
+        """Queues a job that redoes only `element_ids` of a finished job's page; see create_regeneration_job."""
+        queued = self.store.queued()
+        if queued >= self.queue_size:
+            raise QueueFull(f"{queued} jobs are already waiting")
+        new_job_id = create_regeneration_job(self.store, job_id, element_ids, refine)
+        self._wake()
+        return new_job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.store.get(job_id)
+
+    def _wake(self) -> None:
+        # submit and regenerate may be called from a thread (FastAPI runs plain def endpoints
+        # in its threadpool), and an asyncio.Event may only be set from its loop
+        if self.loop is None:
+            self.wake.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def summary(self, job_id: str) -> Optional[dict]:
+        job = self.store.get(job_id)
+        return job_summary(self.store, job) if job else None
+
+    async def _work(self, worker: str) -> None:
+        while True:
+            job = self.store.claim(worker)
+            if job is None:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                async for _ in run_job(self.store, job, worker, self.strategy):
+                    pass
+            except LeaseLost as exc:
+                logger.warning("%s", exc)
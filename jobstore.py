@@ -0,0 +1,441 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from cache import CACHE_BACKEND, REDIS_URL
+
+# Where page generation jobs, their checkpoints and progress events live. SQLite is the
+# default and works for any number of worker processes on one machine; JOB_BACKEND=redis
+# shares the queue between machines.
+JOB_BACKEND = os.getenv("JOB_BACKEND", CACHE_BACKEND)
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(".cache", "jobs.sqlite3"))
+# A running job belongs to its worker for JOB_LEASE seconds at a time; the worker renews the
+# lease while it works, so a job whose worker died is picked up again once the lease lapses.
+JOB_LEASE = float(os.getenv("JOB_LEASE", 60))
+# A job whose lease has lapsed this many times (its worker died each time, e.g. because the
+# job crashes it) is marked failed instead of being claimed again
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def give_up_message(attempts) -> str:
+    return f"Gave up after {attempts} attempts: the worker running the job stopped without finishing it each time"
+
+
+class SQLiteJobStore:
+    """
+    Jobs, checkpoints and events in one SQLite database. Claims run in an IMMEDIATE
+    transaction, so concurrent worker processes never take the same job.
+    """
+
+    def __init__(self, path: str = JOB_DB_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    html TEXT,
+                    error TEXT,
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, created);
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    job_id TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (job_id, key)
+                );
+                CREATE TABLE IF NOT EXISTS events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    event TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS events_job ON events (job_id, seq);"""
+            )
+
+    def _job(self, row) -> Optional[dict]:
+        if row is None:
+            return None
+        keys = ("id", "params", "status", "html", "error", "worker", "lease_until", "attempts", "created", "updated")
+        job = dict(zip(keys, row))
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def create(self, params: dict, checkpoints: Optional[Dict[str, object]] = None) -> str:
+        """Queues a new job. `checkpoints` are stored with it, before any worker can claim it."""
+        job_id = uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT INTO checkpoints (job_id, key, value) VALUES (?, ?, ?)",
+                    [(job_id, key, json.dumps(value)) for key, value in (checkpoints or {}).items()]
+                )
+                self.connection.execute(
+                    "INSERT INTO jobs (id, params, status, created, updated) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, json.dumps(params), QUEUED, now, now)
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            return self._job(self.connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def queued(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+    def _give_up(self, now: float, max_attempts: int) -> None:
+        """Fails the lapsed jobs that have had max_attempts already (inside a claim's transaction)."""
+        exhausted = self.connection.execute(
+            "SELECT id, attempts FROM jobs WHERE status = ? AND lease_until < ? AND attempts >= ?", (RUNNING, now, max_attempts)
+        ).fetchall()
+        for job_id, attempts in exhausted:
+            error = give_up_message(attempts)
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated = ? WHERE id = ?", (FAILED, error, now, job_id)
+            )
+            self.connection.execute(
+                "INSERT INTO events (job_id, event) VALUES (?, ?)", (job_id, json.dumps({"event": "status", "status": FAILED, "error": error}))
+            )
+
+    def claim(self, worker: str, lease: float = JOB_LEASE, job_id: Optional[str] = None, max_attempts: int = JOB_MAX_ATTEMPTS) -> Optional[dict]:
+        """
+        Takes the oldest queued job, or one whose lease has lapsed, for `worker`. With `job_id`
+        only that job is considered, and a worker may also re-claim a job it already holds.
+        Lapsed jobs that have been claimed `max_attempts` times are failed instead; re-claiming a
+        job the worker already holds, or one handed back with release, does not use up an attempt.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._give_up(now, max_attempts)
+                if job_id is None:
+                    row = self.connection.execute(
+                        "SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY created LIMIT 1",
+                        (QUEUED, RUNNING, now)
+                    ).fetchone()
+                else:
+                    row = self.connection.execute(
+                        "SELECT id FROM jobs WHERE id = ? AND (status = ? OR (status = ? AND (lease_until < ? OR worker = ?)))",
+                        (job_id, QUEUED, RUNNING, now, worker)
+                    ).fetchone()
+                if row is None:
+                    self.connection.execute("COMMIT")
+                    return None
+                self.connection.execute(
+                    # Re-claiming a job this worker already holds (a Streamlit rerun) is not a new attempt
+                    "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, updated = ?,"
+                    " attempts = attempts + CASE WHEN status = ? AND worker = ? THEN 0 ELSE 1 END WHERE id = ?",
+                    (RUNNING, worker, now + lease, now, RUNNING, worker, row[0])
+                )
+                job = self._job(self.connection.execute("SELECT * FROM jobs WHERE id = ?", (row[0],)).fetchone())
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return job
+
+    def renew(self, job_id: str, worker: str, lease: float = JOB_LEASE) -> bool:
+        """Extends the lease; False means the job has been taken over by another worker."""
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?",
+                (time.time() + lease, job_id, worker, RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def _settle(self, job_id: str, worker: str, status: str, html: Optional[str] = None, error: Optional[str] = None) -> bool:
+        # A job handed back to the queue gets its attempt back: only runs that stop without
+        # settling the job count towards JOB_MAX_ATTEMPTS
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE jobs SET status = ?, html = ?, error = ?, lease_until = NULL, updated = ?, attempts = MAX(attempts - ?, 0)"
+                " WHERE id = ? AND worker = ? AND status = ?",
+                (status, html, error, time.time(), int(status == QUEUED), job_id, worker, RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, job_id: str, worker: str) -> bool:
+        """Puts a job back in the queue, e.g. when its worker shuts down part way through."""
+        return self._settle(job_id, worker, QUEUED)
+
+    def finish(self, job_id: str, worker: str, html: str) -> bool:
+        return self._settle(job_id, worker, DONE, html=html)
+
+    def fail(self, job_id: str, worker: str, error: str) -> bool:
+        return self._settle(job_id, worker, FAILED, error=error)
+
+    def save_checkpoint(self, job_id: str, key: str, value) -> None:
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints (job_id, key, value) VALUES (?, ?, ?)",
+                (job_id, key, json.dumps(value))
+            )
+
+    def checkpoints(self, job_id: str) -> Dict[str, object]:
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM checkpoints WHERE job_id = ?", (job_id,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def publish(self, job_id: str, event: dict) -> None:
+        with self.lock:
+            self.connection.execute("INSERT INTO events (job_id, event) VALUES (?, ?)", (job_id, json.dumps(event)))
+
+    def events(self, job_id: str, after: int = 0) -> List[Tuple[int, dict]]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT seq, event FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+            ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def expire(self, ttl: float) -> None:
+        """Deletes finished jobs (with their checkpoints and events) last updated over `ttl` seconds ago."""
+        cutoff = time.time() - ttl
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                expired = "SELECT id FROM jobs WHERE status IN (?, ?) AND updated < ?"
+                for table in ("checkpoints", "events"):
+                    self.connection.execute(f"DELETE FROM {table} WHERE job_id IN ({expired})", (DONE, FAILED, cutoff))
+                self.connection.execute(f"DELETE FROM jobs WHERE id IN ({expired})", (DONE, FAILED, cutoff))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+
+class RedisJobStore:
+    """
+    Same interface as SQLiteJobStore on top of Redis. Each job is a hash, the queue a list and
+    running jobs a sorted set scored by lease expiry; claims run as Lua scripts so they are
+    atomic across workers.
+    """
+
+    # Fails a lapsed job that has had its attempts, as SQLiteJobStore._give_up does; held()
+    # tells a worker re-claiming its own job from a new attempt.
+    # ARGV[5] is the job's error message with %d for its attempts.
+    GIVE_UP = """
+    local function give_up(key, job_id)
+        local message = string.format(ARGV[5], tonumber(redis.call('HGET', key, 'attempts')))
+        redis.call('ZREM', KEYS[2], job_id)
+        redis.call('HSET', key, 'status', 'failed', 'error', message, 'lease_until', '', 'updated', ARGV[2])
+        redis.call('ZADD', KEYS[3], ARGV[2], job_id)
+        redis.call('RPUSH', key .. ':events', cjson.encode({event = 'status', status = 'failed', error = message}))
+    end
+    local function exhausted(key)
+        return tonumber(redis.call('HGET', key, 'attempts') or '0') >= tonumber(ARGV[6])
+    end
+    local function held(key)
+        return redis.call('HGET', key, 'status') == 'running' and redis.call('HGET', key, 'worker') == ARGV[1]
+    end
+    """
+    # KEYS: queue, leases, finished. ARGV: worker, now, lease, prefix, give-up message, max attempts
+    CLAIM_NEXT = GIVE_UP + """
+    local job_id
+    while true do
+        job_id = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2], 'LIMIT', 0, 1)[1]
+        if not job_id then break end
+        local key = ARGV[4] .. job_id
+        if redis.call('EXISTS', key) == 0 then
+            redis.call('ZREM', KEYS[2], job_id)
+            return nil
+        end
+        if not exhausted(key) then break end
+        give_up(key, job_id)
+    end
+    job_id = job_id or redis.call('LPOP', KEYS[1])
+    if not job_id then return nil end
+    local key = ARGV[4] .. job_id
+    if redis.call('EXISTS', key) == 0 then
+        redis.call('ZREM', KEYS[2], job_id)
+        return nil
+    end
+    if not held(key) then redis.call('HINCRBY', key, 'attempts', 1) end
+    redis.call('ZADD', KEYS[2], ARGV[2] + ARGV[3], job_id)
+    redis.call('HSET', key, 'status', 'running', 'worker', ARGV[1], 'lease_until', ARGV[2] + ARGV[3], 'updated', ARGV[2])
+    return job_id
+    """
+    # KEYS: queue, leases, finished, job. ARGV: worker, now, lease, job_id, give-up message, max attempts
+    CLAIM_ONE = GIVE_UP + """
+    local status = redis.call('HGET', KEYS[4], 'status')
+    local lease_until = tonumber(redis.call('HGET', KEYS[4], 'lease_until') or '') or 0
+    local worker = redis.call('HGET', KEYS[4], 'worker')
+    if status == 'queued' then
+        redis.call('LREM', KEYS[1], 0, ARGV[4])
+    elseif status == 'running' and lease_until < tonumber(ARGV[2]) and exhausted(KEYS[4]) then
+        give_up(KEYS[4], ARGV[4])
+        return nil
+    elseif not (status == 'running' and (lease_until < tonumber(ARGV[2]) or worker == ARGV[1])) then
+        return nil
+    end
+    if not held(KEYS[4]) then redis.call('HINCRBY', KEYS[4], 'attempts', 1) end
+    redis.call('ZADD', KEYS[2], ARGV[2] + ARGV[3], ARGV[4])
+    redis.call('HSET', KEYS[4], 'status', 'running', 'worker', ARGV[1], 'lease_until', ARGV[2] + ARGV[3], 'updated', ARGV[2])
+    return ARGV[4]
+    """
+    # KEYS: queue, leases, job. ARGV: worker, status, html, error, now, lease (renew only)
+    SETTLE = """
+    if redis.call('HGET', KEYS[3], 'worker') ~= ARGV[1] or redis.call('HGET', KEYS[3], 'status') ~= 'running' then
+        return 0
+    end
+    if ARGV[2] == 'running' then
+        redis.call('ZADD', KEYS[2], ARGV[5] + ARGV[6], redis.call('HGET', KEYS[3], 'id'))
+        redis.call('HSET', KEYS[3], 'lease_until', ARGV[5] + ARGV[6])
+        return 1
+    end
+    local job_id = redis.call('HGET', KEYS[3], 'id')
+    redis.call('ZREM', KEYS[2], job_id)
+    redis.call('HSET', KEYS[3], 'status', ARGV[2], 'html', ARGV[3], 'error', ARGV[4], 'lease_until', '', 'updated', ARGV[5])
+    if ARGV[2] == 'queued' then
+        -- Handed back, as in SQLiteJobStore._settle: this run does not count as an attempt
+        if tonumber(redis.call('HGET', KEYS[3], 'attempts') or '0') > 0 then redis.call('HINCRBY', KEYS[3], 'attempts', -1) end
+        redis.call('RPUSH', KEYS[1], job_id)
+    end
+    return 1
+    """
+
+    def __init__(self, url: str = REDIS_URL):
+        try:
+            import redis
+        except ImportError as exc:
+            raise ImportError("JOB_BACKEND=redis needs the redis package: pip install redis") from exc
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = "inky:job:"
+        self.queue_key = "inky:jobs:queue"
+        self.leases_key = "inky:jobs:leases"
+        self.finished_key = "inky:jobs:finished"
+        self.claim_next = self.client.register_script(self.CLAIM_NEXT)
+        self.claim_one = self.client.register_script(self.CLAIM_ONE)
+        self.settle = self.client.register_script(self.SETTLE)
+
+    def _job(self, job_id: Optional[str]) -> Optional[dict]:
+        if not job_id:
+            return None
+        fields = self.client.hgetall(self.prefix + job_id)
+        if not fields:
+            return None
+        return {
+            "id": fields["id"],
+            "params": json.loads(fields["params"]),
+            "status": fields["status"],
+            "html": fields.get("html") or None,
+            "error": fields.get("error") or None,
+            "worker": fields.get("worker") or None,
+            "lease_until": float(fields["lease_until"]) if fields.get("lease_until") else None,
+            "attempts": int(fields.get("attempts", 0)),
+            "created": float(fields["created"]),
+            "updated": float(fields["updated"]),
+        }
+
+    def create(self, params: dict, checkpoints: Optional[Dict[str, object]] = None) -> str:
+        job_id = uuid4().hex
+        now = time.time()
+        pipeline = self.client.pipeline()
+        if checkpoints:
+            pipeline.hset(f"{self.prefix}{job_id}:checkpoints", mapping={key: json.dumps(value) for key, value in checkpoints.items()})
+        pipeline.hset(self.prefix + job_id, mapping={
+            "id": job_id, "params": json.dumps(params), "status": QUEUED, "attempts": 0, "created": now, "updated": now,
+        })
+        pipeline.rpush(self.queue_key, job_id)
+        pipeline.execute()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self._job(job_id)
+
+    def queued(self) -> int:
+        return self.client.llen(self.queue_key)
+
+    def claim(self, worker: str, lease: float = JOB_LEASE, job_id: Optional[str] = None, max_attempts: int = JOB_MAX_ATTEMPTS) -> Optional[dict]:
+        message = give_up_message("%d")
+        if job_id is None:
+            claimed = self.claim_next(
+                keys=[self.queue_key, self.leases_key, self.finished_key],
+                args=[worker, time.time(), lease, self.prefix, message, max_attempts]
+            )
+        else:
+            claimed = self.claim_one(
+                keys=[self.queue_key, self.leases_key, self.finished_key, self.prefix + job_id],
+                args=[worker, time.time(), lease, job_id, message, max_attempts]
+            )
+        return self._job(claimed)
+
+    def _settle(self, job_id: str, worker: str, status: str, html: Optional[str] = None, error: Optional[str] = None, lease: float = 0) -> bool:
+        settled = self.settle(
+            keys=[self.queue_key, self.leases_key, self.prefix + job_id],
+            args=[worker, status, html or "", error or "", time.time(), lease]
+        ) == 1
+        if settled and status in (DONE, FAILED):
+            self.client.zadd(self.finished_key, {job_id: time.time()})
+        return settled
+
+    def renew(self, job_id: str, worker: str, lease: float = JOB_LEASE) -> bool:
+        return self._settle(job_id, worker, RUNNING, lease=lease)
+
+    def release(self, job_id: str, worker: str) -> bool:
+        return self._settle(job_id, worker, QUEUED)
+
+    def finish(self, job_id: str, worker: str, html: str) -> bool:
+        return self._settle(job_id, worker, DONE, html=html)
+
+    def fail(self, job_id: str, worker: str, error: str) -> bool:
+        return self._settle(job_id, worker, FAILED, error=error)
+
+    def save_checkpoint(self, job_id: str, key: str, value) -> None:
+        self.client.hset(f"{self.prefix}{job_id}:checkpoints", key, json.dumps(value))
+
+    def checkpoints(self, job_id: str) -> Dict[str, object]:
+        return {key: json.loads(value) for key, value in self.client.hgetall(f"{self.prefix}{job_id}:checkpoints").items()}
+
+    def publish(self, job_id: str, event: dict) -> None:
+        self.client.rpush(f"{self.prefix}{job_id}:events", json.dumps(event))
+
+    def events(self, job_id: str, after: int = 0) -> List[Tuple[int, dict]]:
+        # Sequence numbers are 1-based list positions
+        events = self.client.lrange(f"{self.prefix}{job_id}:events", after, -1)
+        return [(after + offset + 1, json.loads(event)) for offset, event in enumerate(events)]
+
+    def expire(self, ttl: float) -> None:
+        expired = self.client.zrangebyscore(self.finished_key, "-inf", time.time() - ttl)
+        for job_id in expired:
+            self.client.delete(self.prefix + job_id, f"{self.prefix}{job_id}:checkpoints", f"{self.prefix}{job_id}:events")
+        if expired:
+            self.client.zrem(self.finished_key, *expired)
+
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+
+def get_job_store():
+    """Returns the process-wide job store, created on first use."""
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            _job_store = RedisJobStore() if JOB_BACKEND == "redis" else SQLiteJobStore()
+        return _job_store
@@ -0,0 +1,328 @@
+# Structured page layouts. With LAYOUT_OUTPUT=json (see htmlgeneratorfunc) the layout model
+# answers with a compact JSON tree instead of HTML: a heading and a list of sections, each a
+# grid cell of a given size holding text and image slots. The tree is validated with the
+# models below and rendered to the same page HTML, placeholders and theme classes the HTML
+# layouts use, so everything after layout generation works on either.
+#
+# Broken answers are repaired as locally as possible: parse_layout cuts a response that was
+# cut off back to its last complete value and closes it, and validates every section on its
+# own, so one bad section is all that needs to go back to the model (see
+# htmlgeneratorfunc.repair_layout_sections) and the rest of the page is kept.
+import html
+import json
+import logging
+import re
+from typing import Annotated, List, Literal, NamedTuple, Optional, Tuple, Union, get_args
+
+from pydantic import BaseModel, Field, ValidationError
+
+from extractors import iter_placeholders
+
+logger = logging.getLogger(__name__)
+
+SectionSize = Literal["cell", "span-2", "span-3", "full-width"]
+
+
+class TextSlot(BaseModel):
+    kind: Literal["text"]
+    description: str = Field(min_length=3, max_length=500)
+
+
+class ImageSlot(BaseModel):
+    kind: Literal["image"]
+    width: int = Field(ge=64, le=2048)
+    height: int = Field(ge=64, le=2048)
+    description: str = Field(min_length=3, max_length=800)
+
+
+Slot = Annotated[Union[TextSlot, ImageSlot], Field(discriminator="kind")]
+
+
+class Section(BaseModel):
+    # Size and highlight come before the slots, so a streamed section is placed on the grid
+    # before its content arrives
+    size: SectionSize
+    highlight: bool = False
+    slots: List[Slot] = Field(min_length=1, max_length=4)
+
+
+class PageLayout(BaseModel):
+    title: str = Field(min_length=1, max_length=200)
+    heading: str = Field(min_length=1, max_length=200)
+    sections: List[Section] = Field(min_length=1, max_length=30)
+
+
+class LayoutError(ValueError):
+    """A layout response with no usable page in it."""
+
+
+class BrokenSection(NamedTuple):
+    position: int  # index among the response's sections
+    data: object  # the section as the model wrote it
+    errors: str
+
+
+class ParsedLayout(NamedTuple):
+    layout: PageLayout  # the valid sections only
+    broken: List[BrokenSection]
+    truncated: bool  # the response was cut off and closed by close_json
+
+
+SECTION_SIZES = get_args(SectionSize)
+
+# The shape of a section and of a layout, as described to the model
+SECTION_SHAPE = (
+    '{"size": ' + " | ".join(f'"{size}"' for size in SECTION_SIZES) + ', "highlight": true (optional), '
+    '"slots": [1 to 4 of {"kind": "text", "description": "..."} or '
+    '{"kind": "image", "width": <pixels>, "height": <pixels>, "description": "..."}]}'
+)
+LAYOUT_SHAPE = '{"title": "<page title>", "heading": "<headline shown in the banner>", "sections": [' + SECTION_SHAPE + ", ...]}"
+
+# The hotline banner every page ends with; the model does not write it
+FOOTER = """<footer class="footer">
+<div><h3>24/7 CNB Hotline</h3><p>1800 325 6666</p></div>
+<div class="qr-placeholder"><a href="https://imgbb.com/"><img src="https://i.ibb.co/6tcJ0tB/qr.png" alt="qr"></a></div>
+</footer>
+"""
+
+# Characters that would end a placeholder early or open a tag inside one
+_PLACEHOLDER_UNSAFE = str.maketrans({'"': "'", "[": "(", "]": ")", "<": None, ">": None})
+
+
+def placeholder_text(description: str) -> str:
+    return " ".join(description.translate(_PLACEHOLDER_UNSAFE).split())
+
+
+def render_slot(slot) -> str:
+    if slot.kind == "image":
+        return f'<div class="image-placeholder">[Image: {slot.width}x{slot.height} - {placeholder_text(slot.description)}]</div>\n'
+    return f'[DESCRIPTION: "{placeholder_text(slot.description)}"]\n'
+
+
+def render_layout(layout: PageLayout) -> str:
+    """
+    The page HTML for a layout, in the form htmlgeneratorfunc.extract_html_content returns
+    HTML layouts (everything after <!DOCTYPE html>, without the closing </html>).
+    """
+    parts = [
+        '\n<html lang="en">\n<head>\n<meta charset="UTF-8">\n',
+        f"<title>{html.escape(layout.title, quote=False)}</title>\n</head>\n<body>\n",
+        f'<div class="container">\n<header class="header"><h1>{html.escape(layout.heading, quote=False)}</h1></header>\n',
+    ]
+    for section in layout.sections:
+        classes = "content-box"
+        if section.size != "cell":
+            classes += f" {section.size}"
+        if section.highlight:
+            classes += " highlight"
+        parts.append(f'<div class="{classes}">\n')
+        parts.extend(render_slot(slot) for slot in section.slots)
+        parts.append("</div>\n")
+    parts.append(FOOTER)
+    parts.append("</div>\n</body>\n")
+    return "".join(parts)
+
+
+_CONTENT_BOX = re.compile(r'<div class="content-box([^"]*)">')
+
+
+def layout_from_html(page: str) -> PageLayout:
+    """
+    The layout of an HTML page written in the theme vocabulary: each content-box becomes a
+    section holding the placeholders inside it. Used for the prompt examples and to compare
+    the two output formats on existing pages.
+    """
+    title = re.search(r"<title>(.*?)</title>", page, re.DOTALL)
+    heading = re.search(r"<h1>(.*?)</h1>", page, re.DOTALL)
+    footer = page.find('<footer class="footer">')
+    boxes = list(_CONTENT_BOX.finditer(page, 0, footer if footer != -1 else len(page)))
+    sections = []
+    for number, box in enumerate(boxes):
+        end = boxes[number + 1].start() if number + 1 < len(boxes) else (footer if footer != -1 else len(page))
+        classes = box.group(1).split()
+        size = next((size for size in SECTION_SIZES if size in classes), "cell")
+        slots = []
+        for placeholder in iter_placeholders(page, box.start(), end):
+            if placeholder.kind == "image":
+                width, height = placeholder.dimensions.split("x")
+                slots.append(ImageSlot(kind="image", width=int(width), height=int(height), description=placeholder.description.strip()))
+            else:
+                slots.append(TextSlot(kind="text", description=placeholder.description.strip()))
+        if slots:
+            sections.append(Section(size=size, highlight="highlight" in classes, slots=slots))
+    heading_text = " ".join(heading.group(1).split()) if heading else ""
+    return PageLayout(title=" ".join(title.group(1).split()) if title else heading_text, heading=heading_text, sections=sections)
+
+
+class JsonCloser:
+    """
+    close_json for text that arrives in pieces: feed() scans only the new text, so a
+    streamed response is scanned once in all rather than once per chunk.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.start = None
+        self.end = None  # set once the object is complete
+        self.scanned = 0
+        self.stack = []
+        self.in_string = self.escaped = False
+        self.cut, self.cut_stack = None, None
+
+    def feed(self, chunk: str) -> List[Tuple[int, Tuple[str, ...]]]:
+        """
+        Adds `chunk`, returning where each object or array inside the object closed in it:
+        the offset just past it and the closers still open there, innermost last.
+        """
+        self.text += chunk
+        closed = []
+        if self.end is not None:
+            return closed
+        if self.start is None:
+            start = self.text.find("{", self.scanned)
+            if start == -1:
+                self.scanned = len(self.text)
+                return closed
+            self.start = self.scanned = start
+        stack = self.stack
+        for position in range(self.scanned, len(self.text)):
+            character = self.text[position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif character == "\\":
+                    self.escaped = True
+                elif character == '"':
+                    self.in_string = False
+            elif character == '"':
+                self.in_string = True
+            elif character in "{[":
+                stack.append("}" if character == "{" else "]")
+            elif character in "}]":
+                if not stack:
+                    break
+                stack.pop()
+                if not stack:
+                    self.end = position + 1
+                    break
+                self.cut, self.cut_stack = position + 1, tuple(stack)
+                closed.append((self.cut, self.cut_stack))
+        self.scanned = len(self.text)
+        return closed
+
+    def document(self, cut: Optional[int] = None, cut_stack: Tuple[str, ...] = ()) -> Tuple[Optional[str], bool]:
+        """
+        What close_json returns for the text so far, or, given one of feed()'s closing
+        points, for the text up to there.
+        """
+        if cut is not None:
+            return self.text[self.start:cut] + "".join(reversed(cut_stack)), True
+        if self.end is not None:
+            return self.text[self.start:self.end], False
+        if self.cut is None:
+            return None, False
+        return self.text[self.start:self.cut] + "".join(reversed(self.cut_stack)), True
+
+
+def close_json(text: str) -> Tuple[Optional[str], bool]:
+    """
+    The first JSON object in `text` (skipping any code fence or prose before it), and
+    whether it had to be closed. A response that was cut off is cut back to its last
+    complete object or array and its open brackets are closed, so what is left parses.
+    (None, False) when not even one value inside the object is complete.
+    """
+    closer = JsonCloser()
+    closer.feed(text)
+    return closer.document()
+
+
+def validation_summary(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in item['loc']) or 'section'}: {item['msg']}" for item in error.errors())
+
+
+def parse_layout(text: str) -> ParsedLayout:
+    """
+    Parses a layout response, keeping every section that validates and reporting the others
+    as broken. Raises LayoutError when there is no page to keep: no JSON object, no heading
+    or title, or no sections at all.
+    """
+    return parse_document(*close_json(text))
+
+
+def parse_document(document: Optional[str], truncated: bool) -> ParsedLayout:
+    """parse_layout for a response already closed by close_json or a JsonCloser."""
+    if document is None:
+        raise LayoutError("no JSON object in the response")
+    try:
+        data = json.loads(document)
+    except json.JSONDecodeError as exc:
+        raise LayoutError(f"invalid JSON: {exc}") from None
+    if not isinstance(data, dict):
+        raise LayoutError("the response is not a JSON object")
+    raw_sections = data.get("sections")
+    if not isinstance(raw_sections, list) or not raw_sections:
+        raise LayoutError('no "sections" list in the response')
+
+    sections, broken = [], []
+    for position, raw in enumerate(raw_sections):
+        try:
+            sections.append(Section.model_validate(raw))
+        except ValidationError as exc:
+            broken.append(BrokenSection(position, raw, validation_summary(exc)))
+    if truncated and broken and broken[-1].position == len(raw_sections) - 1:
+        # The section the response was cut off in, not one the model got wrong
+        broken.pop()
+    if not sections and not broken:
+        raise LayoutError("the response was cut off before its first section")
+
+    # A missing title or heading is filled in from the other
+    title = data.get("title") if isinstance(data.get("title"), str) and data["title"].strip() else None
+    heading = data.get("heading") if isinstance(data.get("heading"), str) and data["heading"].strip() else None
+    if title is None and heading is None:
+        raise LayoutError("the layout has neither a title nor a heading")
+    # The sections are validated already, one by one
+    layout = PageLayout.model_construct(title=(title or heading)[:200], heading=(heading or title)[:200], sections=sections)
+    return ParsedLayout(layout, broken, truncated)
+
+
+def parse_sections(text: str, count: int) -> List[Optional[Section]]:
+    """
+    The sections of a {"sections": [...]} repair response, validated one by one: `count`
+    entries, None for each that is missing or still invalid.
+    """
+    document, _ = close_json(text)
+    try:
+        data = json.loads(document) if document is not None else None
+    except json.JSONDecodeError:
+        data = None
+    raw_sections = data.get("sections") if isinstance(data, dict) else None
+    if not isinstance(raw_sections, list):
+        return [None] * count
+    sections = []
+    for raw in raw_sections[:count]:
+        try:
+            sections.append(Section.model_validate(raw))
+        except ValidationError:
+            sections.append(None)
+    return sections + [None] * (count - len(sections))
+
+
+def merge_sections(parsed: ParsedLayout, repaired: List[Optional[Section]]) -> PageLayout:
+    """
+    The layout with the repaired sections (in the order of parsed.broken, None for those
+    that could not be repaired) put back where they were.
+    """
+    sections = parsed.layout.sections
+    # The valid sections hold every position that is not broken (a section cut off at the
+    # end of a truncated response has no position of either kind)
+    broken_positions = {item.position for item in parsed.broken}
+    valid_positions = [position for position in range(len(sections) + len(parsed.broken)) if position not in broken_positions]
+    by_position = dict(zip(valid_positions, sections))
+    for item, section in zip(parsed.broken, repaired):
+        if section is not None:
+            by_position[item.position] = section
+        else:
+            logger.warning("Dropping layout section %d, which could not be repaired: %s", item.position, item.errors)
+    if not by_position:
+        raise LayoutError("no section of the layout could be repaired")
+    return parsed.layout.model_copy(update={"sections": [by_position[position] for position in sorted(by_position)]})
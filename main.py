@@ -1,46 +1,173 @@
 
 import asyncio  
 import os
-import json  
-from uuid import uuid4  
-import replicate  
 import logging  
-from extractors import extract_image_descriptions, extract_text_descriptions, replace_image_descriptions, replace_text_descriptions
+from typing import Optional
+from extractors import PlaceholderIndex
+from elements import ElementStatus, ElementTable, restore_element
 from imgen import run_multiple_image_predictions, run_image_prediction, run_multiple_image_refinements
+from pipeline import PagePipeline
+from textgen import TEXT_BATCH_SIZE
+from htmlgeneratorfunc import PROMPT_VERSION, generate_html_content, stream_html_content
+from cache import content_key, get_cache
+from retrieval import index_version
+from themes import themes_version
 
 # Configure logging  
 logging.basicConfig(level=logging.INFO)  
+
+# Finished pages are cached in memory (up to PAGE_CACHE_MEMORY_BYTES) and on disk
+PAGE_CACHE_MEMORY_BYTES = int(os.getenv("PAGE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", 7 * 24 * 3600))
   
-class GraphicElement:  
-    def __init__(self, element_type, description, refined = None, content = None):  
-        self.id = str(uuid4())  
-        self.type = element_type
-        self.description = description  
-        self.content = content
-        self.refined = refined
-  
+async def flesh_out_html_progressively(input_html: str, target_audience: str, stylistic_description: str, content_description: str, format: str):
+    """
+    Yields the page again each time another image or batch of text sections has been
+    placed; the last yield is the finished page. Every image goes through refine -> predict
+    -> replace on its own, and text is expanded in batches alongside, so early content lands
+    while slow images are still being generated.
+    """
+    pipeline = PagePipeline(target_audience, stylistic_description, content_description, format)
+    try:
+        # Process the input HTML content
+        with pipeline.timings.stage("page", "extract"):
+            index = PlaceholderIndex(input_html)
+            table = index.table()
+            text_elements = table.of_kind("text")
+            image_elements = table.of_kind("image")
+        for element in image_elements:
+            pipeline.submit(element)
+        for i in range(0, len(text_elements), TEXT_BATCH_SIZE):
+            pipeline.submit_texts(text_elements[i:i + TEXT_BATCH_SIZE])
 
+        output = input_html
+        async for element in pipeline.results():
+            with pipeline.timings.stage(element.id, "replace"):
+                output = index.fill(table)
+            yield output
+        pipeline.timings.log()
+        if not image_elements and not text_elements:
+            yield output
+    finally:
+        pipeline.cancel()
 
 async def flesh_out_html(input_html: str, target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
-    # Process the input HTML content
-    text_elements = extract_text_descriptions(input_html)
-    image_elements = extract_image_descriptions(input_html)
-    
-    # Refine and generate image elements
-    refined_image_elements = await run_multiple_image_refinements(
-        image_elements,
-        target_audience=target_audience,
-        stylistic_description=stylistic_description,
-        content_description=content_description,
-        format=format
+    output = input_html
+    async for output in flesh_out_html_progressively(input_html, target_audience, stylistic_description, content_description, format):
+        pass
+    return output
+
+def get_page_cache():
+    return get_cache("pages", ttl=PAGE_CACHE_TTL, max_entries=1000, memory_budget=PAGE_CACHE_MEMORY_BYTES)
+
+def page_cache_key(target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
+    return content_key(
+        target_audience, stylistic_description, content_description, format,
+        os.getenv("AZURE_OPENAI_CHAT_COMPLETIONS_DEPLOYMENT_NAME"), PROMPT_VERSION,
+        # Pages are grounded in retrieved materials, so adding materials retires cached pages
+        index_version(),
+        # Pages link to (or embed) their theme, so changing any theme retires them too
+        themes_version()
     )
-    generated_image_elements = await run_multiple_image_predictions(refined_image_elements)
-    
-    # Replace image descriptions with generated image elements
-    output = replace_image_descriptions(input_html, generated_image_elements)
-    
+
+def get_cached_page(target_audience: str, stylistic_description: str, content_description: str, format: str) -> Optional[str]:
+    return get_page_cache().get(page_cache_key(target_audience, stylistic_description, content_description, format))
+
+def cache_page(html: str, target_audience: str, stylistic_description: str, content_description: str, format: str) -> None:
+    # Pages with images or text that failed to generate are not cached, so the next request retries them
+    if len(PlaceholderIndex(html)):
+        logging.info("Not caching page: some placeholders were not filled")
+        return
+    get_page_cache().set(page_cache_key(target_audience, stylistic_description, content_description, format), html)
+
+async def generate_page(target_audience: str, stylistic_description: str, content_description: str, format: str, regenerate: bool = False) -> str:
+    """
+    Layout generation plus flesh_out_html, answered from the page cache for inputs seen before.
+    Pass regenerate=True to ignore the cached page and build (and cache) a fresh one.
+    """
+    if not regenerate:
+        cached = get_cached_page(target_audience, stylistic_description, content_description, format)
+        if cached is not None:
+            return cached
+    html_content = await generate_html_content(target_audience, stylistic_description, content_description, format)
+    if html_content is None:
+        raise ValueError("The model response did not contain an HTML document")
+    output = await flesh_out_html(html_content, target_audience, stylistic_description, content_description, format)
+    cache_page(output, target_audience, stylistic_description, content_description, format)
     return output
 
+async def stream_page(target_audience: str, stylistic_description: str, content_description: str, format: str, regenerate: bool = False, strategy=None, on_element=None, on_layout=None, resume: Optional[dict] = None):
+    """
+    Streaming version of generate_page. Yields ("layout", partial_html) while the layout is
+    being generated, ("image", html) or ("text", html) each time more content has been
+    placed, and finally ("page", html). Each image placeholder enters the pipeline as soon
+    as it has streamed in, and text placeholders as soon as a batch of them has, overlapping
+    with the rest of the layout.
+
+    `strategy` is the prediction completion strategy for images (see prediction_completion.py).
+    `on_element`, if given, is called with each element when its placeholder is found, once
+    an image's prompt is refined and when it has been placed or has failed; `on_layout` with
+    the finished layout. `resume` ({"layout": html, "elements": {id: element_state}}, see
+    jobs.py) continues an interrupted run: the saved layout is reused, finished elements are
+    kept and refined prompts are not refined again.
+    """
+    if not regenerate:
+        cached = get_cached_page(target_audience, stylistic_description, content_description, format)
+        if cached is not None:
+            yield "page", cached
+            return
+
+    resume = resume or {}
+    html_content = resume.get("layout")
+    pipeline = PagePipeline(target_audience, stylistic_description, content_description, format, strategy, on_refined=on_element)
+    text_batch = []
+
+    def start(element, flush: bool = False):
+        if on_element:
+            on_element(element)
+        if element.status == ElementStatus.DONE:
+            return
+        if element.type == "image":
+            pipeline.submit(element)
+            return
+        text_batch.append(element)
+        if len(text_batch) == TEXT_BATCH_SIZE:
+            pipeline.submit_texts(text_batch[:])
+            text_batch.clear()
+
+    try:
+        if html_content is not None:
+            table = PlaceholderIndex(html_content).table()
+            for element in table:
+                start(restore_element(element, resume.get("elements", {}).get(element.id)))
+            yield "layout", html_content
+        else:
+            table = ElementTable()
+            async for html_content, placeholders in stream_html_content(target_audience, stylistic_description, content_description, format):
+                for placeholder in placeholders:
+                    start(table.add_placeholder(placeholder))
+                yield "layout", html_content
+            if html_content is None:
+                raise ValueError("The model response did not contain an HTML document")
+            if on_layout:
+                on_layout(html_content)
+        pipeline.submit_texts(text_batch)
+
+        # The streamed placeholders were numbered in document order, like the final index
+        index = PlaceholderIndex(html_content)
+        output = index.fill(table)
+        async for element in pipeline.results():
+            with pipeline.timings.stage(element.id, "replace"):
+                output = index.fill(table)
+            if on_element:
+                on_element(element)
+            yield element.type, output
+        pipeline.timings.log()
+    finally:
+        pipeline.cancel()
+    cache_page(output, target_audience, stylistic_description, content_description, format)
+    yield "page", output
+
 
 
 
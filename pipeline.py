@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, List, Tuple
+
+from imgen import refine_image_description, run_image_prediction
+from textgen import run_text_expansions
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimings:
+    """Records when each element entered and left each stage, to measure how much they overlap."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.spans: List[Tuple[str, str, float, float]] = []
+
+    @contextmanager
+    def stage(self, element_id: str, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans.append((element_id, name, start - self.started, time.monotonic() - self.started))
+
+    def summary(self) -> Dict[str, dict]:
+        stages = {}
+        for _, name, start, end in self.spans:
+            stage = stages.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "first_done": end, "last_done": end})
+            stage["count"] += 1
+            stage["total"] += end - start
+            stage["max"] = max(stage["max"], end - start)
+            stage["first_done"] = min(stage["first_done"], end)
+            stage["last_done"] = max(stage["last_done"], end)
+        return stages
+
+    def log(self) -> None:
+        wall = time.monotonic() - self.started
+        busy = sum(end - start for _, _, start, end in self.spans)
+        for name, stage in self.summary().items():
+            logger.info(
+                "stage %-8s n=%d mean=%.2fs max=%.2fs first done at %.2fs, last at %.2fs",
+                name, stage["count"], stage["total"] / stage["count"], stage["max"], stage["first_done"], stage["last_done"]
+            )
+        # Above 1.0, stages of different elements ran at the same time
+        logger.info("pipeline wall=%.2fs, stage time=%.2fs, overlap=%.1fx", wall, busy, busy / wall if wall else 0.0)
+
+
+class PagePipeline:
+    """
+    Runs each image element through refine -> predict on its own, as soon as it is submitted,
+    and each batch of text elements through one expansion request, concurrently with the
+    images. Finished elements are handed out through a queue in completion order, so one slow
+    image no longer holds back the others and callers can place content as it lands.
+
+    Images that already have a refined prompt (e.g. restored from a checkpoint) skip straight
+    to prediction; `on_refined` is called with each image once its prompt has been refined.
+    """
+
+    def __init__(self, target_audience: str, stylistic_description: str, content_description: str, format: str, strategy=None, on_refined=None):
+        self.context = (target_audience, stylistic_description, content_description, format)
+        self.strategy = strategy
+        self.on_refined = on_refined
+        self.timings = StageTimings()
+        self.completed = asyncio.Queue()
+        self.tasks = []
+        self.expected = 0
+
+    def submit(self, element) -> None:
+        self.expected += 1
+        self.tasks.append(asyncio.create_task(self._run(element)))
+
+    def submit_texts(self, elements) -> None:
+        """Expands a batch of text elements together (see textgen.run_text_expansions)."""
+        if not elements:
+            return
+        self.expected += len(elements)
+        self.tasks.append(asyncio.create_task(self._run_texts(list(elements))))
+
+    async def _run(self, element) -> None:
+        try:
+            if element.refined is None:
+                with self.timings.stage(element.id, "refine"):
+                    await refine_image_description(element, *self.context)
+                if self.on_refined:
+                    self.on_refined(element)
+            with self.timings.stage(element.id, "predict"):
+                await run_image_prediction(element, self.strategy)
+        finally:
+            await self.completed.put(element)
+
+    async def _run_texts(self, elements) -> None:
+        try:
+            with self.timings.stage(elements[0].id, "text"):
+                await run_text_expansions(elements, *self.context)
+        finally:
+            for element in elements:
+                await self.completed.put(element)
+
+    async def results(self) -> AsyncIterator:
+        """Yields every submitted element once it is done, in the order they finish."""
+        for _ in range(self.expected):
+            yield await self.completed.get()
+
+    def cancel(self) -> None:
+        for task in self.tasks:
+            task.cancel()
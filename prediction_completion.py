@@ -0,0 +1,207 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+TERMINAL_STATUSES = ["succeeded", "failed", "canceled"]
+
+GetPrediction = Callable[[str], Awaitable[dict]]
+OnUpdate = Optional[Callable[[dict], None]]
+
+
+class PredictionMetrics:
+    """Counts status polls and records how long each prediction took to be seen as done."""
+
+    def __init__(self):
+        self.polls = 0
+        self.latencies: List[float] = []
+
+    def record(self, polls: int, latency: float) -> None:
+        self.polls += polls
+        self.latencies.append(latency)
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def summary(self) -> dict:
+        return {
+            "predictions": len(self.latencies),
+            "polls": self.polls,
+            "p50_latency": self.percentile(50),
+            "p95_latency": self.percentile(95),
+            "max_latency": max(self.latencies, default=0.0),
+        }
+
+
+class FixedIntervalPolling:
+    """Polls every `interval` seconds. This was the original behaviour of run_image_prediction."""
+
+    def __init__(self, interval: float = 2.0):
+        self.interval = interval
+        self.metrics = PredictionMetrics()
+
+    def create_params(self) -> dict:
+        return {}
+
+    async def wait(self, prediction: dict, get_prediction: GetPrediction, on_update: OnUpdate = None) -> dict:
+        start = time.monotonic()
+        polls = 0
+        while prediction["status"] not in TERMINAL_STATUSES:
+            await asyncio.sleep(self.interval)
+            prediction = await get_prediction(prediction["id"])
+            polls += 1
+            if on_update:
+                on_update(prediction)
+        self.metrics.record(polls, time.monotonic() - start)
+        return prediction
+
+
+class AdaptivePolling:
+    """
+    Polls quickly at first and backs off geometrically up to `max_delay`.
+
+    The typical runtime of each model is learned from completed predictions (an exponential
+    moving average), so later predictions sleep through the first `lead` fraction of the
+    expected runtime and then poll every `late_delay` of it, backing off by `late_factor`:
+    spacing scaled to the runtime spreads the few polls over where it usually finishes,
+    where the fixed initial_delay would spend most of them in the first second.
+    """
+
+    def __init__(self, initial_delay: float = 0.25, max_delay: float = 2.0, factor: float = 2.0, smoothing: float = 0.3, lead: float = 0.85,
+                 late_delay: float = 0.15, late_factor: float = 1.3):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.smoothing = smoothing
+        self.lead = lead
+        self.late_delay = late_delay
+        self.late_factor = late_factor
+        self.typical_runtime: Dict[str, float] = {}
+        self.metrics = PredictionMetrics()
+
+    def create_params(self) -> dict:
+        return {}
+
+    def observe_runtime(self, model: str, runtime: float) -> None:
+        previous = self.typical_runtime.get(model)
+        if previous is None:
+            self.typical_runtime[model] = runtime
+        else:
+            self.typical_runtime[model] = (1 - self.smoothing) * previous + self.smoothing * runtime
+
+    async def wait(self, prediction: dict, get_prediction: GetPrediction, on_update: OnUpdate = None) -> dict:
+        model = prediction.get("model", "")
+        expected = self.typical_runtime.get(model)
+        start = time.monotonic()
+        delay = min(self.late_delay * expected, self.max_delay) if expected else self.initial_delay
+        factor = self.late_factor if expected else self.factor
+        polls = 0
+        last_pending = 0.0
+        while prediction["status"] not in TERMINAL_STATUSES:
+            elapsed = time.monotonic() - start
+            last_pending = elapsed
+            if expected and elapsed < self.lead * expected:
+                # Nothing to gain from polling well before the model usually finishes
+                await asyncio.sleep(self.lead * expected - elapsed)
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * factor, self.max_delay)
+            prediction = await get_prediction(prediction["id"])
+            polls += 1
+            if on_update:
+                on_update(prediction)
+        latency = time.monotonic() - start
+        if prediction["status"] == "succeeded":
+            # Prefer Replicate's own timing; otherwise the prediction finished somewhere
+            # between the last pending poll and the one that saw it done
+            predict_time = (prediction.get("metrics") or {}).get("predict_time")
+            self.observe_runtime(model, predict_time or (last_pending + latency) / 2)
+        self.metrics.record(polls, latency)
+        return prediction
+
+
+class WebhookCompletion:
+    """
+    Resolves predictions from Replicate's completion webhook instead of polling.
+
+    create_params() asks Replicate to POST the finished prediction to `webhook_url`; the
+    receiver (see apis.py) hands the payload to resolve(), which wakes the waiting coroutine.
+    If no webhook arrives within `fallback_after` seconds, waiting falls back to `fallback`
+    polling so a lost delivery cannot hang the page.
+
+    Payloads nobody is waiting for are kept for `early_ttl` seconds, at most `early_limit`
+    of them: most are webhooks that arrive after the fallback, or for predictions another
+    process started, and are never collected.
+    """
+
+    def __init__(self, webhook_url: str, secret: Optional[str] = None, fallback_after: float = 60.0, fallback=None,
+                 early_ttl: float = 120.0, early_limit: int = 1024):
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self.fallback_after = fallback_after
+        self.fallback = fallback or AdaptivePolling()
+        self.early_ttl = early_ttl
+        self.early_limit = early_limit
+        self.metrics = PredictionMetrics()
+        self._waiters: Dict[str, asyncio.Future] = {}
+        # Webhooks can beat the create response back to us, so early payloads are kept here
+        # with the time they arrived, oldest first
+        self._early: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+    def create_params(self) -> dict:
+        return {"webhook": self.webhook_url, "webhook_events_filter": ["completed"]}
+
+    def verify(self, headers, body: bytes) -> bool:
+        """Checks Replicate's webhook signature. Always passes when no secret is configured."""
+        if not self.secret:
+            return True
+        webhook_id = headers.get("webhook-id", "")
+        timestamp = headers.get("webhook-timestamp", "")
+        signatures = headers.get("webhook-signature", "")
+        key = base64.b64decode(self.secret.split("_", 1)[-1])
+        signed = f"{webhook_id}.{timestamp}.".encode() + body
+        expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+        return any(hmac.compare_digest(expected, signature.split(",", 1)[-1]) for signature in signatures.split())
+
+    def resolve(self, prediction: dict) -> None:
+        if prediction.get("status") not in TERMINAL_STATUSES:
+            return
+        future = self._waiters.pop(prediction["id"], None)
+        if future is None:
+            self._expire_early()
+            self._early[prediction["id"]] = (time.monotonic(), prediction)
+            self._early.move_to_end(prediction["id"])
+            while len(self._early) > self.early_limit:
+                self._early.popitem(last=False)
+        elif not future.done():
+            future.set_result(prediction)
+
+    def _expire_early(self) -> None:
+        cutoff = time.monotonic() - self.early_ttl
+        while self._early and next(iter(self._early.values()))[0] < cutoff:
+            self._early.popitem(last=False)
+
+    async def wait(self, prediction: dict, get_prediction: GetPrediction, on_update: OnUpdate = None) -> dict:
+        start = time.monotonic()
+        prediction_id = prediction["id"]
+        if prediction["status"] not in TERMINAL_STATUSES:
+            self._expire_early()
+            if prediction_id in self._early:
+                prediction = self._early.pop(prediction_id)[1]
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self._waiters[prediction_id] = future
+                try:
+                    prediction = await asyncio.wait_for(future, timeout=self.fallback_after)
+                except asyncio.TimeoutError:
+                    self._waiters.pop(prediction_id, None)
+                    prediction = await self.fallback.wait(prediction, get_prediction, on_update)
+        self.metrics.record(0, time.monotonic() - start)
+        return prediction
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import backoff
+
+from sdk import loaded_types
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# 429 is not among them: requests are sent through scheduler.run_rate_limited, which waits
+# out throttling itself, so retrying it here as well would multiply the attempts
+RETRYABLE_STATUS_CODES = {408, 409, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """Raised for failures worth another attempt, e.g. a prediction that ended as "failed"."""
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (RetryableError, asyncio.TimeoutError)):
+        return True
+    # Connection failures of whichever client raised; SDKs not imported yet raised nothing
+    if isinstance(exc, loaded_types("httpx:TransportError", "openai:APIConnectionError")):
+        return True
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def log_retry(details: dict) -> None:
+    logger.warning("Attempt %d failed, retrying in %.1fs: %r", details["tries"], details["wait"], details["exception"])
+
+
+async def retry_call(call: Callable[[], Awaitable[T]], max_tries: int = 3, max_time: Optional[float] = None) -> T:
+    """
+    Runs `call` with jittered exponential backoff between attempts. Gives up straight away on
+    errors that will not go away by retrying (4xx other than 408/409), and on 429s, which
+    reach it only once scheduler.run_rate_limited has given up on them.
+    """
+    @backoff.on_exception(
+        backoff.expo,
+        Exception,
+        max_tries=max_tries,
+        max_time=max_time,
+        giveup=lambda exc: not is_retryable(exc),
+        jitter=backoff.full_jitter,
+        on_backoff=log_retry,
+        logger=None,
+    )
+    async def attempt():
+        return await call()
+
+    return await attempt()
+
+
+async def with_deadline(awaitable: Awaitable[T], timeout: Optional[float]) -> T:
+    """Cancels `awaitable` and raises asyncio.TimeoutError if it runs past `timeout` seconds."""
+    return await asyncio.wait_for(awaitable, timeout)
+
+
+async def hedged(call: Callable[[], Awaitable[T]], hedge_after: Optional[float], max_hedges: int = 1,
+                 started: Optional[asyncio.Event] = None) -> T:
+    """
+    Starts `call`, and if it has not finished after `hedge_after` seconds starts a duplicate
+    (up to `max_hedges` of them). The first success wins and the others are cancelled.
+    With `started`, the seconds count from when the event is set instead, e.g. once the
+    call is past a queue. With `hedge_after=None` this is just `await call()`.
+    """
+    if hedge_after is None:
+        return await call()
+    tasks = [asyncio.ensure_future(call())]
+    launched = 1
+    error = None
+    try:
+        if started is not None:
+            waiter = asyncio.ensure_future(started.wait())
+            try:
+                await asyncio.wait([tasks[0], waiter], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+        while tasks:
+            timeout = hedge_after if launched <= max_hedges else None
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info("Hedging a request still running after %.1fs", hedge_after * launched)
+                tasks.append(asyncio.ensure_future(call()))
+                launched += 1
+                continue
+            for task in done:
+                tasks.remove(task)
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class LatencyTracker:
+    """Keeps recent successful call durations to decide when a request is unusually slow."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def record(self, duration: float) -> None:
+        self.samples.append(duration)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
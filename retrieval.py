@@ -0,0 +1,380 @@
+import asyncio
+import base64
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from typing import List, NamedTuple, Sequence, Tuple
+
+from cache import content_key, get_cache
+from sdk import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Past education materials are embedded and kept in a vector index; generate_html_content
+# puts the RETRIEVAL_TOP_K closest ones into the layout prompt. RETRIEVAL_BACKEND=local keeps
+# the index in RETRIEVAL_INDEX_DIR (see LocalVectorIndex), =azure_search queries the
+# SEARCH_INDEX_NAME index of Azure AI Search instead, and =off disables retrieval.
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "local")
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", os.path.join(".cache", "retrieval"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 3))
+# Materials less similar than this (cosine) to the request are left out of the prompt
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", 0.3))
+# Upper bound on the reference text added to the prompt, in characters
+RETRIEVAL_CONTEXT_CHARS = int(os.getenv("RETRIEVAL_CONTEXT_CHARS", 4000))
+# Below this many materials a brute-force scan is exact and already fast; above it the local
+# index also keeps an HNSW graph (needs the hnswlib package)
+RETRIEVAL_HNSW_THRESHOLD = int(os.getenv("RETRIEVAL_HNSW_THRESHOLD", 20000))
+RETRIEVAL_HNSW_EF = int(os.getenv("RETRIEVAL_HNSW_EF", 64))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 30 * 24 * 3600))
+# Ingested chunks share the embedding cache with queries (see ingest.py), so it holds more
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 100000))
+# Field names of the Azure AI Search index
+AZURE_SEARCH_VECTOR_FIELD = os.getenv("AZURE_SEARCH_VECTOR_FIELD", "content_vector")
+AZURE_SEARCH_TITLE_FIELD = os.getenv("AZURE_SEARCH_TITLE_FIELD", "title")
+AZURE_SEARCH_CONTENT_FIELD = os.getenv("AZURE_SEARCH_CONTENT_FIELD", "content")
+AZURE_SEARCH_SOURCE_FIELD = os.getenv("AZURE_SEARCH_SOURCE_FIELD", "source")
+
+
+class Document(NamedTuple):
+    """A past education material, or a chunk of one."""
+    id: str
+    title: str
+    text: str
+    source: str = ""
+
+
+def normalize(vectors):
+    """L2-normalises rows, so a dot product is the cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class LocalVectorIndex:
+    """
+    Vectors and documents in plain files under `directory`, memory-mapped rather than loaded:
+      vectors.f32        N x D float32 rows, L2-normalised
+      documents.jsonl    one Document per line
+      documents.offsets  N + 1 int64 byte offsets into documents.jsonl
+      hnsw.bin           HNSW graph over the rows once N reaches `hnsw_threshold` (this one
+                         is read into memory by hnswlib)
+      meta.json          dimensions and row counts; written last, so readers see whole rows
+    Search is a brute-force matrix-vector product up to `hnsw_threshold` rows and an HNSW
+    query above it. Other processes pick up rows added here on their next search.
+    """
+
+    def __init__(self, directory: str = RETRIEVAL_INDEX_DIR, hnsw_threshold: int = RETRIEVAL_HNSW_THRESHOLD, ef: int = RETRIEVAL_HNSW_EF):
+        self.directory = directory
+        self.hnsw_threshold = hnsw_threshold
+        self.ef = ef
+        self.lock = threading.Lock()
+        self.meta = {"dimensions": None, "count": 0, "hnsw_count": 0}
+        self.meta_mtime = None
+        self.vectors = None
+        self.offsets = None
+        self.documents = None
+        self.hnsw = None
+        # Ids of rows 0..len(self.ids_rows) seen so far, filled in by __contains__
+        self.ids = set()
+        self.ids_rows = 0
+        self._refresh()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _refresh(self) -> None:
+        """(Re)maps the files if meta.json changed since they were last mapped."""
+        try:
+            stat = os.stat(self._path("meta.json"))
+        except FileNotFoundError:
+            return
+        # meta.json is replaced, never edited, so a new inode also marks a change
+        mtime = (stat.st_mtime_ns, stat.st_ino)
+        if mtime == self.meta_mtime:
+            return
+        with self.lock:
+            with open(self._path("meta.json")) as file:
+                meta = json.load(file)
+            count, dimensions = meta["count"], meta["dimensions"]
+            self.vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r", shape=(count, dimensions)) if count else None
+            self.offsets = np.memmap(self._path("documents.offsets"), dtype=np.int64, mode="r", shape=(count + 1,)) if count else None
+            if count:
+                with open(self._path("documents.jsonl"), "rb") as file:
+                    self.documents = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.hnsw = self._load_hnsw(meta) if meta.get("hnsw_count") else None
+            self.meta, self.meta_mtime = meta, mtime
+
+    def _load_hnsw(self, meta: dict):
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning("hnswlib is not installed, searching %d vectors by brute force", meta["count"])
+            return None
+        index = hnswlib.Index(space="ip", dim=meta["dimensions"])
+        index.load_index(self._path("hnsw.bin"), max_elements=meta["hnsw_count"])
+        index.set_ef(max(self.ef, RETRIEVAL_TOP_K))
+        return index
+
+    def __len__(self) -> int:
+        self._refresh()
+        return self.meta["count"]
+
+    @property
+    def version(self) -> str:
+        """Changes whenever documents are added, for keys of caches built from search results."""
+        self._refresh()
+        return f"local:{self.meta['count']}"
+
+    def __contains__(self, document_id: str) -> bool:
+        self._refresh()
+        with self.lock:
+            for row in range(self.ids_rows, self.meta["count"]):
+                self.ids.add(self.document(row).id)
+            self.ids_rows = max(self.ids_rows, self.meta["count"])
+        return document_id in self.ids
+
+    def document(self, row: int) -> Document:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return Document(**json.loads(self.documents[start:end]))
+
+    def search(self, vector: Sequence[float], k: int = RETRIEVAL_TOP_K) -> List[Tuple[Document, float]]:
+        """The `k` documents closest to `vector` by cosine similarity, best first."""
+        self._refresh()
+        count = self.meta["count"]
+        if not count:
+            return []
+        k = min(k, count)
+        query = normalize(vector)
+        if self.hnsw is not None and self.meta["hnsw_count"] == count:
+            labels, distances = self.hnsw.knn_query(query, k=k)
+            # Inner-product space: distance = 1 - similarity
+            hits = zip(labels[0].tolist(), (1.0 - distances[0]).tolist())
+        else:
+            scores = self.vectors @ query
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            hits = zip(top.tolist(), scores[top].tolist())
+        return [(self.document(row), score) for row, score in hits]
+
+    def add(self, documents: Sequence[Document], vectors) -> None:
+        """Appends documents with their embeddings; one process should write at a time."""
+        if len(documents) != len(vectors):
+            raise ValueError(f"{len(documents)} documents but {len(vectors)} vectors")
+        if not len(documents):
+            return
+        vectors = normalize(vectors)
+        self._refresh()
+        meta = dict(self.meta)
+        if meta["dimensions"] is None:
+            meta["dimensions"] = int(vectors.shape[1])
+        elif vectors.shape[1] != meta["dimensions"]:
+            raise ValueError(f"the index holds {meta['dimensions']}-dimensional vectors, got {vectors.shape[1]}")
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Rows past meta.json's count are left over from an interrupted add(): cut them off
+        count = meta["count"]
+        position = int(self.offsets[-1]) if count else 0
+        offsets = [] if count else [position]
+        with open(self._path("documents.jsonl"), "ab") as file:
+            file.truncate(position)
+            for document in documents:
+                position += file.write(json.dumps(document._asdict()).encode() + b"\n")
+                offsets.append(position)
+        with open(self._path("documents.offsets"), "ab") as file:
+            file.truncate(8 * (count + 1) if count else 0)
+            file.write(np.asarray(offsets, dtype=np.int64).tobytes())
+        with open(self._path("vectors.f32"), "ab") as file:
+            file.truncate(4 * count * meta["dimensions"])
+            file.write(vectors.tobytes())
+        meta["count"] = count + len(documents)
+        if meta["count"] >= self.hnsw_threshold:
+            meta["hnsw_count"] = self._update_hnsw(meta, count, vectors)
+
+        temporary = self._path("meta.json.tmp")
+        with open(temporary, "w") as file:
+            json.dump(meta, file)
+        os.replace(temporary, self._path("meta.json"))
+        self.meta_mtime = None
+        self._refresh()
+
+    def _update_hnsw(self, meta: dict, start: int, vectors) -> int:
+        """Adds rows start.. to the HNSW graph (building it from every row the first time)."""
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning("hnswlib is not installed, so the index will be searched by brute force")
+            return 0
+        total = meta["count"]
+        if meta.get("hnsw_count"):
+            index = hnswlib.Index(space="ip", dim=meta["dimensions"])
+            index.load_index(self._path("hnsw.bin"), max_elements=total)
+            index.resize_index(total)
+            index.add_items(vectors, np.arange(start, total))
+        else:
+            index = hnswlib.Index(space="ip", dim=meta["dimensions"])
+            index.init_index(max_elements=total, ef_construction=200, M=16)
+            all_vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r", shape=(total, meta["dimensions"]))
+            index.add_items(all_vectors, np.arange(total))
+        index.save_index(self._path("hnsw.bin"))
+        return total
+
+
+class AzureSearchIndex:
+    """The SEARCH_INDEX_NAME index of Azure AI Search, queried by vector. Needs azure-search-documents."""
+
+    def __init__(self):
+        try:
+            from azure.core.credentials import AzureKeyCredential
+            from azure.search.documents import SearchClient
+        except ImportError as exc:
+            raise ImportError("RETRIEVAL_BACKEND=azure_search needs the azure-search-documents package: pip install azure-search-documents") from exc
+        from htmlgenerator import load_settings
+
+        settings = load_settings()
+        self.client = SearchClient(settings.azure_search_service_endpoint, settings.search_index_name, AzureKeyCredential(settings.azure_search_service_admin_key))
+        self.version = f"azure_search:{settings.search_index_name}"
+
+    def __len__(self) -> int:
+        return self.client.get_document_count()
+
+    def __contains__(self, document_id: str) -> bool:
+        from sdk import azure_exceptions
+
+        try:
+            self.client.get_document(key=document_id, selected_fields=["id"])
+        except azure_exceptions.ResourceNotFoundError:
+            return False
+        return True
+
+    def search(self, vector: Sequence[float], k: int = RETRIEVAL_TOP_K) -> List[Tuple[Document, float]]:
+        from azure.search.documents.models import VectorizedQuery
+
+        results = self.client.search(
+            search_text=None,
+            vector_queries=[VectorizedQuery(vector=list(vector), k_nearest_neighbors=k, fields=AZURE_SEARCH_VECTOR_FIELD)],
+            top=k,
+        )
+        return [
+            (Document(str(result["id"]), result.get(AZURE_SEARCH_TITLE_FIELD) or "", result.get(AZURE_SEARCH_CONTENT_FIELD) or "", result.get(AZURE_SEARCH_SOURCE_FIELD) or ""), result["@search.score"])
+            for result in results
+        ]
+
+    def add(self, documents: Sequence[Document], vectors) -> None:
+        self.client.upload_documents([
+            {
+                "id": document.id,
+                AZURE_SEARCH_TITLE_FIELD: document.title,
+                AZURE_SEARCH_CONTENT_FIELD: document.text,
+                AZURE_SEARCH_SOURCE_FIELD: document.source,
+                AZURE_SEARCH_VECTOR_FIELD: [float(value) for value in vector],
+            }
+            for document, vector in zip(documents, vectors)
+        ])
+
+
+_vector_index = None
+_vector_index_lock = threading.Lock()
+
+
+def get_vector_index():
+    """Returns the process-wide index for RETRIEVAL_BACKEND, or None when retrieval is off."""
+    global _vector_index
+    if RETRIEVAL_BACKEND == "off":
+        return None
+    with _vector_index_lock:
+        if _vector_index is None:
+            _vector_index = AzureSearchIndex() if RETRIEVAL_BACKEND == "azure_search" else LocalVectorIndex()
+        return _vector_index
+
+
+def index_version() -> str:
+    """Identifies the materials retrieval can currently draw on (see main.page_cache_key)."""
+    if RETRIEVAL_BACKEND == "off":
+        return "off"
+    if RETRIEVAL_BACKEND == "local" and not os.path.exists(os.path.join(RETRIEVAL_INDEX_DIR, "meta.json")):
+        return "local:0"
+    try:
+        return get_vector_index().version
+    except Exception as exc:
+        # As in retrieve: the page is generated without reference materials, and cached
+        # apart from the pages that had them
+        logger.warning("Retrieval index unavailable, generating without reference materials: %r", exc)
+        return "unavailable"
+
+
+async def embed_texts(texts: Sequence[str]) -> List[List[float]]:
+    """
+    Embeds texts with one request for those not embedded before; the rest, and repeats
+    within `texts`, are answered from the cache.
+    """
+    from utils import request_embeddings
+
+    embedding_cache = get_cache("embeddings", ttl=QUERY_EMBEDDING_CACHE_TTL, max_entries=EMBEDDING_CACHE_MAX_ENTRIES)
+    model = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL"), os.getenv("EMBEDDING_VECTOR_DIMENSIONS")
+    keys = [content_key(*model, "float32", text) for text in texts]
+    vectors = {}
+    for key in dict.fromkeys(keys):
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            vectors[key] = np.frombuffer(base64.b64decode(cached), dtype=np.float32).tolist()
+    missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+    if missing:
+        fetched = dict(zip(missing, await request_embeddings(list(missing.values()))))
+        # Stored as base64 float32, a quarter the size of JSON and far quicker to write
+        embedding_cache.set_many({
+            key: base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+            for key, vector in fetched.items()
+        })
+        vectors.update(fetched)
+    return [vectors[key] for key in keys]
+
+
+async def embed_query(text: str) -> List[float]:
+    """Embeds a search query; repeated queries are answered from the cache."""
+    [vector] = await embed_texts([text])
+    return vector
+
+
+def materials_query(target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
+    return f"{format} for {target_audience} about {content_description} ({stylistic_description})"
+
+
+async def find_reference_materials(target_audience: str, stylistic_description: str, content_description: str, format: str, k: int = RETRIEVAL_TOP_K) -> List[Document]:
+    """
+    The past materials most relevant to a page request. Retrieval only adds context, so an
+    empty index, a disabled backend or any failure gives an empty list rather than an error.
+    """
+    try:
+        index = get_vector_index()
+        if index is None or (isinstance(index, LocalVectorIndex) and not len(index)):
+            return []
+        vector = await embed_query(materials_query(target_audience, stylistic_description, content_description, format))
+        start = time.perf_counter()
+        if isinstance(index, LocalVectorIndex):
+            hits = index.search(vector, k)
+        else:
+            hits = await asyncio.to_thread(index.search, vector, k)
+        elapsed = time.perf_counter() - start
+    except Exception as exc:
+        logger.warning("Retrieval failed, generating without reference materials: %r", exc)
+        return []
+    documents = [document for document, score in hits if score >= RETRIEVAL_MIN_SCORE]
+    logger.info("Retrieved %d of %d reference materials in %.2f ms", len(documents), len(hits), elapsed * 1000)
+    return documents
+
+
+def format_references(documents: Sequence[Document], max_chars: int = RETRIEVAL_CONTEXT_CHARS) -> str:
+    """The documents as a numbered list for the prompt, cut off at `max_chars` in total."""
+    parts: List[str] = []
+    remaining = max_chars
+    for number, document in enumerate(documents, start=1):
+        header = f"[{number}] {document.title}".strip() + "\n"
+        if remaining <= len(header):
+            break
+        text = document.text[:remaining - len(header)]
+        parts.append(header + text)
+        remaining -= len(header) + len(text)
+    return "\n\n".join(parts)
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """
+    Refills `capacity` units per minute. Callers reserve units up front and sleep off any
+    debt, so the reservation itself never awaits and cannot race with other coroutines.
+    A threading lock keeps the bucket consistent across event loops in different threads.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` units and returns how long the caller must wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ConcurrencyLimit:
+    """A semaphore that works across event loops, e.g. one per Streamlit script-run thread."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.lock = threading.Lock()
+        self.waiters = deque()
+
+    async def acquire(self) -> None:
+        with self.lock:
+            if self.active < self.limit:
+                self.active += 1
+                return
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                if (loop, future) in self.waiters:
+                    self.waiters.remove((loop, future))
+                    raise
+            # The slot was handed to us just before we were cancelled, so pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self.lock:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                if not loop.is_closed():
+                    # The slot moves straight to the waiter, so `active` is unchanged
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+            self.active -= 1
+
+    def _grant(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class RateLimiter:
+    """
+    Per-backend limits: requests/min, tokens/min and in-flight concurrency, each optional.
+    When the backend answers 429, backoff() pauses every caller until Retry-After has passed,
+    so one throttled request slows the whole pipeline down instead of each task hammering on.
+    """
+
+    def __init__(self, name: str, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None, max_concurrency: Optional[int] = None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency_limit = ConcurrencyLimit(max_concurrency) if max_concurrency else None
+        self.paused_until = 0.0
+        self.throttled = 0
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Waits until one more request (costing `tokens` tokens) fits within the limits."""
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        wait = 0.0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    @asynccontextmanager
+    async def concurrency(self):
+        """Holds one of the backend's concurrent slots for the duration of the block."""
+        if self.concurrency_limit is None:
+            yield
+            return
+        await self.concurrency_limit.acquire()
+        try:
+            yield
+        finally:
+            self.concurrency_limit.release()
+
+    def backoff(self, retry_after: float) -> None:
+        self.throttled += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+
+def retry_after_seconds(response, default: float = 1.0) -> float:
+    """Reads retry-after-ms / Retry-After (seconds or HTTP date) from a throttled response."""
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return default
+
+
+def is_rate_limited(exc: Exception) -> bool:
+    # Both openai.APIStatusError and httpx.HTTPStatusError carry the failed response
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+
+async def run_rate_limited(limiter: RateLimiter, call: Callable[[], Awaitable[T]], tokens: int = 0, max_attempts: int = 6) -> T:
+    """Runs `call` within `limiter`, waiting out 429 responses up to `max_attempts` times."""
+    for attempt in range(1, max_attempts + 1):
+        await limiter.acquire(tokens)
+        try:
+            return await call()
+        except Exception as exc:
+            if not is_rate_limited(exc) or attempt == max_attempts:
+                raise
+            # A little jitter stops every paused task from retrying in the same instant
+            limiter.backoff(retry_after_seconds(exc.response) + random.uniform(0, 0.25))
+
+
+# Defaults match a standard Azure OpenAI GPT-4o deployment (30K TPM / 180 RPM) and
+# Replicate's documented prediction-creation limit; override them per deployment via env.
+_LIMITER_SETTINGS = {
+    "azure_openai": lambda: RateLimiter(
+        "azure_openai",
+        requests_per_minute=float(os.getenv("AZURE_OPENAI_RPM", 180)),
+        tokens_per_minute=float(os.getenv("AZURE_OPENAI_TPM", 30000)),
+    ),
+    # Embedding deployments have a quota of their own (120K TPM / 720 RPM by default)
+    "azure_openai_embeddings": lambda: RateLimiter(
+        "azure_openai_embeddings",
+        requests_per_minute=float(os.getenv("AZURE_OPENAI_EMBEDDING_RPM", 720)),
+        tokens_per_minute=float(os.getenv("AZURE_OPENAI_EMBEDDING_TPM", 120000)),
+    ),
+    "replicate": lambda: RateLimiter(
+        "replicate",
+        requests_per_minute=float(os.getenv("REPLICATE_RPM", 600)),
+        max_concurrency=int(os.getenv("REPLICATE_MAX_CONCURRENT_PREDICTIONS", 8)),
+    ),
+}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str) -> RateLimiter:
+    """Returns the process-wide limiter for a backend ("azure_openai", "azure_openai_embeddings" or "replicate")."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = _LIMITER_SETTINGS[name]()
+        return _limiters[name]
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
@@ -0,0 +1,60 @@
+# Lazy handles to the heavy third-party SDKs. `from sdk import openai` costs nothing; the real
+# package is imported the first time one of its attributes is used. Each process therefore
+# loads only the SDKs of the stages it actually runs: an API server that hands all jobs to
+# worker.py processes never imports openai, and a session that is only waiting on a job
+# never imports the Azure Blob Storage SDK.
+import importlib
+import sys
+import threading
+from typing import Optional
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute: str, value):
+        # Module-level settings such as openai.api_key have to land on the real module
+        if attribute in ("_name", "_module", "_lock"):
+            object.__setattr__(self, attribute, value)
+        else:
+            setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+openai = LazyModule("openai")
+httpx = LazyModule("httpx")
+azure_blob = LazyModule("azure.storage.blob")
+azure_exceptions = LazyModule("azure.core.exceptions")
+numpy = LazyModule("numpy")
+
+
+def loaded(module: str, attribute: str) -> Optional[object]:
+    """
+    `module.attribute` if the module has already been imported, else None. For isinstance
+    checks against SDK exception types: an SDK that was never imported cannot have raised.
+    """
+    return getattr(sys.modules.get(module), attribute, None)
+
+
+def loaded_types(*names: str) -> tuple:
+    """The already-imported classes among "module:Class" names, as an isinstance tuple."""
+    types = (loaded(*name.split(":")) for name in names)
+    return tuple(cls for cls in types if cls is not None)
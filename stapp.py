@@ -1,8 +1,27 @@
 import streamlit as st
 import asyncio
-from htmlgeneratorfunc import generate_html_content
-from main import flesh_out_html
+import atexit
+import time
+from contextlib import aclosing
+from contextlib import aclosing
+from jobs import JOB_POLL_INTERVAL, JobStatus, NotRegenerable, create_regeneration_job, job_elements, run_job, worker_name
+from jobstore import get_job_store
+from themes import publish_themes
+from utils import aclose_async_services, close_services
+
+@st.cache_resource
+def start_process():
+    """
+    Set-up done once per server process, as apis.py's lifespan does, rather than on every
+    script run: Streamlit reruns this whole script on each interaction.
+    """
+    # Streamlit has no shutdown hook of its own, so release pooled clients at interpreter exit
+    atexit.register(close_services)
+    # Pages link to the theme stylesheets, which Streamlit serves from ./static
+    publish_themes()
+
 async def main():
+    start_process()
     st.title("Preventive Drug Education Material Generator")
     st.image("https://img.freepik.com/premium-vector/cute-octopus-artist-painting-cartoon-vector-icon-illustration-animal-education-icon-isolated-flat_138676-6683.jpg?w=360")
     st.write("Hello! I'm Inky, your friendly preventive drug education material generator. I can help you generate content for your educational materials, based on the materials you uploaded. Just fill out the form below and I'll do the rest!")    
@@ -12,29 +31,107 @@ async def main():
     content_description = st.text_input("Content Description", "type your desired content here! e.g: various scenes and landscapes")
     format = st.text_input("Format", "type your desired format here! e.g: pamphlet")
 
-    if st.button("Generate HTML"):
+    generate = st.button("Generate HTML")
+    # Regenerate skips the page cache and replaces the cached page with a fresh one
+    regenerate = st.button("Regenerate")
+    store = get_job_store()
+    job_id = st.query_params.get("job")
+    if generate or regenerate:
         if not target_audience or not stylistic_description or not content_description or not format:
             st.error("All fields must be filled out before submitting.")
+            return
+        # The page is generated as a durable job whose id is kept in the URL, so a refresh
+        # or a dropped connection picks the same job back up instead of starting over
+        job_id = store.create({
+            "target_audience": target_audience,
+            "stylistic_description": stylistic_description,
+            "content_description": content_description,
+            "format": format,
+            "regenerate": regenerate,
+        })
+        st.query_params["job"] = job_id
+    if job_id:
+        await show_job(store, job_id)
+
+async def show_job(store, job_id):
+    status = st.empty()
+    preview = st.empty()
+    job = store.get(job_id)
+    if job is None:
+        status.error("This page has expired, please generate it again.")
+        return
+    # This session works on the job itself unless another worker already has it: a worker
+    # process, or another tab open on the same job, which is why the worker name belongs to
+    # the session and not to the job. If that worker dies, its lease lapses and this
+    # session takes over.
+    worker = st.session_state.setdefault("worker", f"streamlit:{worker_name()}")
+    claimed = None
+    while job["status"] not in (JobStatus.DONE.value, JobStatus.FAILED.value):
+        claimed = store.claim(worker, job_id=job_id)
+        if claimed is not None:
+            break
+        status.info("Inky is working on this page...")
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        job = store.get(job_id)
+    if claimed is None:
+        if job["status"] == JobStatus.DONE.value:
+            status.success("Inky is done!")
+            preview.html(job["html"])
+            show_regeneration(store, job_id)
         else:
-            with st.spinner("Inky is thinking..."):
-                html_content = await generate_html_content(
-                    target_audience=target_audience,
-                    stylistic_description=stylistic_description,
-                    content_description=content_description,
-                    format=format
-                )
-                st.success("Inky has thought of an idea!")
-
-            with st.spinner("Inky is starting.. please wait"):
-                fleshed_out_html = await flesh_out_html(
-                    html_content,
-                    target_audience=target_audience,
-                    stylistic_description=stylistic_description,
-                    content_description=content_description,
-                    format=format
-                )
-                st.success("Inky is done!")
-                st.html(fleshed_out_html)
+            status.error("Inky could not finish this page, please try again.")
+        return
+
+    # The layout is drawn while it streams in, then replaced by the finished page
+    last_render = 0.0
+    status.info("Inky is thinking...")
+    # Closing the run as soon as a rerun or a closed tab interrupts the loop hands the job back
+    async with aclosing(run_job(store, claimed, worker)) as updates:
+        async for stage, html in updates:
+            if stage == "layout":
+                # Re-rendering on every token would swamp the browser, so throttle it
+                if time.monotonic() - last_render > 0.5:
+                    preview.html(html)
+                    last_render = time.monotonic()
+                if "</body>" in html:
+                    status.info("Inky has thought of an idea! Drawing the pictures now.. please wait")
+            elif stage in ("image", "text"):
+                # Pictures and text are placed as they finish
+                preview.html(html)
+            else:
+                status.success("Inky is done!")
+                preview.html(html)
+    if store.get(job_id)["status"] == JobStatus.FAILED.value:
+        status.error("Inky could not finish this page, please try again.")
+    else:
+        show_regeneration(store, job_id)
+
+def show_regeneration(store, job_id):
+    """Lets the user redo chosen pictures or sections of a finished page, keeping the rest."""
+    elements = {element["id"]: element for element in job_elements(store, job_id)}
+    if not elements:
+        return
+    chosen = st.multiselect(
+        "Not happy with some parts? Pick the pictures or sections Inky should redo",
+        list(elements),
+        format_func=lambda element_id: f"{'Picture' if elements[element_id]['type'] == 'image' else 'Text'}: {elements[element_id]['description'][:80]}",
+        key=f"regenerate-{job_id}",
+    )
+    refine = st.checkbox("Also rethink the picture descriptions", key=f"refine-{job_id}")
+    if st.button("Redo selected", disabled=not chosen, key=f"redo-{job_id}"):
+        try:
+            st.query_params["job"] = create_regeneration_job(store, job_id, chosen, refine=refine)
+        except NotRegenerable as exc:
+            st.error(f"Inky cannot redo parts of this page: {exc}")
+            return
+        st.rerun()
+
+async def run():
+    try:
+        await main()
+    finally:
+        # The event loop ends with this script run, so its async clients must be closed here
+        await aclose_async_services()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(run())
\ No newline at end of file
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+from typing import Dict, List, Tuple
+
+from utils import request_chat_completion
+from cache import content_key, get_cache
+from elements import ElementStatus, GraphicElement
+
+# Text placeholders are expanded several to a completion: the page context is sent once per
+# batch rather than once per section, and a page needs a handful of requests instead of one
+# per [DESCRIPTION: "..."] marker.
+TEXT_BATCH_SIZE = int(os.getenv("TEXT_BATCH_SIZE", 6))
+TEXT_CACHE_TTL = float(os.getenv("TEXT_CACHE_TTL", 30 * 24 * 3600))
+# Bump when the prompt below changes, so cached sections are not reused across versions
+TEXT_PROMPT_VERSION = "1"
+
+
+def build_text_expansion_prompt(descriptions: List[str], target_audience: str, stylistic_description: str, content_description: str, format: str) -> str:
+    sections = json.dumps({str(index): description for index, description in enumerate(descriptions)}, indent=2)
+    return f"""Write the text content for the following sections of a {format} with these properties:
+    - Target Audience: {target_audience}
+    - Stylistic Description: {stylistic_description}
+    - Content Description: {content_description}
+
+    Each section is given as an id and a description of what the section should contain:
+    {sections}
+
+    Write every section as a short HTML fragment that will be placed inside an existing <div> of the page. Use only <h3>, <p>, <ul>, <li>, <strong> and <em> tags, no styling, no images and no placeholders. Keep each section to about one paragraph or a short list, with language suited to the target audience.
+
+    Return ONLY a JSON object that maps every section id to its HTML fragment, e.g. {{"0": "<h3>...</h3><p>...</p>", "1": "..."}}
+"""
+
+
+def text_cache_key(description: str, target_audience: str, stylistic_description: str, content_description: str, format: str, variation: int = 0) -> str:
+    parts = [
+        TEXT_PROMPT_VERSION, description, target_audience, stylistic_description, content_description, format,
+        os.getenv("AZURE_OPENAI_CHAT_COMPLETIONS_DEPLOYMENT_NAME")
+    ]
+    # Variation 0 keeps the keys written before elements could be regenerated
+    if variation:
+        parts.append(variation)
+    return content_key(*parts)
+
+
+async def expand_text_batch(elements: List[GraphicElement], target_audience: str, stylistic_description: str, content_description: str, format: str) -> bool:
+    """
+    Fills element.content for a batch of text elements with one JSON-mode completion.
+    Returns False if the request failed or the answer was not a JSON object.
+    """
+    prompt = build_text_expansion_prompt([element.description for element in elements], target_audience, stylistic_description, content_description, format)
+    try:
+        response = await request_chat_completion(prompt, response_format={"type": "json_object"})
+        sections = json.loads(response.choices[0].message.content)
+    except Exception as exc:
+        print(f"Text expansion failed for a batch of {len(elements)} sections: {exc!r}")
+        return False
+    if not isinstance(sections, dict):
+        print(f"Text expansion returned {type(sections).__name__} instead of an object, ignoring it")
+        return False
+    for index, element in enumerate(elements):
+        content = sections.get(str(index))
+        if isinstance(content, str) and content.strip():
+            element.content = content.strip()
+    return True
+
+
+async def run_text_expansions(elements: List[GraphicElement], target_audience: str, stylistic_description: str, content_description: str, format: str, batch_size: int = TEXT_BATCH_SIZE) -> List[GraphicElement]:
+    """
+    Expands every text element, answering repeated descriptions and previously seen sections
+    from the cache, and sending the rest in concurrent batches of `batch_size`. Sections the
+    model left out of an otherwise valid batch answer are retried on their own once.
+    Elements that still have no content keep their placeholder.
+    """
+    context = (target_audience, stylistic_description, content_description, format)
+    text_cache = get_cache("text_expansions", ttl=TEXT_CACHE_TTL)
+    pending: Dict[Tuple[str, int], List[GraphicElement]] = {}
+    for element in elements:
+        if element.type != "text":
+            continue
+        key = (element.description, element.variation)
+        if key in pending:
+            element.status = ElementStatus.GENERATING
+            pending[key].append(element)
+            continue
+        cached = text_cache.get(text_cache_key(element.description, *context, variation=element.variation))
+        if cached is not None:
+            element.content = cached
+            element.status = ElementStatus.DONE
+        else:
+            element.status = ElementStatus.GENERATING
+            pending[key] = [element]
+
+    representatives = [group[0] for group in pending.values()]
+    batches = [representatives[i:i + batch_size] for i in range(0, len(representatives), batch_size)]
+    answered = await asyncio.gather(*[expand_text_batch(batch, *context) for batch in batches])
+    # Only sections the model skipped in an otherwise good answer; a failed request was
+    # already retried inside request_chat_completion
+    missing = [element for batch, ok in zip(batches, answered) if ok and len(batch) > 1 for element in batch if element.content is None]
+    if missing:
+        await asyncio.gather(*[expand_text_batch([element], *context) for element in missing])
+
+    for (description, variation), group in pending.items():
+        content = group[0].content
+        for element in group:
+            element.content = content
+            element.status = ElementStatus.DONE if content is not None else ElementStatus.FAILED
+        if content is not None:
+            text_cache.set(text_cache_key(description, *context, variation=variation), content)
+    return elements
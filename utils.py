@@ -1,59 +1,227 @@
 from dotenv import load_dotenv
 import os
-import openai
-from openai import AzureOpenAI
-from azure.storage.blob import BlobServiceClient
 import asyncio
+import logging
+import threading
+import time
+import weakref
+from scheduler import estimate_tokens, get_limiter, run_rate_limited
+from tokens import count_tokens
+from resilience import retry_call, with_deadline
+# The SDKs are imported when the first client is built, not when this module is (see sdk.py)
+from sdk import azure_blob, httpx, openai
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Per-attempt deadline for a chat completion, and the number of attempts before giving up
+# (429s are not counted: run_rate_limited waits those out on its own)
+CHAT_COMPLETION_TIMEOUT = float(os.getenv("CHAT_COMPLETION_TIMEOUT", 90))
+CHAT_COMPLETION_MAX_TRIES = 3
+# Completion length cap for calls that do not pass their own max_tokens. Azure counts it
+# towards the TPM quota whether or not it is used, so callers that know their output is
+# shorter should pass a smaller one.
+CHAT_COMPLETION_MAX_TOKENS = int(os.getenv("CHAT_COMPLETION_MAX_TOKENS", 4096))
+
 def initialize_openai_client():
+    # The configured openai module itself rather than a client instance, so it has nothing
+    # to close and is not kept in the service registry
     openai.api_key = os.getenv("OPENAI_API_KEY")
     return openai
 
 def initialize_azure_openai_client():
     azure_openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
     azure_openai_api_key = os.getenv("AZURE_OPENAI_API_KEY")
-    return AzureOpenAI(
+    return openai.AzureOpenAI(
         azure_endpoint=azure_openai_endpoint,
         api_key=azure_openai_api_key,
         api_version="2024-06-01"
     )
 
+def initialize_async_azure_openai_client():
+    azure_openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    azure_openai_api_key = os.getenv("AZURE_OPENAI_API_KEY")
+    # 429s are handled by the shared rate limiter (see scheduler.py), which pauses every
+    # caller, rather than by the SDK's per-request retries
+    return openai.AsyncAzureOpenAI(
+        azure_endpoint=azure_openai_endpoint,
+        api_key=azure_openai_api_key,
+        api_version="2024-06-01",
+        max_retries=0
+    )
+
+def initialize_async_replicate_client():
+    # Talks to the Replicate predictions REST API directly; REPLICATE_BASE_URL lets the
+    # client be pointed at a local stub server.
+    replicate_api_token = os.getenv("REPLICATE_API_TOKEN")
+    return httpx.AsyncClient(
+        base_url=os.getenv("REPLICATE_BASE_URL", "https://api.replicate.com"),
+        headers={"Authorization": f"Bearer {replicate_api_token}"},
+        timeout=httpx.Timeout(30.0, connect=5.0)
+    )
+
+def initialize_async_http_client():
+    # Plain client for fetching generated assets; unlike replicate_client it carries no API token
+    return httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=5.0), follow_redirects=True)
+
 def initialize_blob_service_client():
     connection_string = os.getenv("CONNECTION_STRING")
-    return BlobServiceClient.from_connection_string(connection_string)
+    return azure_blob.BlobServiceClient.from_connection_string(connection_string)
+
+# Process-wide service registry. Clients are built lazily on first use and then reused,
+# so every completion shares one connection pool (keep-alive, no repeated TLS handshakes)
+# instead of constructing fresh clients per call.
+_SERVICE_FACTORIES = {
+    "azure_openai_client": initialize_azure_openai_client,
+    "blob_service_client": initialize_blob_service_client,
+}
+_ASYNC_SERVICE_FACTORIES = {
+    "azure_openai_client": initialize_async_azure_openai_client,
+    "replicate_client": initialize_async_replicate_client,
+    "http_client": initialize_async_http_client,
+}
+_services = {}
+# Async clients hold connections bound to the event loop that created them, so they are
+# cached per loop (Streamlit starts a new loop with asyncio.run on every script run).
+_async_services = weakref.WeakKeyDictionary()
+_services_lock = threading.Lock()
+
+def get_service(name):
+    """Returns the shared client registered under `name`, building it on first use."""
+    if name not in _services:
+        with _services_lock:
+            if name not in _services:
+                _services[name] = _SERVICE_FACTORIES[name]()
+    return _services[name]
+
+def get_async_service(name):
+    """Returns the async client registered under `name` for the running event loop."""
+    services = _async_services.setdefault(asyncio.get_running_loop(), {})
+    if name not in services:
+        services[name] = _ASYNC_SERVICE_FACTORIES[name]()
+    return services[name]
 
 def initialize_services():
-    # Initialize OpenAI client
-    openai_client = initialize_openai_client()
+    return {"openai_client": initialize_openai_client(), **{name: get_service(name) for name in _SERVICE_FACTORIES}}
 
-    # Initialize Azure OpenAI client
-    azure_openai_client = initialize_azure_openai_client()
+def close_services():
+    """Closes every synchronous client in the registry. Safe to call more than once."""
+    with _services_lock:
+        services = list(_services.values())
+        _services.clear()
+    for service in services:
+        close = getattr(service, "close", None)
+        if callable(close):
+            close()
 
-    # Initialize Blob Service Client
-    blob_service_client = initialize_blob_service_client()
+async def aclose_async_services():
+    """Closes the async clients bound to the running loop. Call before the loop ends."""
+    services = _async_services.pop(asyncio.get_running_loop(), {})
+    for service in services.values():
+        close = getattr(service, "aclose", None) or service.close
+        await close()
 
-    return {
-        "openai_client": openai_client,
-        "azure_openai_client": azure_openai_client,
-        "blob_service_client": blob_service_client
-    }
+def log_usage(prompt_tokens, completion_tokens, max_tokens, elapsed, cached_tokens=None, first_token=None, finish_reason=None):
+    cached = f" ({cached_tokens} cached)" if cached_tokens else ""
+    first = f", first token after {first_token:.2f}s" if first_token is not None else ""
+    logger.info(
+        "Chat completion: %d prompt tokens%s, %d of %d completion tokens, %.2fs%s",
+        prompt_tokens, cached, completion_tokens, max_tokens, elapsed, first
+    )
+    if finish_reason == "length":
+        logger.warning("Chat completion stopped at max_tokens=%d, so its output is cut off", max_tokens)
 
-async def create_openai_completion(prompt):
-    services = initialize_services()
-    azure_openai_client = services["azure_openai_client"]
+async def request_chat_completion(prompt, **params):
+    # Uses the async client so that concurrent completions (e.g. asyncio.gather over
+    # image refinements) actually overlap instead of blocking the event loop one by one.
+    async_azure_openai_client = get_async_service("azure_openai_client")
     azure_openai_chat_completions_deployment_name = os.getenv("AZURE_OPENAI_CHAT_COMPLETIONS_DEPLOYMENT_NAME")
+    max_tokens = params.pop("max_tokens", CHAT_COMPLETION_MAX_TOKENS)
+    prompt_tokens = count_tokens(prompt)
+
+    # Azure counts max_tokens towards the TPM quota, so it is reserved along with the prompt
+    def attempt():
+        return run_rate_limited(
+            get_limiter("azure_openai"),
+            lambda: with_deadline(
+                async_azure_openai_client.chat.completions.create(
+                    model=azure_openai_chat_completions_deployment_name,
+                    messages=[
+                        {"role": "system", "content": "You are a helpful assistant."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=max_tokens,
+                    temperature=0.7,
+                    top_p=0.95,
+                    **params
+                ),
+                CHAT_COMPLETION_TIMEOUT
+            ),
+            tokens=prompt_tokens + max_tokens
+        )
+
+    start = time.perf_counter()
+    response = await retry_call(attempt, max_tries=CHAT_COMPLETION_MAX_TRIES)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        log_usage(
+            usage.prompt_tokens, usage.completion_tokens, max_tokens, time.perf_counter() - start,
+            cached_tokens=getattr(details, "cached_tokens", None),
+            finish_reason=response.choices[0].finish_reason if response.choices else None
+        )
+    return response
+
+async def request_embeddings(texts):
+    """
+    Embeds `texts` with the AZURE_OPENAI_EMBEDDING_MODEL deployment in one request, returning
+    one vector per text. EMBEDDING_VECTOR_DIMENSIONS, if set, asks the model for shorter vectors.
+    """
+    async_azure_openai_client = get_async_service("azure_openai_client")
+    params = {}
+    if os.getenv("EMBEDDING_VECTOR_DIMENSIONS"):
+        params["dimensions"] = int(os.getenv("EMBEDDING_VECTOR_DIMENSIONS"))
+
+    def attempt():
+        return run_rate_limited(
+            get_limiter("azure_openai_embeddings"),
+            lambda: with_deadline(
+                async_azure_openai_client.embeddings.create(model=os.getenv("AZURE_OPENAI_EMBEDDING_MODEL"), input=list(texts), **params),
+                CHAT_COMPLETION_TIMEOUT
+            ),
+            tokens=sum(estimate_tokens(text) for text in texts)
+        )
+
+    response = await retry_call(attempt, max_tries=CHAT_COMPLETION_MAX_TRIES)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+async def create_openai_completion(prompt, **params):
+    return await request_chat_completion(prompt, **params)
 
-    response = azure_openai_client.chat.completions.create(
-        model=azure_openai_chat_completions_deployment_name,
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=4096,
-        temperature=0.7,
-        top_p=0.95,
+async def stream_openai_completion(prompt, **params):
+    """
+    Yields the completion text as it is generated. Retries and the deadline cover opening the
+    stream (i.e. time to first token); once text has been yielded the stream is not retried.
+    """
+    max_tokens = params.setdefault("max_tokens", CHAT_COMPLETION_MAX_TOKENS)
+    start = time.perf_counter()
+    first_token = None
+    finish_reason = None
+    completion = []
+    stream = await request_chat_completion(prompt, stream=True, **params)
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        if chunk.choices[0].delta.content:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            completion.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+    # Streamed responses carry no usage on this API version, so both sides are counted here
+    log_usage(
+        count_tokens(prompt), count_tokens("".join(completion)), max_tokens, time.perf_counter() - start,
+        first_token=first_token, finish_reason=finish_reason
     )
-    return response
\ No newline at end of file
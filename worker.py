@@ -0,0 +1,61 @@
+# Runs page generation jobs from the job store (see jobs.py and jobstore.py) outside the API
+# server. Each process runs --concurrency jobs at once; start more processes, here or on other
+# machines sharing JOB_BACKEND=redis, to scale out. Stopping a worker hands its running jobs
+# back to the queue, and another worker resumes them from their last checkpoint.
+#
+# The rate limits in scheduler.py apply per process, so divide AZURE_OPENAI_RPM/TPM and
+# REPLICATE_MAX_CONCURRENT_PREDICTIONS between the processes.
+#
+#   python worker.py --processes 4 --concurrency 4
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+
+async def serve(concurrency: int) -> None:
+    from jobs import JobManager
+    from utils import aclose_async_services, close_services
+
+    manager = JobManager(workers=concurrency)
+    manager.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    logging.info("Worker %s running %d jobs at a time", manager.name, concurrency)
+    await stop.wait()
+    await manager.stop()
+    await aclose_async_services()
+    close_services()
+
+
+def run_process(concurrency: int) -> None:
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(concurrency))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs each process runs at once")
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_process(args.concurrency)
+        return
+    processes = [multiprocessing.Process(target=run_process, args=(args.concurrency,)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The children got the same SIGINT and are handing their jobs back
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()